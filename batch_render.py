@@ -0,0 +1,277 @@
+"""Render every combination of scenes, BTF materials and parameter overrides.
+
+Examples
+--------
+Every material in every scene at 64 spp:
+
+    python batch_render.py --scenes simple_sphere matpreview cloth --materials UBO2003/*.zip ATRIUM/*.zip --spp 64
+
+A sweep over the power parameter at half resolution, with the decoded BTFs cached on disk:
+
+    python batch_render.py --scenes matpreview --materials UBO2003/UBO_IMPALLA256.zip --sweep p=1,2,4,32 --resolution-scale 0.5 --cache-dir cache
+
+The images are written to `<output>/<scene>/<material>[_<key><value>...].<format>`, and the timings of
+all jobs to `<output>/manifest.json`.
+"""
+
+import argparse
+import gc
+import importlib
+import itertools
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator, NamedTuple
+import numpy as np
+import mitsuba as mi
+
+mi.set_variant("llvm_ad_rgb")
+
+from custom_bsdf import btf_interpolator, btf_store
+from custom_bsdf.btf_chunked import ChunkedBtf
+from custom_bsdf.measuredbtf import MeasuredBTF
+from custom_bsdf.path_differential import PathDifferential
+from custom_bsdf.render_passes import render_passes
+from custom_bsdf.ubo2003 import Ubo2003
+
+mi.register_bsdf("measuredbtf", lambda props: MeasuredBTF(props))
+mi.register_integrator("path_differential", lambda props: PathDifferential(props))
+
+# Parameters exposed by `MeasuredBTF.traverse`, changed without loading the scene again
+TRAVERSABLE = ("p", "k", "scale", "gamma")
+
+
+class Job(NamedTuple):
+    scene: str
+    material: str
+    overrides: tuple[tuple[str, object], ...]  # sorted (key, value) pairs applied to the measuredbtf plugins
+    label: str = ""  # suffix of the output name, from the swept values
+
+    @property
+    def group(self) -> tuple:
+        """Jobs of a group render one loaded scene, only the traversable parameters differ."""
+        static = tuple((key, value) for key, value in self.overrides if key not in TRAVERSABLE)
+        names = tuple(key for key, _ in self.overrides if key in TRAVERSABLE)
+        return (self.scene, self.material, static, names)
+
+    @property
+    def name(self) -> str:
+        return Path(self.material).stem + self.label
+
+
+class DatasetCache:
+    """Datasets (filename -> bytes) resident in memory, evicted in least recently used order to stay under a budget."""
+
+    def __init__(self, sizes: dict[str, int], budget: float = np.inf) -> None:
+        self.sizes = sizes
+        self.budget = budget
+        self.resident: OrderedDict[str, int] = OrderedDict()
+
+    def missing_bytes(self, files: set[str]) -> int:
+        return sum(self.sizes[file] for file in files if file not in self.resident)
+
+    def require(self, files: set[str]) -> tuple[list[str], list[str]]:
+        """Make `files` resident, returning the loaded and the evicted datasets."""
+        loaded, evicted = [], []
+        for file in sorted(files):
+            if file in self.resident:
+                self.resident.move_to_end(file)
+                continue
+            for old in list(self.resident):
+                if sum(self.resident.values()) + self.sizes[file] <= self.budget:
+                    break
+                if old not in files:
+                    del self.resident[old]
+                    evicted.append(old)
+            self.resident[file] = self.sizes[file]
+            loaded.append(file)
+        return loaded, evicted
+
+
+def parse_value(text: str):
+    """Plugin property value from a command line string (int, float, bool or string)."""
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return {"true": True, "false": False}.get(text.lower(), text)
+
+
+def btf_nodes(node: dict) -> Iterator[dict]:
+    """All `measuredbtf` plugin dictionaries in a scene dictionary."""
+    for value in node.values():
+        if isinstance(value, dict):
+            if value.get("type") == "measuredbtf":
+                yield value
+            yield from btf_nodes(value)
+
+
+def scene_dict(job: Job, resolution_scale: float = 1.0) -> dict:
+    """Scene dictionary of `scenes/<job.scene>/scene.py` with the material and overrides of the job."""
+    module = importlib.reload(importlib.import_module(f"scenes.{job.scene}.scene"))  # fresh dictionary
+    scene = module.scene_dict
+    nodes = list(btf_nodes(scene))
+    if not nodes:
+        raise ValueError(f"The scene '{job.scene}' has no measuredbtf material.")
+    for node in nodes:
+        node["filename"] = job.material
+        node.update(job.overrides)
+    if resolution_scale != 1.0:
+        film = scene["sensor"]["film"]
+        film["width"] = max(1, round(film["width"] * resolution_scale))
+        film["height"] = max(1, round(film["height"] * resolution_scale))
+    return scene
+
+
+def btf_instances(scene: mi.Scene) -> list[MeasuredBTF]:
+    """The `MeasuredBTF` instances of a loaded scene (also nested, e.g. in `twosided`)."""
+    instances = {}
+    for shape in scene.shapes():
+        bsdf = shape.bsdf()
+        for _, _, node, _ in mi.traverse(bsdf).properties.values():
+            if isinstance(node, MeasuredBTF):
+                instances[id(node)] = node
+    return list(instances.values())
+
+
+def dataset_bytes(filename: str, cache_dir: str | None, linearize: str = "none", mip_filter: str = "none") -> int:
+    """Memory of a loaded dataset with the `linearize` and `mip_filter` properties of a job, estimated without loading it.
+
+    With linearize="float16", the float16 copy (2 bytes per texel) is held next to the 8-bit images.
+    The mip levels of `mip_filter` add a third of the images they are built from.
+    """
+    if Path(filename).suffix == ".npz":
+        return Path(filename).stat().st_size
+    if Path(filename).suffix == ".btfc":  # bounded by the chunk cache
+        btf = ChunkedBtf(filename)
+        return min(int(np.prod(btf.shape)) * btf.dtype.itemsize, btf.max_cache_bytes)
+    n, h, w, c = Ubo2003(filename, cache_dir=cache_dir).shape
+    images = n * h * w * c * (2 if linearize == "float16" else 1)
+    size = images + (n * h * w * c if linearize == "float16" else 0)
+    if mip_filter != "none":
+        size += images // 3
+    return size
+
+
+def schedule(jobs: list[Job], needs: list[set[str]], sizes: dict[str, int], budget: float) -> tuple[list[int], int]:
+    """Order the jobs greedily to minimize the dataset loads, returning the order and the number of loads.
+
+    The next job is the one whose datasets take the fewest bytes to load, preferring the group of the
+    previous job (so that the scene is updated instead of loaded again) and then the given order.
+    """
+    cache = DatasetCache(sizes, budget)
+    remaining = list(range(len(jobs)))
+    order, loads, group = [], 0, None
+    while remaining:
+        best = min(remaining, key=lambda i: (cache.missing_bytes(needs[i]), jobs[i].group != group, i))
+        loads += len(cache.require(needs[best])[0])
+        group = jobs[best].group
+        order.append(best)
+        remaining.remove(best)
+    return order, loads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render every combination of scenes, BTF materials and parameter overrides.")
+    parser.add_argument("--scenes", nargs="+", required=True, help="Scene names in scenes/ (e.g. simple_sphere matpreview cloth)")
+    parser.add_argument("--materials", nargs="+", required=True, help="BTF files assigned to the measuredbtf plugins of the scenes")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="Properties set on all measuredbtf plugins (e.g. scale=0.6 backend=drjit)")
+    parser.add_argument("--sweep", nargs="*", default=[], metavar="KEY=V1,V2", help="Properties rendered with each of the values (e.g. p=1,4,32)")
+    parser.add_argument("--spp", type=int, default=16, help="Samples per pixel")
+    parser.add_argument("--sample-per-pass", type=int, default=None, help="Samples per pixel of each render pass (default: all at once)")
+    parser.add_argument("--resolution-scale", type=float, default=1.0, help="Scale factor of the film resolution")
+    parser.add_argument("--cache-dir", default=None, help="Directory for the decoded BTF cache (cache_dir property)")
+    parser.add_argument("--ram-budget-gb", type=float, default=None, help="Memory for the loaded BTF datasets, the least recently used ones are released beyond it")
+    parser.add_argument("--output", default="renders", help="Output directory")
+    parser.add_argument("--format", default="jpg", choices=["jpg", "png", "exr"], help="Image format")
+    parser.add_argument("--dry-run", action="store_true", help="Print the schedule without rendering")
+    args = parser.parse_args()
+
+    static = {key: parse_value(value) for key, value in (item.split("=", 1) for item in args.set)}
+    if args.cache_dir is not None:
+        static.setdefault("cache_dir", args.cache_dir)
+    sweeps = [[(key, parse_value(value)) for value in values.split(",")] for key, values in (item.split("=", 1) for item in args.sweep)]
+    jobs = []
+    for scene, material, combination in itertools.product(args.scenes, args.materials, itertools.product(*sweeps)):
+        overrides = static | dict(combination)
+        label = "".join(f"_{key}{value}" for key, value in combination)
+        jobs.append(Job(scene, material, tuple(sorted(overrides.items())), label))
+
+    # Every measuredbtf plugin of a job renders its material, the job needs that dataset
+    needs = [{str(Path(job.material).resolve())} for job in jobs]
+    # Per dataset, the largest estimate over the jobs using it (linearize and mip_filter add copies)
+    variants = {(file, dict(job.overrides).get("linearize", "none"), dict(job.overrides).get("mip_filter", "none")) for job, files in zip(jobs, needs) for file in files}
+    sizes = {}
+    for file, linearize, mip_filter in variants:
+        sizes[file] = max(sizes.get(file, 0), dataset_bytes(file, args.cache_dir, linearize, mip_filter))
+    budget = np.inf if args.ram_budget_gb is None else args.ram_budget_gb * 2**30
+    order, loads = schedule(jobs, needs, sizes, budget)
+    print(f"{len(jobs)} jobs, {len(sizes)} datasets ({sum(sizes.values()) / 2**30:.2f} GB), {loads} dataset loads")
+    if args.dry_run:
+        for i in order:
+            print(f"  {jobs[i].scene}/{jobs[i].name}")
+        return
+
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    manifest = {"spp": args.spp, "jobs": [], "dataset_loads": 0}
+    cache = DatasetCache(sizes, budget)
+    scene, group = None, None
+    start = time.perf_counter()
+    for i in order:
+        job = jobs[i]
+        loaded, evicted = cache.require(needs[i])
+        if evicted:
+            scene, group = None, None
+            gc.collect()
+            for file in evicted:
+                btf_store.release(file)
+            btf_interpolator.clear_shared()
+
+        setup_start = time.perf_counter()
+        if job.group == group:
+            # Same scene and material, only traversable parameters change
+            for instance in btf_instances(scene):
+                params = mi.traverse(instance)
+                for key, value in job.overrides:
+                    if key in TRAVERSABLE:
+                        params[key] = value
+                params.update()
+            setup = "traverse"
+        else:
+            scene = None
+            scene = mi.load_dict(scene_dict(job, args.resolution_scale))
+            group = job.group
+            setup = "load_dict"
+        setup_seconds = time.perf_counter() - setup_start
+
+        stats, log = render_passes(scene, args.spp, sample_per_pass=args.sample_per_pass, progress=False)
+        file = output / job.scene / f"{job.name}.{args.format}"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        mi.util.write_bitmap(str(file), mi.Bitmap(stats.mean.astype(np.float32)))
+
+        record = {
+            "scene": job.scene,
+            "material": job.material,
+            "overrides": dict(job.overrides),
+            "output": str(file),
+            "setup": setup,
+            "setup_seconds": setup_seconds,
+            "render_seconds": sum(entry["seconds"] for entry in log),
+            "peak_rss_mb": max(entry["peak_rss_mb"] for entry in log),
+            "loaded": loaded,
+            "evicted": evicted,
+        }
+        manifest["jobs"].append(record)
+        manifest["dataset_loads"] += len(loaded)
+        manifest["total_seconds"] = time.perf_counter() - start
+        # Written after every job, so that the manifest of an interrupted batch lists the finished images
+        with open(output / "manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        print(f"{file}: {setup} {setup_seconds:.1f} s, render {record['render_seconds']:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
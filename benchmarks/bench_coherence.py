@@ -0,0 +1,96 @@
+"""Render time and lookup stage times of the `coherence` orders of the texel lookups.
+
+Renders the `cloth` and `matpreview` scenes with a synthetic BTF zip in place of their materials,
+once per `coherence` value, and reports the time of the render and of the gather (including the
+sort and scatter of "sort") as recorded by `custom_bsdf.profiling`, with the mean wavefront size.
+Scenes whose meshes are missing are skipped, missing environment maps are replaced by a constant emitter.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_coherence --scenes cloth matpreview --size 256 --spp 4
+"""
+
+import argparse
+import importlib
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import mitsuba as mi
+
+from benchmarks.synthetic import write_ubo2003_zip
+
+
+def prepare(node: dict, file: str, properties: dict) -> bool:
+    """Point the measuredbtf plugins to `file` and replace missing environment maps (in place). False if other assets are missing."""
+    for name, value in list(node.items()):
+        if not isinstance(value, dict):
+            continue
+        if value.get("type") == "measuredbtf":
+            value.update({"filename": file} | properties)
+        elif "filename" in value and not Path(value["filename"]).exists():
+            if value.get("type") != "envmap":
+                print(f"  missing {value['filename']}")
+                return False
+            node[name] = {"type": "constant", "radiance": {"type": "rgb", "value": 0.5}}
+        elif not prepare(value, file, properties):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", nargs="+", default=["cloth", "matpreview"])
+    parser.add_argument("--modes", nargs="+", default=["none", "sort", "dedup"], help="Values of the coherence property")
+    parser.add_argument("--size", type=int, default=256, help="Image resolution of the synthetic BTF")
+    parser.add_argument("--zip", default=None, help="Synthetic zip file, written if it does not exist (default: temporary file)")
+    parser.add_argument("--cache-dir", default=None, help="cache_dir property, the BTF is then memory-mapped")
+    parser.add_argument("--tile", type=int, default=0, help="tile property")
+    parser.add_argument("--spp", type=int, default=4, help="Samples per pixel, all in one wavefront")
+    parser.add_argument("--resolution-scale", type=float, default=0.5, help="Scale factor of the film resolution")
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    mi.set_variant("llvm_ad_rgb")
+    from custom_bsdf import profiling
+    from custom_bsdf.measuredbtf import MeasuredBTF
+
+    mi.register_bsdf("measuredbtf", lambda props: MeasuredBTF(props))
+    profiling.enable()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = Path(args.zip or Path(tmp) / "SYNTHETIC.zip")
+        if not file.exists():
+            write_ubo2003_zip(file, args.size)
+
+        for scene_name in args.scenes:
+            print(f"{scene_name}:")
+            for mode in args.modes:
+                scene_dict = importlib.reload(importlib.import_module(f"scenes.{scene_name}.scene")).scene_dict
+                properties = {"coherence": mode, "tile": args.tile}
+                if args.cache_dir is not None:
+                    properties["cache_dir"] = args.cache_dir
+                if not prepare(scene_dict, str(file), properties):
+                    break
+                film = scene_dict["sensor"]["film"]
+                film["width"] = max(1, round(film["width"] * args.resolution_scale))
+                film["height"] = max(1, round(film["height"] * args.resolution_scale))
+                scene = mi.load_dict(scene_dict)
+
+                mi.render(scene, spp=args.spp)  # warm up (kernel compilation, page cache)
+                profiling.reset()
+                seconds = []
+                for i in range(args.repeat):
+                    start = time.perf_counter()
+                    np.asarray(mi.render(scene, spp=args.spp, seed=i + 1))
+                    seconds.append(time.perf_counter() - start)
+                stages = profiling.summary()
+                lookup = sum(stages.get(f"BtfInterpolator.{name}", {"seconds": 0.0})["seconds"] for name in ("gather", "sort")) / args.repeat
+                blend = stages["BtfInterpolator.blend"]["seconds"] / args.repeat
+                wavefront = stages["BtfInterpolator.__call__"]["mean_items"]
+                print(f"  {mode:6s} render {np.median(seconds):7.2f} s  gather+sort {lookup:7.3f} s  blend {blend:7.3f} s  mean wavefront {wavefront:9.0f}")
+                del scene
+
+
+if __name__ == "__main__":
+    main()
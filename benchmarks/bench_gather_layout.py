@@ -0,0 +1,57 @@
+"""Texel gather throughput of the image layouts of BtfInterpolator.
+
+Compares the (N, H, W, C) layout with the texel-major tiled layout (H/t, W/t, N, t, t, C)
+for coherent (scanline) and random query orders on synthetic data.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_gather_layout --size 256 --tiles 4 8 16
+"""
+
+import argparse
+import time
+import numpy as np
+
+from custom_bsdf.btf_interpolator import BtfInterpolator
+from benchmarks.synthetic import camera_queries, random_images, ubo2003_angles
+
+
+def measure(interp: BtfInterpolator, index, y, x, repeat: int) -> float:
+    interp.gather(index, y, x)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        interp.gather(index, y, x)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=128, help="Image resolution of the synthetic BTF")
+    parser.add_argument("--resolution", type=int, default=512, help="Queries are one per pixel of a resolution^2 image")
+    parser.add_argument("--uv-scale", type=float, default=1.0, help="Texture repetitions across the image")
+    parser.add_argument("--tiles", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    angles = ubo2003_angles()
+    images = random_images(len(angles), args.size)
+    print(f"images: {images.shape}, {images.nbytes / 2**20:.0f} MiB")
+
+    layouts = {"NHWC": BtfInterpolator(images, angles, k=args.k)}
+    for t in args.tiles:
+        layouts[f"tile {t}"] = BtfInterpolator(images, angles, k=args.k, tile=t)
+
+    for order in ["coherent", "random"]:
+        wi, wr, uv = camera_queries(args.resolution, args.uv_scale, shuffle=order == "random")
+        index, _ = layouts["NHWC"].neighbors(wi, wr)
+        x = np.clip(np.mod(uv[..., 0] * (args.size - 1), args.size).astype(np.uint32), 0, args.size - 1)[..., np.newaxis]
+        y = np.clip(np.mod(uv[..., 1] * (args.size - 1), args.size).astype(np.uint32), 0, args.size - 1)[..., np.newaxis]
+        lookups = index.size
+        for name, interp in layouts.items():
+            seconds = measure(interp, index, y, x, args.repeat)
+            print(f"{order:8s} {name:8s} {lookups / seconds / 1e6:8.1f} M texels/s  {seconds * 1e3:8.1f} ms / {lookups} lookups")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Speed and accuracy of the angular interpolation methods of BtfInterpolator.
+
+The synthetic BTF samples a smooth, glossy reflectance function at the UBO2003 / ATRIUM angles
+(one texel per image), so the interpolation error can be measured against the function itself.
+The seam metric is the largest change of the interpolated value between directions 0.05 degrees
+apart, relative to the largest change of the function: large values indicate discontinuities.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_interpolation --queries 262144
+"""
+
+import argparse
+import time
+import numpy as np
+
+from custom_bsdf.angular_grid import sph_to_dir
+from custom_bsdf.btf_interpolator import BtfInterpolator
+from benchmarks.synthetic import ubo2003_angles
+
+
+def reflectance(wi: np.ndarray, wr: np.ndarray, shininess: float) -> np.ndarray:
+    """Smooth lobe around the mirror direction of the view direction."""
+    mirror = wr * np.array([-1.0, -1.0, 1.0])
+    return np.exp(shininess * (np.sum(wi * mirror, axis=-1) - 1.0)) + 0.1
+
+
+def random_directions(rng: np.random.Generator, n: int, max_theta: float = 85.0) -> np.ndarray:
+    theta = np.radians(max_theta) * np.sqrt(rng.random(n))
+    phi = 2.0 * np.pi * rng.random(n)
+    return sph_to_dir(theta, phi).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=1 << 18)
+    parser.add_argument("--shininess", type=float, default=8.0)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--p", type=float, default=4.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    angles = ubo2003_angles()
+    wl = sph_to_dir(np.radians(angles[:, 0]), np.radians(angles[:, 1]))
+    wv = sph_to_dir(np.radians(angles[:, 2]), np.radians(angles[:, 3]))
+    images = reflectance(wl, wv, args.shininess).astype(np.float32)[:, np.newaxis, np.newaxis, np.newaxis]
+
+    methods = {
+        "idw kdtree": BtfInterpolator(images, angles, k=args.k, p=args.p, mode="kdtree"),
+        "idw grid": BtfInterpolator(images, angles, k=args.k, p=args.p, mode="grid"),
+        "barycentric": BtfInterpolator(images, angles, interpolation="barycentric"),
+    }
+
+    rng = np.random.default_rng(0)
+    wi = random_directions(rng, args.queries)
+    wr = random_directions(rng, args.queries)
+    uv = np.zeros((args.queries, 2), dtype=np.float32)
+    truth = reflectance(wi, wr, args.shininess)
+
+    # Pairs of view directions 0.05 degrees apart along the azimuth
+    n_seam = min(args.queries, 1 << 16)
+    theta = np.radians(80.0) * rng.random(n_seam)
+    phi = 2.0 * np.pi * rng.random(n_seam)
+    delta = np.radians(0.05)
+    wr0 = sph_to_dir(theta, phi).astype(np.float32)
+    wr1 = sph_to_dir(theta, phi + delta).astype(np.float32)
+    truth_step = np.max(np.abs(reflectance(wi[:n_seam], wr1, args.shininess) - reflectance(wi[:n_seam], wr0, args.shininess)))
+
+    for name, interp in methods.items():
+        interp(wi, wr, uv)  # warm up
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            value = interp(wi, wr, uv)[..., 0]
+        seconds = (time.perf_counter() - start) / args.repeat
+        error = np.mean(np.abs(value - truth) / truth)
+        step = np.max(np.abs(interp(wi[:n_seam], wr1, uv[:n_seam]) - interp(wi[:n_seam], wr0, uv[:n_seam])))
+        stencil = interp.neighbors(wi[:1], wr[:1])[0].shape[-1]
+        print(f"{name:12s} {seconds * 1e3:8.1f} ms / {args.queries} evals  {args.queries / seconds / 1e6:6.2f} M evals/s  stencil {stencil}  mean rel. error {error:.4f}  seam {step / truth_step:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Per-evaluation time and memory of the texel storage formats of the numpy backend.
+
+Compares the default uint8 images with scale and inverse gamma applied after blending, uint8
+images with a 256-entry linearization table applied at gather time, and images converted once to
+float16 linear reflectance, on synthetic data.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_linearize --size 128 --resolution 512
+"""
+
+import argparse
+import time
+import numpy as np
+
+from custom_bsdf.btf_interpolator import BtfInterpolator
+from custom_bsdf.linearize import linear_lut, linearize
+from benchmarks.synthetic import camera_queries, random_images, ubo2003_angles
+
+
+def measure(evaluate, repeat: int) -> float:
+    evaluate()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        evaluate()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=128, help="Image resolution of the synthetic BTF")
+    parser.add_argument("--resolution", type=int, default=512, help="Queries are one per pixel of a resolution^2 image")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--gamma", type=float, default=2.2)
+    parser.add_argument("--table-resolution", type=int, default=32, help="Neighbor table resolution, so that the texel path dominates (0: search)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    angles = ubo2003_angles()
+    images = random_images(len(angles), args.size)
+    table_resolution = args.table_resolution if args.table_resolution > 0 else None
+    base = BtfInterpolator(images, angles, k=args.k, table_resolution=table_resolution)
+    wi, wr, uv = camera_queries(args.resolution)
+
+    def gamma_after_blend():
+        value = base(wi, wr, uv)
+        value *= args.scale / 255.0
+        value **= args.gamma
+        return value
+
+    lut = BtfInterpolator(images, angles, k=args.k, table_resolution=table_resolution, lut=linear_lut(args.scale, args.gamma))
+    linear = BtfInterpolator(linearize(images, args.scale, args.gamma), angles, k=args.k, table_resolution=table_resolution)
+    formats = {
+        "uint8 + pow": (gamma_after_blend, images.nbytes),
+        "uint8 + LUT": (lambda: lut(wi, wr, uv), images.nbytes),
+        "float16": (lambda: linear(wi, wr, uv), linear.images.nbytes),
+    }
+
+    reference = gamma_after_blend()
+    lookups = len(wi)
+    for name, (evaluate, nbytes) in formats.items():
+        seconds = measure(evaluate, args.repeat)
+        error = np.mean(np.abs(evaluate() - reference)) / np.mean(reference)
+        print(f"{name:12s} {seconds * 1e3:8.1f} ms / {lookups} evals  {lookups / seconds / 1e6:6.2f} M evals/s  {nbytes / 2**20:8.0f} MiB  rel. diff {error:.4f}")
+
+
+if __name__ == "__main__":
+    main()
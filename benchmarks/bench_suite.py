@@ -0,0 +1,306 @@
+"""Benchmark suite of the BTF loading and evaluation hot paths, with machine-readable results.
+
+Generates a synthetic BTF zip in the UBO2003 format (so that it runs without the real datasets) and
+measures:
+
+- load: reading the zip index (`Ubo2003.__init__`) and decoding all images (`Ubo2003.preload`)
+- build: the angular search structures of `BtfInterpolator` (KD-tree and ring grid)
+- query: `BtfInterpolator.__call__` for each batch size, k and p
+- gather: texel gather bandwidth for coherent and random query orders
+- eval: `MeasuredBTF.eval` on a wavefront of surface interactions, for each backend
+- lod: fitting the diffuse + GGX fallback (`FittedBrdf.fit`), and `MeasuredBTF.eval` with lod="depth"
+  (the wavefront has no ray differentials, so all evaluations use the fitted model), for each backend
+- render: `simple_sphere` with the synthetic material at a fixed spp, for each backend
+
+Each measurement is the median of `--repeat` runs after a warm-up run. The results are written as
+JSON (by default to benchmarks/results/, which is not tracked), and `--compare` prints the ratios
+to the results of an earlier run (e.g. of another commit). With several backends, the stages that
+use them run in one process per backend, since a numpy backend instance disables the recording of
+loops and calls in its process (see `MeasuredBTF`).
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_suite --output benchmarks/results/main.json
+    git checkout other-branch
+    python -m benchmarks.bench_suite --output benchmarks/results/other.json --compare benchmarks/results/main.json
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+import numpy as np
+import mitsuba as mi
+
+from benchmarks.synthetic import camera_queries, write_ubo2003_zip
+
+
+def measure(run: Callable[[], object], repeat: int) -> list[float]:
+    """Seconds of `repeat` runs after a warm-up run."""
+    run()  # warm up
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def result(stage: str, params: dict, seconds: list[float], count: float = None, unit: str = None) -> dict:
+    """Result record: median seconds and, if `count` is given, the throughput in `unit` per second."""
+    record = {"stage": stage, "params": params, "seconds": float(np.median(seconds)), "samples": seconds}
+    if count is not None:
+        record["rate"] = count / record["seconds"]
+        record["unit"] = f"{unit}/s"
+    return record
+
+
+def report(record: dict) -> None:
+    params = " ".join(f"{key}={value}" for key, value in record["params"].items())
+    rate = f"  {record['rate'] / 1e6:10.2f} M{record['unit']}" if "rate" in record else ""
+    print(f"{record['stage']:7s} {params:42s} {record['seconds'] * 1e3:10.1f} ms{rate}")
+
+
+def key(record: dict) -> str:
+    return json.dumps([record["stage"], record["params"]], sort_keys=True)
+
+
+def environment(args: argparse.Namespace) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "mitsuba": mi.__version__,
+        "variant": mi.variant(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "args": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+    }
+
+
+def bench_load(file: Path, repeat: int) -> tuple[list[dict], np.ndarray, np.ndarray]:
+    from custom_bsdf.ubo2003 import Ubo2003
+
+    results = [result("load", {"step": "index"}, measure(lambda: Ubo2003(file), repeat))]
+    data = Ubo2003(file)
+    results.append(result("load", {"step": "preload"}, measure(lambda: Ubo2003(file).preload(), repeat), data.images.nbytes, "B"))
+    return results, data.images, data.angle_array
+
+
+def bench_build(images: np.ndarray, angles: np.ndarray, repeat: int) -> list[dict]:
+    from custom_bsdf.btf_interpolator import BtfInterpolator, clear_shared
+
+    results = []
+    for mode in ["kdtree", "grid"]:
+
+        def build():
+            clear_shared()  # otherwise the structures of the first build are reused
+            BtfInterpolator(images, angles, mode=mode)
+
+        results.append(result("build", {"mode": mode}, measure(build, repeat)))
+    clear_shared()
+    return results
+
+
+def bench_query(images: np.ndarray, angles: np.ndarray, batch_sizes: list[int], ks: list[int], ps: list[float], repeat: int) -> list[dict]:
+    from custom_bsdf.btf_interpolator import BtfInterpolator
+
+    wi, wr, uv = camera_queries(int(np.ceil(np.sqrt(max(batch_sizes)))), uv_scale=4.0)
+    results = []
+    for k in ks:
+        for p in ps:
+            interp = BtfInterpolator(images, angles, k=k, p=p)
+            for n in batch_sizes:
+                seconds = measure(lambda: interp(wi[:n], wr[:n], uv[:n]), repeat)
+                results.append(result("query", {"batch": n, "k": k, "p": p}, seconds, n, "evals"))
+    return results
+
+
+def bench_gather(images: np.ndarray, angles: np.ndarray, resolution: int, k: int, repeat: int) -> list[dict]:
+    from custom_bsdf.btf_interpolator import BtfInterpolator
+
+    interp = BtfInterpolator(images, angles, k=k)
+    _, height, width, channels = images.shape
+    results = []
+    for order in ["coherent", "random"]:
+        wi, wr, uv = camera_queries(resolution, uv_scale=4.0, shuffle=order == "random")
+        index, _ = interp.neighbors(wi, wr)
+        x = (np.mod(uv[:, 0], 1.0) * (width - 1)).astype(np.uint32)[:, np.newaxis]
+        y = (np.mod(uv[:, 1], 1.0) * (height - 1)).astype(np.uint32)[:, np.newaxis]
+        seconds = measure(lambda: interp.gather(index, y, x), repeat)
+        results.append(result("gather", {"order": order, "k": k}, seconds, index.size * channels * images.itemsize, "B"))
+    return results
+
+
+def bench_eval(file: Path, resolution: int, backends: list[str], repeat: int, properties: dict | None = None, stage: str = "eval") -> list[dict]:
+    import drjit as dr
+
+    wi, wr, uv = camera_queries(resolution)
+    n = len(wi)
+    si = dr.zeros(mi.SurfaceInteraction3f, n)
+    si.wi = mi.Vector3f(wr.T)
+    si.uv = mi.Point2f(uv.T)
+    wo = mi.Vector3f(wi.T)
+    ctx = mi.BSDFContext()
+    results = []
+    for backend in backends:
+        bsdf = mi.load_dict({"type": "measuredbtf", "filename": str(file), "backend": backend} | (properties or {}))
+
+        def evaluate():
+            value = bsdf.eval(ctx, si, wo, True)
+            dr.eval(value)
+            dr.sync_thread()
+
+        results.append(result(stage, {"backend": backend, "batch": n}, measure(evaluate, repeat), n, "evals"))
+    return results
+
+
+def bench_lod(file: Path, images: np.ndarray, angles: np.ndarray, resolution: int, backends: list[str], repeat: int) -> list[dict]:
+    from custom_bsdf.btf_fit import FittedBrdf
+    from custom_bsdf.path_differential import PathDifferential
+
+    start = time.perf_counter()
+    fit = FittedBrdf.fit(images, angles)
+    results = [result("lod", {"step": "fit"}, [time.perf_counter() - start], images.size, "texels")]
+    fit_file = file.with_name(f"{file.stem}_fit.npz")
+    fit.save(fit_file)
+    # The queries have no ray differentials, like the secondary bounces of path_differential (the fitted model is timed).
+    # MeasuredBTF refuses lod when no such integrator exists, as differentials would never arrive.
+    PathDifferential(mi.Properties())
+    return results + bench_eval(file, resolution, backends, repeat, {"lod": "depth", "lod_filename": str(fit_file)}, stage="lod")
+
+
+def bench_render(file: Path, resolution: int, spp: int, backends: list[str], repeat: int) -> list[dict]:
+    import drjit as dr
+
+    results = []
+    for backend in backends:
+        scene_dict = importlib.reload(importlib.import_module("scenes.simple_sphere.scene")).scene_dict
+        scene_dict["sensor"]["film"]["width"] = scene_dict["sensor"]["film"]["height"] = resolution
+        scene_dict["sphere"]["bsdf"].update({"filename": str(file), "backend": backend})
+        params = {"backend": backend, "resolution": resolution, "spp": spp}
+
+        start = time.perf_counter()
+        scene = mi.load_dict(scene_dict)
+        results.append(result("render", params | {"step": "load"}, [time.perf_counter() - start]))
+
+        def render():
+            image = mi.render(scene, spp=spp)
+            dr.eval(image)
+            dr.sync_thread()
+
+        # The first render includes the kernel compilation (or its lookup in the Dr.Jit cache)
+        start = time.perf_counter()
+        render()
+        results.append(result("render", params | {"step": "first"}, [time.perf_counter() - start]))
+        results.append(result("render", params | {"step": "frame"}, measure(render, repeat), resolution**2 * spp, "samples"))
+    return results
+
+
+def run_backend(backend: str, stages: list[str], file: Path, args: argparse.Namespace) -> list[dict]:
+    """Run the `stages` of one backend in a new process and return its results."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = Path(tmp) / "results.json"
+        options = ["--size", str(args.size), "--quality", str(args.quality), "--resolution", str(args.resolution), "--spp", str(args.spp), "--variant", args.variant, "--repeat", str(args.repeat)]
+        command = [sys.executable, "-m", "benchmarks.bench_suite", "--stages", *stages, "--backends", backend, "--zip", str(file), "--output", str(output), *options]
+        subprocess.run(command, check=True, cwd=Path(__file__).resolve().parent.parent)
+        with open(output) as f:
+            return json.load(f)["results"]
+
+
+def compare(results: list[dict], file: str) -> None:
+    """Print the time ratios to the matching results of an earlier run (> 1: slower now)."""
+    with open(file) as f:
+        baseline = {key(record): record for record in json.load(f)["results"]}
+    print(f"\nCompared to {file} (time ratio, > 1 is slower):")
+    for record in results:
+        if key(record) in baseline:
+            params = " ".join(f"{name}={value}" for name, value in record["params"].items())
+            ratio = record["seconds"] / baseline[key(record)]["seconds"]
+            print(f"{record['stage']:7s} {params:42s} {ratio:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stages", nargs="+", default=["load", "build", "query", "gather", "eval", "lod", "render"], help="Stages to run")
+    parser.add_argument("--size", type=int, default=64, help="Image resolution of the synthetic BTF")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG quality of the synthetic BTF")
+    parser.add_argument("--zip", default=None, help="Synthetic zip file, written if it does not exist (default: temporary file)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1024, 16384, 262144])
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--p", type=float, nargs="+", default=[1.0, 4.0, 32.0])
+    parser.add_argument("--resolution", type=int, default=256, help="Image resolution of the gather, eval and render stages")
+    parser.add_argument("--spp", type=int, default=4, help="Samples per pixel of the render stage")
+    parser.add_argument("--backends", nargs="+", default=["numpy", "drjit"], help="MeasuredBTF backends of the eval and render stages")
+    parser.add_argument("--variant", default="llvm_ad_rgb")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmarks/results/bench.json", help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    mi.set_variant(args.variant)
+    from custom_bsdf.measuredbtf import MeasuredBTF
+
+    mi.register_bsdf("measuredbtf", lambda props: MeasuredBTF(props))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = Path(args.zip or Path(tmp) / "SYNTHETIC.zip")
+        if not file.exists():
+            start = time.perf_counter()
+            write_ubo2003_zip(file, args.size, args.quality)
+            print(f"{file}: {file.stat().st_size / 2**20:.1f} MiB, written in {time.perf_counter() - start:.1f} s")
+
+        if "load" in args.stages:
+            results, images, angles = bench_load(file, args.repeat)
+            for record in results:
+                report(record)
+        else:
+            from custom_bsdf.ubo2003 import Ubo2003
+
+            data = Ubo2003(file)
+            results, images, angles = [], data.images, data.angle_array
+        stages = {
+            "build": lambda: bench_build(images, angles, args.repeat),
+            "query": lambda: bench_query(images, angles, args.batch_sizes, args.k, args.p, args.repeat),
+            "gather": lambda: bench_gather(images, angles, args.resolution, 4, args.repeat),
+            "eval": lambda: bench_eval(file, args.resolution, args.backends, args.repeat),
+            "lod": lambda: bench_lod(file, images, angles, args.resolution, args.backends, args.repeat),
+            "render": lambda: bench_render(file, args.resolution, args.spp, args.backends, args.repeat),
+        }
+        # The numpy backend disables the recording of loops and calls in its process, which would slow down the drjit backend
+        backend_stages = [stage for stage in ("eval", "lod", "render") if stage in args.stages]
+        separate = len(args.backends) > 1 and backend_stages
+        for stage, run in stages.items():
+            if stage in args.stages and not (separate and stage in backend_stages):
+                for record in run():
+                    report(record)
+                    results.append(record)
+        if separate:
+            for backend in args.backends:
+                results += run_backend(backend, backend_stages, file, args)  # reported by the subprocess
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(args), "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Synthetic BTF data for the benchmarks, so that they run without the real datasets."""
+
+from pathlib import Path
+from zipfile import ZIP_STORED, ZipFile
+import numpy as np
+
+# (polar angle, number of azimuths) of the direction rings in the UBO2003 / ATRIUM datasets
+UBO2003_RINGS = [(0, 1), (15, 6), (30, 12), (45, 18), (60, 20), (75, 24)]
+
+
+def ubo2003_directions() -> list[tuple[float, float]]:
+    """The 81 (theta, phi) directions in degrees of the UBO2003 / ATRIUM sampling."""
+    return [(float(theta), j * 360.0 / n) for theta, n in UBO2003_RINGS for j in range(n)]
+
+
+def ubo2003_angles() -> np.ndarray:
+    """(6561, 4) angles (tl, pl, tv, pv) in degrees, ordered by view then light direction as in the zip files."""
+    dirs = ubo2003_directions()
+    return np.array([(tl, pl, tv, pv) for tv, pv in dirs for tl, pl in dirs], dtype=np.float32)
+
+
+def random_images(num: int, size: int, seed: int = 0) -> np.ndarray:
+    """(num, size, size, 3) uint8 images."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (num, size, size, 3), dtype=np.uint8)
+
+
+def camera_queries(resolution: int, uv_scale: float = 1.0, shuffle: bool = False, seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(wi, wr, uv) for one sample per pixel of a `resolution`^2 image of a textured, curved surface.
+
+    In scanline order, neighboring queries have similar directions and texture coordinates, like
+    coherent camera rays. With `shuffle`, the order is random.
+    """
+    s = (np.arange(resolution, dtype=np.float32) + 0.5) / resolution
+    sx, sy = np.meshgrid(s, s, indexing="xy")
+    sx, sy = sx.reshape(-1), sy.reshape(-1)
+
+    # The normal tilts across the image, the light and the camera are fixed
+    theta_v = np.radians(70.0) * np.abs(2.0 * sx - 1.0)
+    phi_v = np.where(sx < 0.5, np.pi, 0.0) + 0.3 * sy
+    theta_l = np.radians(10.0 + 60.0 * sy)
+    phi_l = np.radians(40.0) + np.zeros_like(sx)
+    wr = np.stack([np.sin(theta_v) * np.cos(phi_v), np.sin(theta_v) * np.sin(phi_v), np.cos(theta_v)], axis=-1)
+    wi = np.stack([np.sin(theta_l) * np.cos(phi_l), np.sin(theta_l) * np.sin(phi_l), np.cos(theta_l)], axis=-1)
+    uv = np.stack([sx, sy], axis=-1) * uv_scale
+
+    if shuffle:
+        order = np.random.default_rng(seed).permutation(len(uv))
+        wi, wr, uv = wi[order], wr[order], uv[order]
+    return wi.astype(np.float32), wr.astype(np.float32), uv.astype(np.float32)
+
+
+def write_ubo2003_zip(file: str | Path, size: int = 64, quality: int = 90, seed: int = 0) -> Path:
+    """Write a synthetic BTF zip with the member names and angles of the UBO2003 datasets.
+
+    Every image is a random texture modulated by a smooth function of the light and view
+    directions, JPEG-encoded like the real datasets, so that loading and decoding cost about the
+    same per texel.
+    """
+    import cv2
+
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    texture = random_images(1, size, seed)[0].astype(np.float32)
+    with ZipFile(file, "w", ZIP_STORED) as z:
+        for i, (tl, pl, tv, pv) in enumerate(ubo2003_angles()):
+            shade = (0.3 + 0.7 * np.cos(np.radians(tl))) * (0.6 + 0.4 * np.cos(np.radians(pl - pv))) * (0.5 + 0.5 * np.cos(np.radians(tv)))
+            image = np.clip(texture * shade, 0, 255).astype(np.uint8)
+            ok, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise RuntimeError("JPEG encoding failed.")
+            folder = f"tv{tv:03.0f}_pv{pv:03.0f}"
+            z.writestr(f"UBO2003/MANYFILES/{folder}/{i:05d} tl{tl:03.0f} pl{pl:03.0f} tv{tv:03.0f} pv{pv:03.0f}.jpg", data.tobytes())
+    return file
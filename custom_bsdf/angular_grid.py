@@ -0,0 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import numpy as np
+import numpy.typing as npt
+from scipy.spatial import Delaunay
+
+
+def sph_to_dir(theta, phi):
+    st = np.sin(theta)
+    x = st * np.cos(phi)
+    y = st * np.sin(phi)
+    z = np.cos(theta)
+    return np.stack([x, y, z], axis=-1)
+
+
+class HemisphereRings:
+    """Directions on a hemisphere arranged in rings of constant polar angle with uniformly spaced azimuths.
+
+    This is the layout of the light and view directions in the UBO2003 and ATRIUM datasets
+    (81 directions in 6 rings: 1, 6, 12, 18, 20, 24 directions at theta = 0, 15, ..., 75 degrees).
+
+    Parameters
+    ----------
+    theta, phi : ndarray (D,)
+        Polar and azimuth angles of the directions in degrees.
+        The directions are sorted ring by ring in increasing azimuth.
+
+    Use `HemisphereRings.from_angles` to detect the layout from unordered angles.
+    """
+
+    def __init__(self, theta: npt.ArrayLike, phi: npt.ArrayLike) -> None:
+        self.theta = np.asarray(theta, dtype=np.float64)
+        self.phi = np.asarray(phi, dtype=np.float64)
+        self.dirs = sph_to_dir(np.radians(self.theta), np.radians(self.phi)).astype(np.float32)
+
+        # (polar angle, start index, count, first azimuth) of each ring
+        self._ring_theta, self._ring_start, self._ring_count = np.unique(self.theta, return_index=True, return_counts=True)
+        self._ring_phi0 = self.phi[self._ring_start]
+
+    @classmethod
+    def from_angles(cls, theta: npt.ArrayLike, phi: npt.ArrayLike, atol: float = 1e-3) -> Optional[tuple["HemisphereRings", np.ndarray]]:
+        """Detect the ring layout of unique directions.
+
+        Returns
+        -------
+        (rings, order) or None
+            `rings` holds the directions sorted ring by ring, and `order` maps each of them to the input index.
+            None if the directions are not arranged in uniformly spaced rings.
+        """
+        theta = np.asarray(theta, dtype=np.float64)
+        phi = np.mod(np.asarray(phi, dtype=np.float64), 360.0)
+        order = np.lexsort((phi, np.round(theta / atol)))
+        theta, phi = theta[order], phi[order]
+
+        _, start, count = np.unique(np.round(theta / atol), return_index=True, return_counts=True)
+        for s, n in zip(start, count):
+            step = 360.0 / n
+            expected = phi[s] + step * np.arange(n)
+            if not np.allclose(phi[s : s + n], expected, atol=atol):
+                return None
+        return cls(theta, phi), order
+
+    def nearest(self, w: np.ndarray, m: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the squared distances and indices (..., m') of the m' = min(m, D) nearest directions to `w` (..., 3)."""
+        # Squared distance to a direction (theta_r, phi_r) in cylindrical coordinates (rho, phi, z) of w:
+        #   |w - d|^2 = (z - cos(theta_r))^2 + (rho - sin(theta_r))^2 + 4 rho sin(theta_r) sin^2((phi - phi_r) / 2)
+        # All rings are evaluated at once on a (..., ring, m) grid of candidates.
+        dtype = w.dtype
+        rho = np.hypot(w[..., 0], w[..., 1])[..., np.newaxis]
+        z = w[..., 2, np.newaxis]
+        phi = np.degrees(np.arctan2(w[..., 1], w[..., 0]))[..., np.newaxis]
+
+        n = self._ring_count.astype(dtype)[:, np.newaxis]  # (R, 1)
+        small = self._ring_count <= m  # rings where every direction is a candidate
+        x = (phi - self._ring_phi0.astype(dtype)) * (n[:, 0] / 360.0)  # (..., R) azimuth in units of ring steps
+        # The m nearest directions on a ring are the m azimuth steps centered at phi
+        j0 = np.where(small, 0.0, np.round(x - (m - 1) / 2)).astype(dtype)
+        j = j0[..., np.newaxis] + np.arange(m, dtype=dtype)  # (..., R, m)
+        half_dphi = (x[..., np.newaxis] - j) * (np.pi / n)
+        theta = np.radians(self._ring_theta).astype(dtype)
+        st, ct = np.sin(theta), np.cos(theta)
+        d2_ring = (z - ct) ** 2 + (rho - st) ** 2  # (..., R)
+        d2 = d2_ring[..., np.newaxis] + (4.0 * rho * st)[..., np.newaxis] * np.sin(half_dphi) ** 2
+        d2[..., (np.arange(m) >= self._ring_count[:, np.newaxis])] = np.inf  # rings with fewer than m directions
+        idx = self._ring_start[:, np.newaxis] + np.mod(j.astype(np.int64), self._ring_count[:, np.newaxis])
+
+        d2 = d2.reshape(d2.shape[:-2] + (-1,))
+        idx = idx.reshape(idx.shape[:-2] + (-1,))
+        m = min(m, len(self.dirs))
+        part = np.argpartition(d2, m - 1, axis=-1)[..., :m]
+        return np.take_along_axis(d2, part, axis=-1), np.take_along_axis(idx, part, axis=-1)
+
+
+class RingGridLookup:
+    """Exact k-nearest-neighbor search over (light, view) angle sets laid out on hemispherical rings.
+
+    The sample set must be the product of a light ring layout and a view ring layout, as in the
+    UBO2003 and ATRIUM datasets. The neighbors are identical to a KD-tree query on the 6D points
+    (xl, yl, zl, xv, yv, zv) with the Euclidean metric, but are found by computing ring / azimuth
+    indices directly instead of traversing a tree.
+
+    Because the 6D distance is the sum of the light and view distances, each of the k nearest pairs
+    consists of one of the k nearest light directions and one of the k nearest view directions,
+    so only k x k pairs have to be compared.
+
+    Use `RingGridLookup.from_angles` to detect whether a dataset has this layout.
+    """
+
+    def __init__(self, light: HemisphereRings, view: HemisphereRings, pair_index: np.ndarray) -> None:
+        self.light = light
+        self.view = view
+        self.pair_index = pair_index  # (num light, num view) -> image index
+
+    @classmethod
+    def from_angles(cls, angles: npt.ArrayLike, atol: float = 1e-3) -> Optional["RingGridLookup"]:
+        """Build the lookup from (N, 4) angles (tl, pl, tv, pv) in degrees, or return None if the layout is irregular."""
+        angles = np.asarray(angles, dtype=np.float64)
+        key = np.round(angles / atol).astype(np.int64)
+        key[:, 1] = np.where(key[:, 0] == 0, 0, key[:, 1])  # azimuth is irrelevant at the pole
+        key[:, 3] = np.where(key[:, 2] == 0, 0, key[:, 3])
+        light_keys, light_inv = np.unique(key[:, :2], axis=0, return_inverse=True)
+        view_keys, view_inv = np.unique(key[:, 2:], axis=0, return_inverse=True)
+        light_inv, view_inv = light_inv.reshape(-1), view_inv.reshape(-1)
+        if len(light_keys) * len(view_keys) != len(angles):
+            return None
+
+        pair_index = np.full((len(light_keys), len(view_keys)), -1, dtype=np.int64)
+        pair_index[light_inv, view_inv] = np.arange(len(angles))
+        if np.any(pair_index < 0):
+            return None
+
+        light = HemisphereRings.from_angles(*(light_keys * atol).T, atol=atol)
+        view = HemisphereRings.from_angles(*(view_keys * atol).T, atol=atol)
+        if light is None or view is None:
+            return None
+        (light, light_order), (view, view_order) = light, view
+        return cls(light, view, pair_index[light_order][:, view_order])
+
+    def query(self, wi: np.ndarray, wr: np.ndarray, k: int, chunk_size: int = 65536, workers: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return the distances and image indices (..., k) of the k nearest samples, sorted by distance.
+
+        The queries are processed in chunks of `chunk_size` in a thread pool to bound the memory usage.
+        """
+        batch_shape = wi.shape[:-1]
+        wi = wi.reshape(-1, 3)
+        wr = wr.reshape(-1, 3)
+        distance = np.empty((len(wi), k), dtype=np.float32)
+        index = np.empty((len(wi), k), dtype=np.int64)
+
+        def run(start):
+            sl = slice(start, start + chunk_size)
+            distance[sl], index[sl] = self._query(wi[sl], wr[sl], k)
+
+        starts = range(0, len(wi), chunk_size)
+        if len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                list(ex.map(run, starts))
+        else:
+            for start in starts:
+                run(start)
+
+        return distance.reshape(batch_shape + (k,)), index.reshape(batch_shape + (k,))
+
+    def _query(self, wi: np.ndarray, wr: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        dl, il = _sorted(*self.light.nearest(wi, k))  # (B, kl)
+        dv, iv = _sorted(*self.view.nearest(wr, k))  # (B, kv)
+        kl, kv = il.shape[-1], iv.shape[-1]
+        if k > kl * kv:
+            raise ValueError(f"k={k} exceeds the number of samples ({kl * kv}).")
+
+        # With both lists sorted, the pair of the a-th light and b-th view direction is beaten by
+        # all (a+1)(b+1)-1 pairs (a' <= a, b' <= b), so it can only be among the k nearest if (a+1)(b+1) <= k
+        a, b = np.array([(a, b) for a in range(kl) for b in range(kv) if (a + 1) * (b + 1) <= k]).T
+        d2 = dl[:, a] + dv[:, b]
+        index = self.pair_index[il[:, a], iv[:, b]]
+        if k < len(a):
+            part = np.argpartition(d2, k - 1, axis=-1)[:, :k]
+            d2 = np.take_along_axis(d2, part, axis=-1)
+            index = np.take_along_axis(index, part, axis=-1)
+        d2, index = _sorted(d2, index)
+        return np.sqrt(np.maximum(d2, 0.0)), index
+
+
+def _sorted(d: np.ndarray, index: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(d, axis=-1)
+    return np.take_along_axis(d, order, axis=-1), np.take_along_axis(index, order, axis=-1)
+
+
+class HemisphereTriangulation:
+    """Delaunay triangulation of directions on a hemisphere for barycentric interpolation.
+
+    The directions are projected orthographically onto the unit disk (x, y) and triangulated once.
+    A query direction is located in its triangle, and the barycentric coordinates of its projection
+    are the interpolation weights, which vary continuously with the direction. Directions outside
+    the convex hull of the samples (e.g. beyond 75 degrees in UBO2003) are moved to the closest
+    point of the hull.
+
+    Parameters
+    ----------
+    dirs : ndarray (D, 3)
+        Unit directions on the upper hemisphere.
+    """
+
+    def __init__(self, dirs: npt.ArrayLike) -> None:
+        self.dirs = np.asarray(dirs, dtype=np.float32)
+        self._tri = Delaunay(self.dirs[:, :2].astype(np.float64))
+        hull = self._tri.convex_hull  # (E, 2) vertex indices of the hull edges
+        self._hull_a = self._tri.points[hull[:, 0]]
+        self._hull_b = self._tri.points[hull[:, 1]]
+        self._center = self._tri.points.mean(axis=0)
+
+    def barycentric(self, w: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the vertex indices and barycentric weights (..., 3) of the triangles containing the directions `w` (..., 3)."""
+        batch_shape = w.shape[:-1]
+        p = np.asarray(w, dtype=np.float64)[..., :2].reshape(-1, 2)
+        simplex = self._tri.find_simplex(p)
+        outside = simplex < 0
+        if np.any(outside):
+            p = p.copy()
+            p[outside] = self._closest_on_hull(p[outside])
+            simplex[outside] = self._tri.find_simplex(p[outside])
+            simplex = np.maximum(simplex, 0)  # should not happen, guard against round-off
+
+        transform = self._tri.transform[simplex]  # (M, 3, 2)
+        b = np.einsum("mij,mj->mi", transform[:, :2], p - transform[:, 2])
+        weights = np.concatenate([b, 1.0 - b.sum(axis=-1, keepdims=True)], axis=-1)
+        weights = np.maximum(weights, 0.0)
+        weights /= weights.sum(axis=-1, keepdims=True)
+        index = self._tri.simplices[simplex]
+        return index.reshape(batch_shape + (3,)), weights.astype(np.float32).reshape(batch_shape + (3,))
+
+    def _closest_on_hull(self, p: np.ndarray) -> np.ndarray:
+        # Closest point on each hull edge, then the nearest one, nudged towards the inside
+        ab = self._hull_b - self._hull_a  # (E, 2)
+        t = np.einsum("mej,ej->me", p[:, np.newaxis] - self._hull_a, ab) / np.sum(ab * ab, axis=-1)
+        q = self._hull_a + np.clip(t, 0.0, 1.0)[..., np.newaxis] * ab  # (M, E, 2)
+        nearest = np.argmin(np.sum((q - p[:, np.newaxis]) ** 2, axis=-1), axis=-1)
+        q = q[np.arange(len(p)), nearest]
+        return q + (self._center - q) * 1e-7
+
+
+class BarycentricLookup:
+    """Barycentric interpolation over (light, view) angle sets that are the product of two direction sets.
+
+    Each hemisphere is triangulated (see `HemisphereTriangulation`), and the 3 light x 3 view
+    vertices of the triangles containing (wi, wr) are blended with the products of their barycentric
+    weights. The stencil is always 9 samples, and the result is continuous in both directions.
+    """
+
+    def __init__(self, light: np.ndarray, view: np.ndarray, pair_index: np.ndarray) -> None:
+        self.light = HemisphereTriangulation(light)
+        self.view = HemisphereTriangulation(view)
+        self.pair_index = pair_index  # (num light, num view) -> image index
+
+    @classmethod
+    def from_angles(cls, angles: npt.ArrayLike) -> Optional["BarycentricLookup"]:
+        """Build the lookup from (N, 4) angles (tl, pl, tv, pv) in degrees, or return None if the layout is not supported."""
+        grid = RingGridLookup.from_angles(angles)
+        if grid is None:
+            return None
+        return cls(grid.light.dirs, grid.view.dirs, grid.pair_index)
+
+    def neighbors(self, wi: np.ndarray, wr: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the image indices and weights (..., 9) to blend for each (wi, wr) pair."""
+        il, wl = self.light.barycentric(wi)
+        iv, wv = self.view.barycentric(wr)
+        index = self.pair_index[il[..., :, np.newaxis], iv[..., np.newaxis, :]]
+        weights = wl[..., :, np.newaxis] * wv[..., np.newaxis, :]
+        return index.reshape(index.shape[:-2] + (9,)), weights.reshape(weights.shape[:-2] + (9,))
@@ -0,0 +1,295 @@
+"""Chunked BTF container with independently compressed chunks and random access.
+
+Command line usage:
+
+    python -m custom_bsdf.btf_chunked UBO2003/UBO_IMPALLA256.zip --output UBO2003/IMPALLA256.btfc
+
+converts a BTF zip, and prints the size and the read time of the container.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+import numpy as np
+
+# File layout:
+#   [magic (8 bytes)][index offset (8 bytes)][chunk data ...][json header][chunk offsets (uint64, n_chunks + 1)]
+# The chunk offsets are absolute, chunk i occupies bytes [offsets[i], offsets[i + 1]).
+MAGIC = b"BTFCHNK1"
+CODECS = ("zlib", "none")
+
+
+class ChunkedBtf:
+    """BTF in a chunked container, decompressed chunk by chunk on lookup.
+
+    The image stack (N, H, W, C) is divided into chunks of `chunk[0]` consecutive angular samples x
+    `chunk[1]` x `chunk[1]` texels, each compressed independently (zlib) and located through an
+    offset index. `gather` reads only the chunks touched by a lookup, and keeps the decompressed
+    chunks in an LRU cache of `max_cache_bytes`. The object can be used in place of the image array
+    of `BtfInterpolator`.
+
+    Compared to the JPEG zip, a lookup of a few texels decompresses a small lossless chunk instead of
+    decoding whole images. Compared to the raw `.npy` cache, the file is smaller (how much depends on
+    the material) and only the touched chunks occupy memory.
+
+    Parameters
+    ----------
+    file : str or Path
+        Container written by `write_chunked`.
+    max_cache_bytes : int
+        Memory of the decompressed chunk cache. At least one chunk is cached.
+    max_workers : int, optional
+        Threads decompressing the missing chunks of a lookup.
+
+    Examples
+    --------
+    >>> write_chunked(Ubo2003("UBO2003/UBO_IMPALLA256.zip"), "IMPALLA256.btfc")
+    >>> btf = ChunkedBtf("IMPALLA256.btfc", max_cache_bytes=256 * 2**20)
+    >>> interp = BtfInterpolator(btf, btf.angles)
+    >>> btf.cache_info()
+    {'hits': 0, 'misses': 0, 'evictions': 0, 'chunks': 0, 'bytes': 0, 'max_bytes': 268435456}
+    """
+
+    def __init__(self, file: str | Path, max_cache_bytes: int = 512 * 2**20, max_workers: Optional[int] = None) -> None:
+        self.file = str(file)
+        self.max_workers = max_workers
+        self._fd = os.open(self.file, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        head = os.pread(self._fd, 16, 0)
+        if head[:8] != MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"{self.file} is not a chunked BTF container.")
+        index_offset = int(np.frombuffer(head, dtype=np.uint64, count=1, offset=8)[0])
+        index = os.pread(self._fd, os.fstat(self._fd).st_size - index_offset, index_offset)
+        header_size = int(np.frombuffer(index, dtype=np.uint64, count=1)[0])
+        header = json.loads(index[8 : 8 + header_size])
+        self.shape: tuple[int, int, int, int] = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.angles = np.asarray(header["angles"], dtype=np.float64).reshape(-1, 4)
+        self.chunk: tuple[int, int] = tuple(header["chunk"])
+        self.codec: str = header["codec"]
+        if self.codec not in CODECS:
+            raise ValueError(f"Unknown codec '{self.codec}' in {self.file}.")
+        n, h, w, c = self.shape
+        a, t = self.chunk
+        self.grid = (-(-h // t), -(-w // t), -(-n // a))  # chunks along y, x and the angular samples, ids are (angular, y, x) major to minor
+        self.offsets = np.frombuffer(index, dtype=np.uint64, offset=8 + header_size).astype(np.int64)
+        if len(self.offsets) != np.prod(self.grid) + 1:
+            raise ValueError(f"Corrupt chunk index in {self.file}.")
+
+        # Decompressed chunks live in the slots of one array, so that a lookup is a single fancy index
+        chunk_bytes = a * t * t * c * self.dtype.itemsize
+        self.max_cache_bytes = max_cache_bytes
+        self._capacity = int(max(1, min(len(self.offsets) - 1, max_cache_bytes // chunk_bytes)))
+        self._slots: Optional[np.ndarray] = None
+        self._free = list(range(self._capacity))[::-1]
+        self._lru: OrderedDict[int, int] = OrderedDict()  # chunk id -> slot
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = 0
+
+    @property
+    def nbytes(self) -> int:
+        """Compressed size of the chunks."""
+        return int(self.offsets[-1] - self.offsets[0])
+
+    def chunk_ids(self, index, y, x) -> np.ndarray:
+        """Chunk ids of the texels `images[index, y, x]`."""
+        a, t = self.chunk
+        ny, nx, na = self.grid
+        return ((np.asarray(index, dtype=np.int64) // a) * ny + np.asarray(y, dtype=np.int64) // t) * nx + np.asarray(x, dtype=np.int64) // t
+
+    def read_chunk(self, chunk_id: int) -> np.ndarray:
+        """Decompress one chunk (angular samples, rows, columns, C), smaller at the borders of the stack."""
+        n, h, w, c = self.shape
+        a, t = self.chunk
+        ny, nx, na = self.grid
+        ia, tile = divmod(int(chunk_id), ny * nx)
+        ty, tx = divmod(tile, nx)
+        shape = (min(a, n - ia * a), min(t, h - ty * t), min(t, w - tx * t), c)
+        data = os.pread(self._fd, int(self.offsets[chunk_id + 1] - self.offsets[chunk_id]), int(self.offsets[chunk_id]))
+        if self.codec == "zlib":
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def gather(self, index, y, x) -> np.ndarray:
+        """Return the texels `images[index, y, x]` (broadcast shape + (C,)), reading only the touched chunks."""
+        index, y, x = np.broadcast_arrays(np.asarray(index, dtype=np.int64), np.asarray(y, dtype=np.int64), np.asarray(x, dtype=np.int64))
+        shape = index.shape
+        index, y, x = index.reshape(-1), y.reshape(-1), x.reshape(-1)
+        a, t = self.chunk
+        used, inverse = np.unique(self.chunk_ids(index, y, x), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        out = np.empty((len(index), self.shape[-1]), dtype=self.dtype)
+
+        with self._lock:
+            if self._slots is None:
+                self._slots = np.empty((self._capacity, a, t, t, self.shape[-1]), dtype=self.dtype)
+            # More chunks than fit in the cache are processed in rounds
+            for start in range(0, len(used), self._capacity):
+                ids = used[start : start + self._capacity]
+                slots = self._acquire(ids)
+                sel = (inverse >= start) & (inverse < start + len(ids)) if len(used) > self._capacity else slice(None)
+                slot = slots[inverse[sel] - start]
+                out[sel] = self._slots[slot, index[sel] % a, y[sel] % t, x[sel] % t]
+        return out.reshape(shape + (-1,))
+
+    def _acquire(self, ids: np.ndarray) -> np.ndarray:
+        """Slots holding the chunks `ids` (at most the capacity), decompressing the missing ones."""
+        slots = np.empty(len(ids), dtype=np.int64)
+        missing = []
+        for i, chunk_id in enumerate(ids.tolist()):
+            slot = self._lru.get(chunk_id)
+            if slot is None:
+                missing.append(i)
+            else:
+                self._lru.move_to_end(chunk_id)
+                slots[i] = slot
+        self._hits += len(ids) - len(missing)
+        self._misses += len(missing)
+
+        # The chunks of this round are at the end of the LRU order, so the evicted ones are not among them
+        for i in missing:
+            if self._free:
+                slots[i] = self._free.pop()
+            else:
+                _, slots[i] = self._lru.popitem(last=False)
+                self._evictions += 1
+
+        def load(i):
+            chunk = self.read_chunk(ids[i])
+            self._slots[slots[i], : chunk.shape[0], : chunk.shape[1], : chunk.shape[2]] = chunk
+
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as ex:  # zlib releases the GIL
+                list(ex.map(load, missing))
+        elif missing:
+            load(missing[0])
+        for i in missing:
+            self._lru[int(ids[i])] = int(slots[i])
+        return slots
+
+    def cache_info(self) -> dict[str, int]:
+        """Hit, miss and eviction counters (in chunks) and the current size of the chunk cache."""
+        with self._lock:
+            a, t = self.chunk
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "chunks": len(self._lru),
+                "bytes": len(self._lru) * a * t * t * self.shape[-1] * self.dtype.itemsize,
+                "max_bytes": self.max_cache_bytes,
+            }
+
+    def clear_cache(self) -> None:
+        """Drop all chunks from the cache (and its memory) and reset the counters."""
+        with self._lock:
+            self._lru.clear()
+            self._slots = None
+            self._free = list(range(self._capacity))[::-1]
+            self._hits = self._misses = self._evictions = 0
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self) -> None:
+        if getattr(self, "_fd", None) is not None:
+            self.close()
+
+
+def write_chunked(source, file: str | Path, chunk: tuple[int, int] = (16, 32), codec: str = "zlib", level: int = 1, max_workers: Optional[int] = None, angles=None) -> Path:
+    """Write a BTF into a chunked container readable by `ChunkedBtf`.
+
+    Parameters
+    ----------
+    source : Ubo2003 or ndarray (N, H, W, C)
+        BTF to convert. A `Ubo2003` is decoded `chunk[0]` images at a time, so the full stack is
+        never held in memory.
+    file : str or Path
+        Output file (conventionally `.btfc`). Written to a temporary file and renamed when complete.
+    chunk : (int, int)
+        Angular samples and texels (square) per chunk. Lookups touching few texels read less with
+        small chunks, larger chunks compress better.
+    codec : str
+        "zlib" or "none".
+    level : int
+        zlib compression level, 1 is the fastest to write. Decompression is about as fast for all levels.
+    max_workers : int, optional
+        Threads compressing the chunks.
+    angles : ndarray (N, 4), optional
+        (tl, pl, tv, pv) of the images, required if `source` is an array.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}'. Use {' or '.join(repr(c) for c in CODECS)}.")
+    is_ubo = hasattr(source, "indices_to_images")
+    angles = np.asarray(source.angle_array if is_ubo else angles, dtype=np.float64)
+    n, h, w, c = source.shape
+    if angles.shape != (n, 4):
+        raise ValueError("angles must have shape (N,4).")
+    a, t = chunk
+    ny, nx, na = -(-h // t), -(-w // t), -(-n // a)
+    dtype = np.dtype(source.dtype)
+
+    def compress(block: np.ndarray) -> bytes:
+        data = np.ascontiguousarray(block).tobytes()
+        return zlib.compress(data, level) if codec == "zlib" else data
+
+    file = Path(file)
+    file_tmp = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+    sizes = []  # in chunk id order, which is the order of the file
+    with open(file_tmp, "wb") as f, ThreadPoolExecutor(max_workers=max_workers) as ex:
+        f.write(MAGIC + bytes(8))
+        for ia in range(na):
+            samples = np.arange(ia * a, min((ia + 1) * a, n))
+            block = source.indices_to_images(samples) if is_ubo else np.asarray(source[samples[0] : samples[-1] + 1])
+            tiles = [(ty, tx) for ty in range(ny) for tx in range(nx)]
+            for data in ex.map(lambda tile: compress(block[:, tile[0] * t : (tile[0] + 1) * t, tile[1] * t : (tile[1] + 1) * t]), tiles):
+                f.write(data)
+                sizes.append(len(data))
+
+        offsets = (16 + np.concatenate([[0], np.cumsum(sizes)])).astype(np.uint64)
+        header = json.dumps({"shape": [n, h, w, c], "dtype": dtype.str, "angles": angles.tolist(), "chunk": [a, t], "codec": codec}).encode()
+        index_offset = f.tell()
+        f.write(np.uint64(len(header)).tobytes() + header + offsets.tobytes())
+        f.seek(8)
+        f.write(np.uint64(index_offset).tobytes())
+    os.replace(file_tmp, file)
+    return file
+
+
+def main():
+    from .ubo2003 import Ubo2003
+
+    parser = argparse.ArgumentParser(description="Convert a UBO2003 / ATRIUM BTF zip into a chunked container.")
+    parser.add_argument("filename", help="BTF zip file")
+    parser.add_argument("--output", required=True, help="Output file (.btfc)")
+    parser.add_argument("--chunk", type=int, nargs=2, default=[16, 32], metavar=("SAMPLES", "TEXELS"), help="Angular samples and texels per chunk")
+    parser.add_argument("--codec", default="zlib", choices=CODECS)
+    parser.add_argument("--level", type=int, default=1, help="zlib compression level")
+    parser.add_argument("--cache-dir", help="Cache directory of the decoded images, see Ubo2003")
+    args = parser.parse_args()
+
+    ubo = Ubo2003(args.filename, cache_dir=args.cache_dir)
+    start = time.perf_counter()
+    write_chunked(ubo, args.output, chunk=tuple(args.chunk), codec=args.codec, level=args.level)
+    seconds = time.perf_counter() - start
+
+    btf = ChunkedBtf(args.output)
+    raw = int(np.prod(btf.shape)) * btf.dtype.itemsize
+    print(f"zip: {Path(args.filename).stat().st_size / 2**20:.1f} MiB, raw: {raw / 2**20:.1f} MiB, chunked: {Path(args.output).stat().st_size / 2**20:.1f} MiB ({raw / btf.nbytes:.1f}x), written in {seconds:.1f} s")
+    start = time.perf_counter()
+    for chunk_id in range(len(btf.offsets) - 1):
+        btf.read_chunk(chunk_id)
+    print(f"read all {len(btf.offsets) - 1} chunks in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
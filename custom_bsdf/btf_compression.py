@@ -0,0 +1,192 @@
+"""Low-rank (truncated SVD) compression of measured BTFs.
+
+Command line usage:
+
+    python -m custom_bsdf.btf_compression UBO2003/UBO_IMPALLA256.zip --rank 8 16 32 --output IMPALLA256_r{rank}.npz
+
+prints the reconstruction error and the memory footprint for each rank and saves the compressed BTFs.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Iterator, Optional
+import numpy as np
+import numpy.typing as npt
+
+
+class CompressedBtf:
+    """BTF stored as a truncated SVD with spatial and angular factors.
+
+    The images are approximated as
+
+        images[n, y, x, c] ~= sum_r spatial[y, x, c, r] * angular[n, r]
+
+    i.e. each texel channel has `rank` coefficients, and each angular sample has `rank` basis weights.
+    Only the requested texels x angles are reconstructed on lookup, so the full image stack is never
+    held in memory. The object can be used in place of the image array of `BtfInterpolator`.
+
+    Inputs
+    ------
+    spatial : ndarray (H, W, C, rank)
+        Spatial factors (including the singular values).
+    angular : ndarray (N, rank)
+        Angular factors.
+    angles : ndarray (N, 4)
+        (tl, pl, tv, pv) in degrees for each angular sample.
+
+    Examples
+    --------
+    >>> ubo = Ubo2003("UBO2003/UBO_IMPALLA256.zip")
+    >>> btf = CompressedBtf.fit(ubo.images, ubo.angles, rank=32)
+    >>> btf.nbytes / ubo.images.nbytes
+    0.0201...
+    >>> btf.save("IMPALLA256_r32.npz")
+    >>> interp = BtfInterpolator(CompressedBtf.load("IMPALLA256_r32.npz"), ubo.angles)
+    """
+
+    def __init__(self, spatial: npt.ArrayLike, angular: npt.ArrayLike, angles: npt.ArrayLike) -> None:
+        self.spatial = np.ascontiguousarray(spatial, dtype=np.float32)
+        self.angular = np.ascontiguousarray(angular, dtype=np.float32)
+        self.angles = np.asarray(angles, dtype=np.float32)
+        if self.spatial.ndim != 4 or self.angular.ndim != 2 or self.spatial.shape[-1] != self.angular.shape[-1]:
+            raise ValueError("spatial and angular must have shapes (H,W,C,rank) and (N,rank).")
+        if len(self.angles) != len(self.angular):
+            raise ValueError("angular and angles batch dimension mismatch.")
+
+    @property
+    def rank(self) -> int:
+        return self.angular.shape[-1]
+
+    @property
+    def shape(self) -> tuple[int, int, int, int]:
+        """Shape (N, H, W, C) of the represented image stack."""
+        return (len(self.angular),) + self.spatial.shape[:3]
+
+    @property
+    def nbytes(self) -> int:
+        return self.spatial.nbytes + self.angular.nbytes
+
+    def truncate(self, rank: int) -> "CompressedBtf":
+        """Keep the first `rank` components."""
+        return CompressedBtf(self.spatial[..., :rank], self.angular[:, :rank], self.angles)
+
+    def gather(self, index, y, x, chunk_size: int = 65536) -> np.ndarray:
+        """Reconstruct the texels `images[index, y, x]` (broadcast shape + (C,)) as float32.
+
+        Negative values of the approximation are clamped to zero.
+        """
+        index, y, x = np.broadcast_arrays(np.asarray(index), np.asarray(y), np.asarray(x))
+        shape = index.shape
+        index, y, x = index.reshape(-1), y.reshape(-1), x.reshape(-1)
+        out = np.empty((len(index), self.spatial.shape[2]), dtype=np.float32)
+        for start in range(0, len(index), chunk_size):
+            sl = slice(start, start + chunk_size)
+            # (M, C, rank) @ (M, rank, 1) -> (M, C, 1)
+            out[sl] = np.matmul(self.spatial[y[sl], x[sl]], self.angular[index[sl], :, np.newaxis])[..., 0]
+        np.maximum(out, 0.0, out=out)
+        return out.reshape(shape + (out.shape[-1],))
+
+    def reconstruct(self, index: int) -> np.ndarray:
+        """Reconstruct the full image (H, W, C) of angular sample `index`."""
+        return self.spatial @ self.angular[index]
+
+    @classmethod
+    def fit(cls, images: npt.ArrayLike, angles: npt.ArrayLike, rank: int, oversample: int = 10, power_iterations: int = 2, rows_per_chunk: int = 8, seed: int = 0) -> "CompressedBtf":
+        """Compute a truncated SVD of the images with a randomized range finder.
+
+        The (H * W * C) x N matrix of texel channels over angular samples is streamed in chunks of
+        `rows_per_chunk` image rows, so memory stays bounded even for memory-mapped image stacks.
+        """
+        images = np.asarray(images)
+        n, h, w, c = images.shape
+        size = rank + oversample
+        rng = np.random.default_rng(seed)
+
+        # Range finder: Y = A Omega, followed by power iterations Y = A (A^T Y)
+        omega = rng.standard_normal((n, size)).astype(np.float32)
+        y_mat = np.concatenate([a @ omega for _, a in _row_chunks(images, rows_per_chunk)])
+        for _ in range(power_iterations):
+            q, _ = np.linalg.qr(y_mat)
+            z = sum(a.T @ q[sl] for sl, a in _row_chunks(images, rows_per_chunk))
+            z, _ = np.linalg.qr(z)
+            y_mat = np.concatenate([a @ z for _, a in _row_chunks(images, rows_per_chunk)])
+        q, _ = np.linalg.qr(y_mat)
+
+        # B = Q^T A is small (size x N), its SVD gives the factors: A ~= (Q U_b S) V^T
+        b_mat = sum(q[sl].T @ a for sl, a in _row_chunks(images, rows_per_chunk))
+        u_b, s, vt = np.linalg.svd(b_mat, full_matrices=False)
+        spatial = (q @ (u_b[:, :rank] * s[:rank])).reshape(h, w, c, rank)
+        angular = vt[:rank].T
+        return cls(spatial, angular, angles)
+
+    def error(self, images: npt.ArrayLike, ranks: Optional[list[int]] = None, rows_per_chunk: int = 8) -> dict[int, dict[str, float]]:
+        """Reconstruction error against the original images for each rank (default: the full rank).
+
+        Returns RMSE, PSNR (peak 255) and relative error ||A - A_r|| / ||A|| per rank.
+        """
+        images = np.asarray(images)
+        ranks = [self.rank] if ranks is None else ranks
+        sq_err = {r: 0.0 for r in ranks}
+        sq_norm = 0.0
+        spatial = self.spatial.reshape(-1, self.rank)
+        for sl, a in _row_chunks(images, rows_per_chunk):
+            sq_norm += float(np.sum(a.astype(np.float64) ** 2))
+            for r in ranks:
+                diff = a - spatial[sl, :r] @ self.angular[:, :r].T
+                sq_err[r] += float(np.sum(diff.astype(np.float64) ** 2))
+        result = {}
+        for r in ranks:
+            mse = sq_err[r] / images.size
+            result[r] = {
+                "rmse": float(np.sqrt(mse)),
+                "psnr": float(10.0 * np.log10(255.0**2 / mse)) if mse > 0 else float("inf"),
+                "relative_error": float(np.sqrt(sq_err[r] / sq_norm)),
+            }
+        return result
+
+    def save(self, file: str | Path) -> None:
+        with open(file, "wb") as f:
+            np.savez(f, spatial=self.spatial, angular=self.angular, angles=self.angles)
+
+    @classmethod
+    def load(cls, file: str | Path) -> "CompressedBtf":
+        with np.load(file) as data:
+            return cls(data["spatial"], data["angular"], data["angles"])
+
+
+def _row_chunks(images: np.ndarray, rows_per_chunk: int) -> Iterator[tuple[slice, np.ndarray]]:
+    """Yield (row slice, A[rows]) of the (H * W * C) x N float32 matrix, `rows_per_chunk` image rows at a time."""
+    n, h, w, c = images.shape
+    for y0 in range(0, h, rows_per_chunk):
+        y1 = min(y0 + rows_per_chunk, h)
+        a = np.asarray(images[:, y0:y1], dtype=np.float32).reshape(n, -1).T  # (rows, N)
+        yield slice(y0 * w * c, y1 * w * c), a
+
+
+def main():
+    from .ubo2003 import Ubo2003
+
+    parser = argparse.ArgumentParser(description="Compress a UBO2003 / ATRIUM BTF with a truncated SVD.")
+    parser.add_argument("filename", help="BTF zip file")
+    parser.add_argument("--rank", type=int, nargs="+", default=[8, 16, 32, 64], help="Ranks to evaluate")
+    parser.add_argument("--output", help="Output file, '{rank}' is replaced by the rank (e.g. out_r{rank}.npz)")
+    parser.add_argument("--cache-dir", help="Cache directory of the decoded images, see Ubo2003")
+    args = parser.parse_args()
+
+    ubo = Ubo2003(args.filename, cache_dir=args.cache_dir)
+    images = ubo.images
+    btf = CompressedBtf.fit(images, ubo.angles, rank=max(args.rank))
+    errors = btf.error(images, ranks=args.rank)
+
+    print(f"original: {images.nbytes / 2**20:.1f} MiB")
+    for rank in args.rank:
+        truncated = btf.truncate(rank)
+        e = errors[rank]
+        ratio = images.nbytes / truncated.nbytes
+        print(f"rank {rank:4d}: {truncated.nbytes / 2**20:8.1f} MiB ({ratio:6.1f}x)  RMSE {e['rmse']:6.2f}  PSNR {e['psnr']:6.2f} dB  relative error {e['relative_error']:.4f}")
+        if args.output is not None:
+            truncated.save(args.output.format(rank=rank))
+
+
+if __name__ == "__main__":
+    main()
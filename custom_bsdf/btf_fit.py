@@ -0,0 +1,254 @@
+"""Per-texel diffuse + GGX fit of measured BTFs, used as a cheap level of detail.
+
+Command line usage:
+
+    python -m custom_bsdf.btf_fit UBO2003/UBO_IMPALLA256.zip --output UBO2003/IMPALLA256_fit.npz
+
+prints the fit error and the size of the textures and saves them.
+"""
+
+from __future__ import annotations  # the Mitsuba types of the annotations need a variant, which main() sets
+
+import argparse
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+import numpy as np
+import numpy.typing as npt
+import mitsuba as mi
+import drjit as dr
+
+from .angular_grid import sph_to_dir
+from .btf_interpolator import is_image_source
+from .linearize import linear_lut
+
+# Roughness candidates of the fit
+ALPHAS = np.geomspace(0.02, 1.0, 16)
+
+
+class FittedBrdf:
+    """Analytic diffuse + GGX model with per-texel parameters, fitted to a measured BTF.
+
+    The linear reflectance (v / 255)^gamma of the BTF (the value that `MeasuredBTF` divides by pi) is
+    approximated for light direction l, view direction v and half vector h as
+
+        value[y, x, c] ~= diffuse[y, x, c] * cos(l) + specular[y, x, c] * pi * D(h) G(l, v) / (4 cos(v))
+
+    with the GGX distribution D and Smith shadowing G of roughness alpha[y, x], i.e. pi times a
+    Lambertian + microfacet BRDF times the cosine foreshortening, Fresnel folded into `specular`.
+    `scale` is not part of the fit, the value for a scale s is s^gamma times the above.
+
+    An evaluation is three texture reads and closed-form math in Dr.Jit, see `eval`.
+
+    Inputs
+    ------
+    diffuse : ndarray (H, W, 3)
+        Diffuse albedo (RGB, linear).
+    specular : ndarray (H, W, 3)
+        Specular weight (RGB, linear).
+    alpha : ndarray (H, W)
+        GGX roughness.
+    gamma : float
+        Gamma of the linear conversion the model was fitted for.
+    error : ndarray (H, W), optional
+        RMS error of the fit over the angular samples and channels, in linear units.
+
+    Examples
+    --------
+    >>> ubo = Ubo2003("UBO2003/UBO_IMPALLA256.zip")
+    >>> fit = FittedBrdf.fit(ubo.images, ubo.angle_array)
+    >>> fit.nbytes / ubo.images.nbytes
+    0.0014...
+    >>> fit.save("IMPALLA256_fit.npz")
+    """
+
+    def __init__(self, diffuse: npt.ArrayLike, specular: npt.ArrayLike, alpha: npt.ArrayLike, gamma: float = 2.2, error: Optional[npt.ArrayLike] = None) -> None:
+        self.diffuse = np.ascontiguousarray(diffuse, dtype=np.float32)
+        self.specular = np.ascontiguousarray(specular, dtype=np.float32)
+        self.alpha = np.ascontiguousarray(alpha, dtype=np.float32)
+        self.gamma = float(gamma)
+        self.error = None if error is None else np.asarray(error, dtype=np.float32)
+        if self.diffuse.ndim != 3 or self.diffuse.shape[-1] != 3 or self.specular.shape != self.diffuse.shape or self.alpha.shape != self.diffuse.shape[:2]:
+            raise ValueError("diffuse, specular and alpha must have shapes (H,W,3), (H,W,3) and (H,W).")
+        self._textures: Optional[tuple[mi.Float, mi.Float, mi.Float]] = None
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """Texture resolution (H, W)."""
+        return self.alpha.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.diffuse.nbytes + self.specular.nbytes + self.alpha.nbytes
+
+    def eval(self, wi: mi.Vector3f, wr: mi.Vector3f, uv: mi.Point2f, active: mi.Mask = True) -> mi.Color3f:
+        """Linear reflectance (RGB) of the model for light direction `wi`, view direction `wr` and texture coordinates `uv`.
+
+        The texel is the nearest one, with the uv convention of `BtfInterpolator`.
+        """
+        from .drjit_btf import _wrap  # needs a variant, which the CLI sets after the import of this module
+
+        if self._textures is None:
+            self._textures = (mi.Float(self.diffuse.reshape(-1)), mi.Float(self.specular.reshape(-1)), mi.Float(self.alpha.reshape(-1)))
+        diffuse, specular, alpha = self._textures
+        h, w = self.shape
+        x = _wrap(uv.x * (w - 1), w)
+        y = _wrap(uv.y * (h - 1), h)
+        texel = y * w + x
+        a = dr.gather(mi.Float, alpha, texel, active)
+        kd = dr.gather(mi.Color3f, diffuse, texel, active)
+        ks = dr.gather(mi.Color3f, specular, texel, active)
+        return kd * mi.Frame3f.cos_theta(wi) + ks * specular_lobe(a, wi, wr)
+
+    @classmethod
+    def fit(cls, images: npt.ArrayLike, angles: npt.ArrayLike, gamma: float = 2.2, alphas: npt.ArrayLike = ALPHAS, factor: int = 1, rows_per_chunk: int = 4) -> "FittedBrdf":
+        """Fit the model to the images (N, H, W, C) in BGR order (e.g. `Ubo2003.images` or an image source).
+
+        For each roughness in `alphas`, the model is linear in the diffuse and specular weights, so the
+        non-negative least squares weights of every texel channel are solved in closed form, and the
+        roughness with the smallest error over the three channels is kept. With `factor` > 1, the linear
+        texels are averaged over blocks of `factor` x `factor` before fitting (lower texture resolution).
+        The images are streamed in chunks of `rows_per_chunk` x `factor` rows.
+        """
+        angles = np.asarray(angles, dtype=np.float64)
+        n, h, w, c = images.shape
+        if c != 3:
+            raise ValueError("images must have 3 channels.")
+        if len(angles) != n:
+            raise ValueError("images and angles batch dimension mismatch.")
+        factor = max(1, int(factor))
+        alphas = np.asarray(alphas, dtype=np.float32)
+
+        # Basis (N, 2 * len(alphas)): the diffuse and the specular term of each roughness
+        wi = sph_to_dir(np.radians(angles[:, 0]), np.radians(angles[:, 1]))
+        wr = sph_to_dir(np.radians(angles[:, 2]), np.radians(angles[:, 3]))
+        lobes = specular_lobe(mi.Float(np.repeat(alphas, n)), mi.Vector3f(np.tile(wi, (len(alphas), 1)).T), mi.Vector3f(np.tile(wr, (len(alphas), 1)).T))
+        lobes = np.asarray(lobes, dtype=np.float64).reshape(len(alphas), n)
+        basis = np.empty((n, 2 * len(alphas)), dtype=np.float64)
+        basis[:, 0::2] = wi[:, 2:3]
+        basis[:, 1::2] = lobes.T
+        gram = np.einsum("na,nb->ab", basis, basis)
+        basis = basis.astype(np.float32)
+
+        h, w = h // factor, w // factor
+        diffuse = np.empty((h, w, 3), dtype=np.float32)
+        specular = np.empty((h, w, 3), dtype=np.float32)
+        alpha = np.empty((h, w), dtype=np.float32)
+        error = np.empty((h, w), dtype=np.float32)
+        lut = linear_lut(1.0, gamma)
+        for rows, values in _linear_rows(images, lut, gamma, factor, rows_per_chunk):
+            projection = (basis.T @ values).astype(np.float64)  # (2 * len(alphas), M)
+            norm = np.einsum("nm,nm->m", values, values, dtype=np.float64)
+            best = None
+            for j in range(len(alphas)):
+                kd, ks, residual = _nonnegative_solve(gram[2 * j : 2 * j + 2, 2 * j : 2 * j + 2], projection[2 * j], projection[2 * j + 1], norm)
+                residual = residual.reshape(-1, 3).sum(axis=-1)  # per texel
+                if best is None:
+                    best = [kd, ks, residual, np.zeros(len(residual), dtype=np.int64)]
+                else:
+                    better = residual < best[2]
+                    best[0] = np.where(np.repeat(better, 3), kd, best[0])
+                    best[1] = np.where(np.repeat(better, 3), ks, best[1])
+                    best[2] = np.where(better, residual, best[2])
+                    best[3] = np.where(better, j, best[3])
+            kd, ks, residual, j = best
+            shape = (rows.stop - rows.start, w)
+            diffuse[rows] = kd.reshape(shape + (3,))[..., ::-1]  # BGR -> RGB
+            specular[rows] = ks.reshape(shape + (3,))[..., ::-1]
+            alpha[rows] = alphas[j].reshape(shape)
+            error[rows] = np.sqrt(np.maximum(residual, 0.0) / (n * 3)).reshape(shape)
+        return cls(diffuse, specular, alpha, gamma, error)
+
+    def save(self, file: str | Path) -> None:
+        with open(file, "wb") as f:
+            arrays = {} if self.error is None else {"error": self.error}
+            np.savez(f, diffuse=self.diffuse, specular=self.specular, alpha=self.alpha, gamma=self.gamma, **arrays)
+
+    @classmethod
+    def load(cls, file: str | Path) -> "FittedBrdf":
+        with np.load(file) as data:
+            return cls(data["diffuse"], data["specular"], data["alpha"], float(data["gamma"]), data["error"] if "error" in data else None)
+
+
+def specular_lobe(alpha: mi.Float, wi: mi.Vector3f, wr: mi.Vector3f) -> mi.Float:
+    """pi D(h) G(wi, wr) / (4 cos(wr)) of the GGX distribution with roughness `alpha` (zero below the horizon)."""
+    distr = mi.MicrofacetDistribution(mi.MicrofacetType.GGX, alpha, alpha, False)
+    m = dr.normalize(wi + wr)
+    cos_theta_r = mi.Frame3f.cos_theta(wr)
+    value = dr.pi * distr.eval(m) * distr.G(wi, wr, m) / (4.0 * cos_theta_r)
+    return dr.select((cos_theta_r > 0.0) & (mi.Frame3f.cos_theta(wi) > 0.0), value, 0.0)
+
+
+def _nonnegative_solve(gram: np.ndarray, pd: np.ndarray, ps: np.ndarray, norm: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Non-negative least squares weights (kd, ks) of a two column basis and the squared residuals.
+
+    `gram` is the 2 x 2 Gram matrix of the basis, `pd` and `ps` the projections of the values on the
+    columns and `norm` their squared norms. The residual of the least squares weights c is norm - c . p.
+    """
+    (gdd, gds), (_, gss) = gram
+    det = gdd * gss - gds * gds
+    kd = (gss * pd - gds * ps) / det
+    ks = (gdd * ps - gds * pd) / det
+    residual = norm - kd * pd - ks * ps
+    # If a weight is negative, the optimum is on the boundary: the other column alone (or zero)
+    kd_only = np.maximum(pd, 0.0) / gdd
+    ks_only = np.maximum(ps, 0.0) / gss
+    residual_d = norm - kd_only * pd
+    residual_s = norm - ks_only * ps
+    inside = (kd >= 0.0) & (ks >= 0.0)
+    diffuse_only = ~inside & (residual_d <= residual_s)
+    specular_only = ~inside & ~diffuse_only
+    kd = np.where(inside, kd, np.where(diffuse_only, kd_only, 0.0))
+    ks = np.where(inside, ks, np.where(specular_only, ks_only, 0.0))
+    residual = np.where(inside, residual, np.where(diffuse_only, residual_d, residual_s))
+    return kd.astype(np.float32), ks.astype(np.float32), residual
+
+
+def _linear_rows(images, lut: np.ndarray, gamma: float, factor: int, rows_per_chunk: int) -> Iterator[tuple[slice, np.ndarray]]:
+    """Yield (output row slice, values (N, rows * W' * C) float32) of the linear, block averaged images."""
+    n, h, w, c = images.shape
+    h, w = h // factor * factor, w // factor * factor
+    step = rows_per_chunk * factor
+    for y0 in range(0, h, step):
+        y1 = min(y0 + step, h)
+        if is_image_source(images):
+            yy, xx = np.meshgrid(np.arange(y0, y1), np.arange(w), indexing="ij")
+            block = images.gather(np.arange(n)[:, np.newaxis, np.newaxis], yy, xx)
+        else:
+            block = np.asarray(images[:, y0:y1, :w])
+        if block.dtype == np.uint8:
+            block = lut[block]
+        else:
+            block = (np.maximum(block.astype(np.float32), 0.0) / 255.0) ** gamma
+        if factor > 1:
+            block = block.reshape(n, (y1 - y0) // factor, factor, w // factor, factor, c).mean(axis=(2, 4))
+        yield slice(y0 // factor, y1 // factor), np.ascontiguousarray(block, dtype=np.float32).reshape(n, -1)
+
+
+def main():
+    from .ubo2003 import Ubo2003
+
+    parser = argparse.ArgumentParser(description="Fit per-texel diffuse + GGX parameters to a UBO2003 / ATRIUM BTF.")
+    parser.add_argument("filename", help="BTF zip file")
+    parser.add_argument("--output", required=True, help="Output file (.npz)")
+    parser.add_argument("--gamma", type=float, default=2.2, help="gamma of the measuredbtf plugin")
+    parser.add_argument("--factor", type=int, default=1, help="Texels per fitted texel along each axis")
+    parser.add_argument("--cache-dir", help="Cache directory of the decoded images, see Ubo2003")
+    parser.add_argument("--variant", default="llvm_ad_rgb")
+    args = parser.parse_args()
+
+    mi.set_variant(args.variant)
+    ubo = Ubo2003(args.filename, cache_dir=args.cache_dir)
+    images = ubo.images
+    start = time.perf_counter()
+    fit = FittedBrdf.fit(images, ubo.angle_array, gamma=args.gamma, factor=args.factor)
+    seconds = time.perf_counter() - start
+    fit.save(args.output)
+
+    mean = float(np.sqrt(np.mean(fit.error**2)))
+    print(f"original: {images.nbytes / 2**20:.1f} MiB, fitted: {fit.nbytes / 2**20:.2f} MiB ({images.nbytes / fit.nbytes:.0f}x), fitted in {seconds:.1f} s")
+    print(f"RMS error (linear): {mean:.4f}, median alpha: {np.median(fit.alpha):.3f}")
+
+
+if __name__ == "__main__":
+    main()
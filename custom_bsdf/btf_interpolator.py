@@ -1,14 +1,22 @@
+import hashlib
+import threading
+from pathlib import Path
+from typing import Callable, Optional, TypeVar
 import numpy as np
 import numpy.typing as npt
 from scipy.spatial import KDTree
 
+from . import profiling
+from .angular_grid import BarycentricLookup, RingGridLookup, sph_to_dir
+from .btf_mipmap import mip_lod
+from .neighbor_table import NeighborTable, idw_weights
 
-def sph_to_dir(theta, phi):
-    st = np.sin(theta)
-    x = st * np.cos(phi)
-    y = st * np.sin(phi)
-    z = np.cos(theta)
-    return np.stack([x, y, z], axis=-1)
+T = TypeVar("T")
+
+# Search structures, neighbor tables and tiled copies shared by all interpolators in the process,
+# so that instances with different settings (k, p, ...) over the same data do not rebuild them
+_shared: dict[tuple, object] = {}
+_shared_lock = threading.Lock()
 
 
 class BtfInterpolator:
@@ -18,6 +26,8 @@ class BtfInterpolator:
     ------
     images : ndarray (N, H, W, C)
         BTF sample images (must all be same resolution & dtype).
+        Instead of an array, any image source with a `shape` (N, H, W, C) attribute and a
+        `gather(index, y, x)` method returning `images[index, y, x]` can be given (e.g. `CompressedBtf`).
     angles : ndarray (N, 4)
         (tl, pl, tv, pv) in degrees for each image.
           tl, pl : light polar / azimuth (theta_l, phi_l)
@@ -26,13 +36,74 @@ class BtfInterpolator:
         Number of nearest angular samples used for interpolation.
     p : float
         Inverse distance weighting power. p=2 typical. k=1 disables weighting.
+    mode : str
+        Nearest neighbor search method.
+          "kdtree" : KD-tree over the 6D points, works for any angle set.
+          "grid"   : Direct ring / azimuth index computation, requires the angles to be the product
+                     of light and view directions on uniformly spaced rings (UBO2003 / ATRIUM).
+          "auto"   : "grid" if the angles have this layout, otherwise "kdtree".
+        Both methods return the same neighbors (up to ties).
+    interpolation : str
+        Angular interpolation method.
+          "idw"         : Inverse distance weighting of the k nearest samples (k, p, mode).
+          "barycentric" : Barycentric weights of the Delaunay triangles of the light and view hemispheres
+                          (3 x 3 = 9 samples, continuous, see `BarycentricLookup`). Requires the
+                          UBO2003 / ATRIUM layout, k, p and the neighbor table are not used.
+    table_resolution : int, optional
+        If given, the neighbors and weights are precomputed for `table_resolution` x `table_resolution`
+        direction cells per hemisphere (see `NeighborTable`), and looked up instead of searched.
+        The directions are then quantized to the cell centers.
+    table_file : str or Path, optional
+        File to load the precomputed table from, or to save it to if it does not exist yet.
+    tile : int, optional
+        If given, the images are copied into a texel-major layout (H/t, W/t, N, t, t, C), so that all
+        angular samples of a t x t texel neighborhood are contiguous in memory. Lookups of nearby
+        texels (coherent camera rays) then hit the cache instead of reading from N separate images.
+        The copy is kept in addition to `images`. H and W are padded to multiples of t.
+    lut : ndarray (256,), optional
+        Table applied to the uint8 texels before blending (e.g. `linear_lut` for scale and inverse gamma),
+        so that the interpolated values are in the units of the table instead of the images.
+    mip_levels : list of ndarray, optional
+        Spatial mip levels 1, 2, ... of the images (see `mip_pyramid`). If given, calls with a
+        `footprint` look up the level matching the footprint instead of the full resolution.
+    trilinear : bool
+        Blend the two nearest mip levels instead of picking the nearest one.
+    coherence : str
+        Order of the texel lookups of a call.
+          "none"  : Query order (ray order).
+          "sort"  : The queries are sorted by primary angular sample and texel tile (in the memory
+                    order of the layout), gathered and blended in that order, and scattered back.
+          "dedup" : Each distinct texel (angular sample, y, x) is read once, in address order.
+        Both return the same values as "none". They pay off when a texel read costs more than the
+        sort, e.g. from a memory-mapped cache that is not resident.
+
+    Everything that only depends on the data is shared between instances (see `shared`): the
+    search structures and the triangulation per angle set, the neighbor table per angle set,
+    resolution and k, and the tiled copy per image array. Constructing another interpolator
+    with different settings over the same data is therefore cheap.
     """
 
-    def __init__(self, images: npt.ArrayLike, angles: npt.ArrayLike, k: int = 4, p: float = 4.0):
+    def __init__(
+        self,
+        images: npt.ArrayLike,
+        angles: npt.ArrayLike,
+        k: int = 4,
+        p: float = 4.0,
+        mode: str = "auto",
+        interpolation: str = "idw",
+        table_resolution: Optional[int] = None,
+        table_file: str | Path | None = None,
+        tile: Optional[int] = None,
+        lut: Optional[np.ndarray] = None,
+        mip_levels: Optional[list[np.ndarray]] = None,
+        trilinear: bool = False,
+        coherence: str = "none",
+    ):
         # images and angles validation
-        images = np.asarray(images)
+        if not is_image_source(images):
+            images = np.asanyarray(images)  # keeps memory-mapped arrays, whose id keys the shared copies
         angles = np.asarray(angles)
-        if images.ndim != 4:
+        if len(images.shape) != 4:
             raise ValueError("images must have shape (N,H,W,C).")
         if angles.ndim != 2 or angles.shape[1] != 4:
             raise ValueError("angles must have shape (N,4).")
@@ -42,27 +113,95 @@ class BtfInterpolator:
         self.angles = angles.astype(np.float32)
         self._N, self._H, self._W, self._C = images.shape
 
-        # Precompute 6D points (xl, yl, zl, xv, yv, zv)
-        self._points6 = np.empty((self._N, 6), dtype=np.float32)
-        for i, (tl, pl, tv, pv) in enumerate(self.angles):
-            wl = sph_to_dir(np.radians(tl), np.radians(pl))
-            wv = sph_to_dir(np.radians(tv), np.radians(pv))
-            self._points6[i] = np.concatenate([wl, wv], axis=-1)
-
-        self._tree = KDTree(self._points6)
+        if mode not in ("auto", "grid", "kdtree"):
+            raise ValueError(f"Unknown mode '{mode}'. Use 'auto', 'grid' or 'kdtree'.")
+        self._angles_key = hashlib.sha1(self.angles.tobytes()).hexdigest()
+        self._points6, self._grid, self._tree = shared(("search", self._angles_key, mode), lambda: _search_structures(self.angles, mode))
+        if mode == "grid" and self._grid is None:
+            raise ValueError("mode='grid' requires angles on hemispherical rings (UBO2003 / ATRIUM layout).")
+        self.mode = "grid" if self._grid is not None else "kdtree"
 
         self.k = max(1, int(k))
         self.p = float(p)
 
-    def __call__(self, wi, wr, uv):
-        # wi (..., 3) light directions
-        # wr (..., 3) view directions
-        # uv (..., 2) texture coordinates
+        if interpolation not in ("idw", "barycentric"):
+            raise ValueError(f"Unknown interpolation '{interpolation}'. Use 'idw' or 'barycentric'.")
+        self.interpolation = interpolation
+        self._barycentric: Optional[BarycentricLookup] = None
+        if interpolation == "barycentric":
+            self._barycentric = shared(("barycentric", self._angles_key), lambda: BarycentricLookup.from_angles(self.angles))
+            if self._barycentric is None:
+                raise ValueError("interpolation='barycentric' requires angles on hemispherical rings (UBO2003 / ATRIUM layout).")
+            if table_resolution is not None:
+                raise ValueError("The neighbor table is not used with interpolation='barycentric'.")
+
+        self.table: Optional[NeighborTable] = None
+        if table_resolution is not None:
+            self.table = self._load_table(table_resolution, table_file)
+
+        self.lut = None
+        if lut is not None:
+            self.lut = np.asarray(lut, dtype=np.float32)
+            if self.lut.shape != (256,):
+                raise ValueError("lut must have shape (256,).")
+            dtype = images.dtype if not is_image_source(images) else getattr(images, "dtype", None)
+            if dtype != np.uint8:
+                raise ValueError("lut requires uint8 images.")
+
+        self.mip_levels = mip_levels
+        self.trilinear = trilinear
+        if mip_levels is not None:
+            if is_image_source(images):
+                raise ValueError("Mip levels require the images as an array.")
+            if any(level.shape[0] != self._N or level.shape[-1] != self._C for level in mip_levels):
+                raise ValueError("mip_levels must have shapes (N,H_l,W_l,C).")
+
+        if coherence not in ("none", "sort", "dedup"):
+            raise ValueError(f"Unknown coherence '{coherence}'. Use 'none', 'sort' or 'dedup'.")
+        self.coherence = coherence
+
+        self.tile = tile
+        self._tiled: Optional[np.ndarray] = None
+        if tile is not None:
+            if is_image_source(images):
+                raise ValueError("The tiled layout requires the images as an array.")
+            # The entry keeps a reference to the images, so their id cannot be reused while it exists
+            _, self._tiled, self._tile_offset = shared(("tiled", id(images), tile), lambda: (images, *_tiled_layout(images, tile)))
+
+    def _load_table(self, resolution: int, file: str | Path | None) -> NeighborTable:
+        key = ("table", self._angles_key, self.mode, resolution, self.k)
+        return shared(key, lambda: self._build_table(resolution, file))
+
+    def _build_table(self, resolution: int, file: str | Path | None) -> NeighborTable:
+        if file is not None and Path(file).exists():
+            table = NeighborTable.load(file)
+            if table.resolution == resolution and table.k == self.k and table.index.max() < self._N:
+                return table
+        table = NeighborTable.build(self.query, resolution)
+        if file is not None:
+            table.save(file)
+        return table
+
+    def neighbors(self, wi, wr):
+        """Return the indices and normalized weights (..., k) of the angular samples to blend for each (wi, wr) pair."""
+        if self._barycentric is not None:
+            return self._barycentric.neighbors(np.asarray(wi, dtype=np.float32), np.asarray(wr, dtype=np.float32))
+
+        if self.table is not None:
+            cell = self.table.flat_cells(wi, wr)
+            return self.table.index.reshape(-1, self.k)[cell], self.table.weights(self.p).reshape(-1, self.k)[cell]
+
+        distance, index = self.query(wi, wr)
+        return index, idw_weights(distance, self.p)
+
+    def query(self, wi, wr):
+        """Return the distances and indices (..., k) of the k nearest angular samples for each (wi, wr) pair."""
         wi = np.asarray(wi, dtype=np.float32)
         wr = np.asarray(wr, dtype=np.float32)
-        uv = np.asarray(uv, dtype=np.float32)
 
-        # k-NN search for each (wi, wr) pair
+        if self._grid is not None:
+            return self._grid.query(wi, wr, self.k)
+
         point = np.concatenate([wi, wr], axis=-1)
         distance, index = self._tree.query(point, k=self.k, p=2, workers=-1)
         distance = distance.astype(np.float32)
@@ -71,17 +210,182 @@ class BtfInterpolator:
             distance = distance[..., np.newaxis]
             index = index[..., np.newaxis]
 
+        return distance, index
+
+    @profiling.profiled("BtfInterpolator.__call__", lambda self, wi, wr, uv, footprint=None: np.size(uv) // 2)
+    def __call__(self, wi, wr, uv, footprint=None):
+        # wi (..., 3) light directions
+        # wr (..., 3) view directions
+        # uv (..., 2) texture coordinates
+        # footprint (...,) optional, width of the pixel footprint in uv units for mip mapping
+        uv = np.asarray(uv, dtype=np.float32)
+        n = uv[..., 0].size
+
+        # k-NN search for each (wi, wr) pair
+        with profiling.stage("BtfInterpolator.search", n):
+            index, weights = self.neighbors(wi, wr)
+
         # uv to xy
         u, v = uv[..., 0], uv[..., 1]
         x = np.clip(np.mod(u * (self._W - 1), (self._W)).astype(np.uint32), 0, self._W - 1)[..., np.newaxis]
         y = np.clip(np.mod(v * (self._H - 1), (self._H)).astype(np.uint32), 0, self._H - 1)[..., np.newaxis]
 
+        # Gather and blend in a cache-friendly order, the results are scattered back below
+        order = None
+        if self.coherence == "sort":
+            with profiling.stage("BtfInterpolator.sort", n):
+                index, weights, x, y = (a.reshape(n, -1) for a in (index, weights, x, y))
+                u, v = u.reshape(-1), v.reshape(-1)
+                order = self._coherent_order(index[:, 0], y[:, 0], x[:, 0])
+                index, weights, x, y, u, v = (a[order] for a in (index, weights, x, y, u, v))
+                if footprint is not None:
+                    footprint = np.broadcast_to(footprint, uv.shape[:-1]).reshape(-1)[order]
+
         # Gather pixel values
-        values = self.images[index, y, x].astype(np.float32)
+        with profiling.stage("BtfInterpolator.gather", n):
+            if footprint is not None and self.mip_levels:
+                values = self._gather_mip(index, u, v, footprint)
+            elif self.coherence == "dedup":
+                values = self._apply_lut(self._gather_unique(index, y, x))
+            else:
+                values = self._apply_lut(self.gather(index, y, x))
 
         # Weighted average with inverse distance weights
-        weights = 1 / (distance + 1e-16) ** self.p
-        weights = weights[..., np.newaxis]
-        pixel = np.sum(values * weights, axis=-2) / np.sum(weights, axis=-2)
+        with profiling.stage("BtfInterpolator.blend", n):
+            pixel = np.sum(values * weights[..., np.newaxis], axis=-2)
+
+        if order is not None:
+            with profiling.stage("BtfInterpolator.sort", n):
+                out = np.empty_like(pixel)
+                out[order] = pixel
+                pixel = out.reshape(uv.shape[:-1] + pixel.shape[-1:])
 
         return pixel
+
+    def _coherent_order(self, primary, y, x):
+        """Permutation (n,) grouping the queries by primary angular sample and texel tile, in the memory order of the layout."""
+        t = self.tile or 16
+        tiles_x = -(-self._W // t)
+        tiles_y = -(-self._H // t)
+        tile = (y // t).astype(np.int64) * tiles_x + x // t
+        if self._tiled is not None:
+            key = tile * self._N + primary  # (H/t, W/t, N, t, t, C): the tile is outermost
+        else:
+            key = primary.astype(np.int64) * (tiles_y * tiles_x) + tile
+        return np.argsort(key, kind="stable")
+
+    def _gather_unique(self, index, y, x):
+        """`gather` reading every distinct texel once, in the order of its (index, y, x) address."""
+        key = (np.asarray(index, dtype=np.int64) * self._H + y) * self._W + x
+        unique, inverse = np.unique(key, return_inverse=True)
+        texels = self.gather(unique // (self._H * self._W), (unique // self._W) % self._H, unique % self._W)
+        return texels[inverse.reshape(key.shape)]
+
+    def _apply_lut(self, values):
+        return np.take(self.lut, values) if self.lut is not None else values
+
+    def _gather_mip(self, index, u, v, footprint):
+        """Texel values (..., k, C) at the mip level(s) of the footprint."""
+        lod = np.minimum(mip_lod(footprint, max(self._W, self._H)), len(self.mip_levels))
+        lod = np.broadcast_to(lod, u.shape)
+        if not self.trilinear:
+            return self._gather_level(index, u, v, np.round(lod).astype(np.int64))
+        level = np.floor(lod).astype(np.int64)
+        t = (lod - level).astype(np.float32)[..., np.newaxis, np.newaxis]
+        fine = self._gather_level(index, u, v, level).astype(np.float32)
+        coarse = self._gather_level(index, u, v, np.minimum(level + 1, len(self.mip_levels)))
+        return fine + t * (coarse - fine)
+
+    def _gather_level(self, index, u, v, level):
+        """Texel values (..., k, C) of `index` (..., k) at the texture coordinates (u, v) and mip level (...,)."""
+        out = None
+        # Same texel position convention as level 0, scaled to the resolution of each level
+        xf = np.mod(u * (self._W - 1), self._W)
+        yf = np.mod(v * (self._H - 1), self._H)
+        for l in np.unique(level):
+            mask = level == l
+            images = self.images if l == 0 else self.mip_levels[l - 1]
+            h, w = images.shape[1:3]
+            x = np.clip((xf[mask] * (w / self._W)).astype(np.int64), 0, w - 1)[..., np.newaxis]
+            y = np.clip((yf[mask] * (h / self._H)).astype(np.int64), 0, h - 1)[..., np.newaxis]
+            if l == 0:
+                values = self.gather(index[mask], y, x)
+            else:
+                values = np.take(images.reshape(-1, self._C), (index[mask] * h + y) * w + x, axis=0)
+            values = self._apply_lut(values)
+            if out is None:
+                out = np.empty(index.shape + (self._C,), dtype=values.dtype)
+            out[mask] = values
+        return out
+
+    def gather(self, index, y, x):
+        """Return the texels `images[index, y, x]` (broadcast shape + (C,)) from the active memory layout."""
+        index = np.asarray(index, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)
+        x = np.asarray(x, dtype=np.int64)
+        if is_image_source(self.images):
+            return self.images.gather(index, y, x)
+        if self._tiled is not None:
+            flat = self._tile_offset[y, x] + index * (self.tile * self.tile)
+            return np.take(self._tiled.reshape(-1, self._C), flat, axis=0)
+        flat = (index * self._H + y) * self._W + x
+        return np.take(self.images.reshape(-1, self._C), flat, axis=0)
+
+
+def shared(key: tuple, build: Callable[[], T]) -> T:
+    """Return the object shared under `key` in this process, calling `build()` to create it on first use."""
+    with _shared_lock:
+        if key in _shared:
+            return _shared[key]
+    value = build()  # outside of the lock, concurrent builds of the same key keep the first result
+    with _shared_lock:
+        return _shared.setdefault(key, value)
+
+
+def clear_shared() -> None:
+    """Drop the shared search structures, tables and tiled copies (instances keep their references)."""
+    with _shared_lock:
+        _shared.clear()
+
+
+def _search_structures(angles: np.ndarray, mode: str) -> tuple[np.ndarray, Optional[RingGridLookup], Optional[KDTree]]:
+    """6D points (xl, yl, zl, xv, yv, zv), ring grid and KD-tree for the angles (N, 4) and search mode."""
+    points6 = np.empty((len(angles), 6), dtype=np.float32)
+    for i, (tl, pl, tv, pv) in enumerate(angles):
+        wl = sph_to_dir(np.radians(tl), np.radians(pl))
+        wv = sph_to_dir(np.radians(tv), np.radians(pv))
+        points6[i] = np.concatenate([wl, wv], axis=-1)
+    grid = None if mode == "kdtree" else RingGridLookup.from_angles(angles)
+    tree = KDTree(points6) if grid is None else None
+    return points6, grid, tree
+
+
+def _tiled_layout(images: np.ndarray, tile: int) -> tuple[np.ndarray, np.ndarray]:
+    """Tiled copy of the images (see `to_tiled`) and the offset (H, W) of texel (y, x) of image 0 in it."""
+    tiled = to_tiled(images, tile)
+    n, h, w = images.shape[:3]
+    # Image i is at + i * t * t
+    y, x = np.meshgrid(np.arange(h), np.arange(w), indexing="ij")
+    offset = ((y // tile) * tiled.shape[1] + x // tile) * (n * tile * tile) + (y % tile) * tile + x % tile
+    return tiled, offset
+
+
+def is_image_source(images) -> bool:
+    """True for image sources that are not arrays but provide `shape` and `gather(index, y, x)`."""
+    return not isinstance(images, np.ndarray) and hasattr(images, "gather")
+
+
+def to_tiled(images: np.ndarray, tile: int) -> np.ndarray:
+    """Reorganize images (N, H, W, C) into the texel-major layout (H/t, W/t, N, t, t, C).
+
+    H and W are padded to multiples of `tile` by repeating the last row / column.
+    """
+    n, h, w, c = images.shape
+    ph, pw = -h % tile, -w % tile
+    if ph or pw:
+        images = np.pad(images, ((0, 0), (0, ph), (0, pw), (0, 0)), mode="edge")
+    h, w = h + ph, w + pw
+    tiled = np.empty((h // tile, w // tile, n, tile, tile, c), dtype=images.dtype)
+    for i in range(n):  # one image at a time, so that memory-mapped sources are not read in full at once
+        tiled[:, :, i] = images[i].reshape(h // tile, tile, w // tile, tile, c).transpose(0, 2, 1, 3, 4)
+    return tiled
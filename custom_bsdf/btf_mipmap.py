@@ -0,0 +1,68 @@
+from pathlib import Path
+import os
+import numpy as np
+import numpy.typing as npt
+
+
+def downsample(image: np.ndarray) -> np.ndarray:
+    """Halve the resolution of an image (H, W, C) with a 2 x 2 box filter.
+
+    Odd sizes drop the last row / column, sizes of 1 are kept. Integer images are rounded.
+    """
+    h, w = image.shape[:2]
+    h2, w2 = max(1, h // 2), max(1, w // 2)
+    fy, fx = (2 if h > 1 else 1), (2 if w > 1 else 1)
+    block = image[: h2 * fy, : w2 * fx].astype(np.float32).reshape(h2, fy, w2, fx, -1)
+    mean = block.mean(axis=(1, 3))
+    if np.issubdtype(image.dtype, np.integer):
+        mean = np.round(mean)
+    return mean.astype(image.dtype)
+
+
+def mip_pyramid(images: npt.ArrayLike, cache_base: str | Path | None = None) -> list[np.ndarray]:
+    """Spatial mip levels 1, 2, ... (N, H/2^l, W/2^l, C) of the images (N, H, W, C), down to 1 x 1.
+
+    Level 0 is the images themselves and is not included. The levels take 1/3 of the memory of the
+    images in total. The images are filtered in their stored encoding (e.g. gamma-encoded 8 bit).
+    If `cache_base` is given, level l is cached in the memory-mapped file `{cache_base}.mip{l}.npy`.
+
+    Examples
+    --------
+    >>> levels = mip_pyramid(np.zeros((4, 256, 256, 3), dtype=np.uint8))
+    >>> [level.shape[1] for level in levels]
+    [128, 64, 32, 16, 8, 4, 2, 1]
+    """
+    n, h, w, c = images.shape
+    shapes = []
+    while h > 1 or w > 1:
+        h, w = max(1, h // 2), max(1, w // 2)
+        shapes.append((n, h, w, c))
+
+    files = [Path(f"{cache_base}.mip{l + 1}.npy") for l in range(len(shapes))] if cache_base is not None else None
+    if files is not None and all(f.exists() for f in files):
+        levels = [np.load(f, mmap_mode="r") for f in files]
+        if [level.shape for level in levels] == shapes:
+            return levels
+
+    levels = [np.empty(shape, dtype=images.dtype) for shape in shapes]
+    for i in range(n):  # one image at a time, so that memory-mapped sources are not read in full at once
+        image = images[i]
+        for level in levels:
+            image = level[i] = downsample(image)
+
+    if files is None:
+        return levels
+    for f, level in zip(files, levels):
+        f.parent.mkdir(parents=True, exist_ok=True)
+        file_tmp = f.with_suffix(f".npy.{os.getpid()}.tmp")
+        with open(file_tmp, "wb") as fp:
+            np.save(fp, level)
+        os.replace(file_tmp, f)  # atomic, concurrent jobs never see a partial file
+    return [np.load(f, mmap_mode="r") for f in files]
+
+
+def mip_lod(footprint: npt.ArrayLike, size: int) -> np.ndarray:
+    """Continuous level of detail log2(footprint * size) (>= 0) for a footprint in uv units on a texture of `size` texels."""
+    footprint = np.asarray(footprint, dtype=np.float32)
+    with np.errstate(divide="ignore"):
+        return np.maximum(np.log2(footprint * size), 0.0)
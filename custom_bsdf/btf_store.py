@@ -0,0 +1,343 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Callable, NamedTuple, TypeVar
+import numpy as np
+
+from .btf_chunked import ChunkedBtf
+from .btf_compression import CompressedBtf
+from .btf_mipmap import mip_pyramid
+from .linearize import linearize
+from .ubo2003 import Ubo2003, cache_base, cache_key
+
+
+class BtfData(NamedTuple):
+    """Decoded BTF dataset shared between BSDF instances.
+
+    images : ndarray (N, H, W, C) or image source
+        BTF sample images. Read-only, must not be modified by the users.
+        For compressed BTFs, a `CompressedBtf` that reconstructs the texels on lookup, for chunked BTFs
+        a `ChunkedBtf` that decompresses the touched chunks.
+    angles : ndarray (N, 4)
+        (tl, pl, tv, pv) in degrees for each image.
+    """
+
+    images: np.ndarray
+    angles: np.ndarray
+
+
+T = TypeVar("T")
+
+# Process-wide registry of loaded datasets, keyed by (absolute filename, load options). The futures
+# are resolved by the thread that loads the dataset, so different datasets load concurrently.
+_registry: dict[tuple, Future] = {}
+_registry_lock = threading.Lock()
+_loader = ThreadPoolExecutor(thread_name_prefix="btf-load")  # see `load_in_background`
+_pyramids: dict[tuple, list[np.ndarray]] = {}
+
+# Shared memory blocks that are alive in this process, and the ones created (and owned) by it
+_shm_blocks: dict[str, SharedMemory] = {}
+_shm_owned: set[str] = set()
+
+# Layout of a shared memory block: [state (8 bytes)][header size (8 bytes)][json header][padding][images]
+# The json header holds the pid of the creating process, so that waiting processes notice if it dies.
+_SHM_ALIGN = 64
+_SHM_LOADING, _SHM_READY, _SHM_FAILED = 0, 1, 2
+
+# Seconds a process waits for another process to fill a shared memory block before loading its own copy
+SHM_WAIT_SECONDS = 1800.0
+
+
+def load_btf(filename: str | Path, cache_dir: str | Path | None = None, shared_memory: bool = False, max_cache_bytes: int | None = None) -> BtfData:
+    """Load a BTF dataset once per process and return the shared images and angles.
+
+    Every call with the same filename and options returns the same arrays, so many
+    `measuredbtf` instances pointing at one file hold a single copy of the data.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the BTF zip file (UBO2003 / ATRIUM format), to a compressed BTF (.npz, see `CompressedBtf`),
+        or to a chunked BTF (.btfc, see `ChunkedBtf`).
+    cache_dir : str or Path, optional
+        Directory for the decoded image cache, see `Ubo2003`.
+    shared_memory : bool
+        If True, the images are placed in a `multiprocessing.shared_memory` block named after
+        the dataset. Other processes on the same node attach to the existing block instead of
+        decoding their own copy. The block is unlinked when the process that created it exits.
+    max_cache_bytes : int, optional
+        If given, the images are not preloaded. `images` is then the `Ubo2003` object itself, which
+        decodes the images on demand and keeps up to `max_cache_bytes` of them in an LRU cache.
+        For a chunked BTF, the memory of its decompressed chunk cache (default: 512 MiB).
+
+    Examples
+    --------
+    >>> data = load_btf("UBO2003/UBO_IMPALLA256.zip")
+    >>> data.images.shape
+    (6561, 256, 256, 3)
+    >>> load_btf("UBO2003/UBO_IMPALLA256.zip").images is data.images
+    True
+    """
+    if shared_memory and max_cache_bytes is not None:
+        raise ValueError("shared_memory and max_cache_bytes (lazy loading) cannot be combined.")
+    key = (str(Path(filename).resolve()), None if cache_dir is None else str(Path(cache_dir).resolve()), bool(shared_memory), max_cache_bytes)
+
+    def load() -> BtfData:
+        if Path(filename).suffix == ".npz":  # small enough to be loaded per process
+            btf = CompressedBtf.load(filename)
+            return BtfData(btf, btf.angles)
+        elif Path(filename).suffix == ".btfc":  # chunks are decompressed on lookup
+            btf = ChunkedBtf(filename) if max_cache_bytes is None else ChunkedBtf(filename, max_cache_bytes=max_cache_bytes)
+            return BtfData(btf, btf.angles)
+        elif max_cache_bytes is not None:
+            ubo = Ubo2003(filename, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes)
+            return BtfData(ubo, ubo.angle_array)
+        elif shared_memory:
+            return _load_shared(filename, cache_dir)
+        else:
+            ubo = Ubo2003(filename, cache_dir=cache_dir)
+            return BtfData(ubo.images, ubo.angle_array)
+
+    return _load_once(key, load)
+
+
+def load_linearized(filename: str | Path, scale: float = 1.0, gamma: float = 2.2, cache_dir: str | Path | None = None, shared_memory: bool = False) -> BtfData:
+    """Load a BTF dataset like `load_btf`, converted once to float16 linear reflectance (v * scale / 255)^gamma.
+
+    The converted images are shared per process like the ones of `load_btf`. With `cache_dir`,
+    they are also cached on disk as a memory-mapped `.npy` file. See `linearize`.
+    """
+    key = ("linear", str(Path(filename).resolve()), None if cache_dir is None else str(Path(cache_dir).resolve()), bool(shared_memory), float(scale), float(gamma))
+
+    def load() -> BtfData:
+        data = load_btf(filename, cache_dir=cache_dir, shared_memory=shared_memory)
+        if not isinstance(data.images, np.ndarray):
+            raise ValueError("Linearized storage requires the images as an array (not a compressed BTF).")
+        if cache_dir is not None:
+            file_npy = Path(f"{cache_base(filename, cache_dir)}.linear-s{scale:g}-g{gamma:g}.npy")
+            if not file_npy.exists():
+                file_tmp = file_npy.with_suffix(f".npy.{os.getpid()}.{threading.get_ident()}.tmp")
+                out = np.lib.format.open_memmap(file_tmp, mode="w+", dtype=np.float16, shape=data.images.shape)
+                linearize(data.images, scale, gamma, out=out)
+                out.flush()
+                del out
+                os.replace(file_tmp, file_npy)
+            images = np.load(file_npy, mmap_mode="r")
+        else:
+            images = linearize(data.images, scale, gamma)
+            images.flags.writeable = False
+        return BtfData(images, data.angles)
+
+    return _load_once(key, load)
+
+
+def _load_once(key: tuple, load: Callable[[], T]) -> T:
+    """Return the dataset registered under `key`, calling `load()` in this thread if no other thread is loading it.
+
+    The registry lock is only held to look up the key, so datasets with different keys load
+    concurrently, and callers of a key that is being loaded wait for it. A failed load is removed
+    from the registry, so that the next call tries again.
+    """
+    with _registry_lock:
+        future = _registry.get(key)
+        owner = future is None
+        if owner:
+            future = _registry[key] = Future()
+    if owner:
+        try:
+            future.set_result(load())
+        except BaseException as error:
+            with _registry_lock:
+                if _registry.get(key) is future:
+                    del _registry[key]
+            future.set_exception(error)
+    return future.result()
+
+
+def load_in_background(function: Callable[[], T]) -> Future:
+    """Run `function` (e.g. the loading of a BSDF) in a loader thread, returning its future.
+
+    Loads started this way run concurrently. Reading and decoding the images release the GIL, so
+    they overlap with each other and with the rest of the scene construction.
+    """
+    return _loader.submit(function)
+
+
+def load_mip_pyramid(filename: str | Path, images: np.ndarray, cache_dir: str | Path | None = None, tag: str = "") -> list[np.ndarray]:
+    """Spatial mip levels of `images` loaded from `filename` (see `mip_pyramid`), built once per process.
+
+    `tag` identifies the variant of the images (e.g. "linear-s1-g2.2"). With `cache_dir`, the levels
+    are also cached on disk as memory-mapped `.npy` files.
+    """
+    if not isinstance(images, np.ndarray):
+        raise ValueError("Mip levels require the images as an array (not a compressed or lazily loaded BTF).")
+    key = (str(Path(filename).resolve()), None if cache_dir is None else str(Path(cache_dir).resolve()), tag)
+    with _registry_lock:
+        if key in _pyramids:
+            return _pyramids[key]
+    base = None
+    if cache_dir is not None:
+        base = f"{cache_base(filename, cache_dir)}{'.' + tag if tag else ''}"
+    levels = mip_pyramid(images, cache_base=base)
+    for level in levels:
+        level.flags.writeable = False
+    with _registry_lock:
+        return _pyramids.setdefault(key, levels)
+
+
+def shm_name(filename: str | Path) -> str:
+    """Name of the shared memory block holding the dataset `filename`."""
+    return f"btf-{cache_key(filename)}"
+
+
+def _attach(name: str) -> SharedMemory:
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False)
+    shm = SharedMemory(name)
+    _untrack(shm)
+    return shm
+
+
+def _untrack(shm: SharedMemory) -> None:
+    # Before Python 3.13, every process that merely attaches to a block registers it with the resource
+    # tracker, which unlinks it when that process exits (or double-unregisters it when the tracker is
+    # inherited by spawned workers). The lifetime is managed by this module instead.
+    if sys.version_info < (3, 13):
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+
+
+def _unlink(shm: SharedMemory) -> None:
+    if sys.version_info < (3, 13):
+        resource_tracker.register(shm._name, "shared_memory")  # type: ignore[attr-defined]  # unlink() unregisters it
+    shm.unlink()
+
+
+def _load_shared(filename: str | Path, cache_dir: str | Path | None) -> BtfData:
+    name = shm_name(filename)
+    try:
+        shm = _attach(name)
+    except FileNotFoundError:
+        shm = None
+
+    if shm is None:
+        ubo = Ubo2003(filename, cache_dir=cache_dir)
+        header = json.dumps({"shape": ubo.shape, "dtype": ubo.dtype.str, "angles": ubo.angles, "pid": os.getpid()}).encode()
+        offset = -(-(16 + len(header)) // _SHM_ALIGN) * _SHM_ALIGN
+        nbytes = int(np.prod(ubo.shape)) * ubo.dtype.itemsize
+        try:
+            shm = SharedMemory(name, create=True, size=offset + nbytes)
+        except FileExistsError:  # Another process was faster, use its block
+            return _load_shared(filename, cache_dir)
+        _untrack(shm)
+        _shm_owned.add(name)
+        _shm_blocks[name] = shm
+        shm.buf[16 : 16 + len(header)] = header
+        shm.buf[8:16] = np.uint64(len(header)).tobytes()  # after the header, so that a nonzero size means a complete header
+        images = np.ndarray(ubo.shape, dtype=ubo.dtype, buffer=shm.buf, offset=offset)
+        try:
+            ubo.preload(out=images)
+        except BaseException:
+            # Do not leave a block behind that other processes would wait on forever
+            shm.buf[0:8] = np.uint64(_SHM_FAILED).tobytes()
+            del images
+            shm.close()
+            _unlink(shm)
+            _shm_owned.discard(name)
+            del _shm_blocks[name]
+            raise
+        shm.buf[0:8] = np.uint64(_SHM_READY).tobytes()
+        images.flags.writeable = False
+        return BtfData(images, ubo.angle_array)
+
+    # Wait until the creator has finished decoding
+    deadline = time.monotonic() + SHM_WAIT_SECONDS
+    while (state := int(np.frombuffer(shm.buf, dtype=np.uint64, count=1)[0])) != _SHM_READY:
+        if state == _SHM_FAILED:
+            shm.close()
+            raise RuntimeError(f"The process loading {filename} into shared memory failed, see its error.")
+        alive = _creator_alive(shm)
+        if not alive or time.monotonic() > deadline:
+            if not alive:  # left behind by a killed process, the next load creates a new block
+                try:
+                    _unlink(shm)
+                except FileNotFoundError:  # already unlinked by another waiting process
+                    _untrack(shm)
+            shm.close()
+            reason = "exited without filling it" if not alive else f"did not fill it within {SHM_WAIT_SECONDS:g} s"
+            warnings.warn(f"The process loading {filename} into shared memory {reason}, loading a private copy.")
+            ubo = Ubo2003(filename, cache_dir=cache_dir)
+            return BtfData(ubo.images, ubo.angle_array)
+        time.sleep(0.05)
+    _shm_blocks[name] = shm
+    size = int(np.frombuffer(shm.buf, dtype=np.uint64, count=1, offset=8)[0])
+    header = json.loads(bytes(shm.buf[16 : 16 + size]))
+    offset = -(-(16 + size) // _SHM_ALIGN) * _SHM_ALIGN
+    images = np.ndarray(tuple(header["shape"]), dtype=np.dtype(header["dtype"]), buffer=shm.buf, offset=offset)
+    images.flags.writeable = False
+    return BtfData(images, np.asarray(header["angles"]))
+
+
+def _creator_alive(shm: SharedMemory) -> bool:
+    """False if the process that created the block is known to have exited."""
+    size = int(np.frombuffer(shm.buf, dtype=np.uint64, count=1, offset=8)[0])
+    if size == 0 or os.name != "posix":  # header not written yet, or no signal 0: rely on the timeout
+        return True
+    pid = json.loads(bytes(shm.buf[16 : 16 + size])).get("pid")
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, owned by another user
+        pass
+    return True
+
+
+def clear() -> None:
+    """Drop all loaded datasets and release the shared memory blocks of this process.
+
+    Arrays previously returned by `load_btf` must not be used afterwards if they are backed by shared memory.
+    """
+    with _registry_lock:
+        _registry.clear()
+        _pyramids.clear()
+        for name in list(_shm_blocks):
+            _close(name)
+
+
+def release(filename: str | Path) -> None:
+    """Drop the datasets loaded from `filename` (with any options) like `clear`, and keep the others.
+
+    The memory is freed once no BSDF instance references the data anymore.
+    """
+    path = str(Path(filename).resolve())
+    with _registry_lock:
+        for key in [key for key in _registry if path in key[:2]]:  # (path, ...) or ("linear", path, ...)
+            del _registry[key]
+        for key in [key for key in _pyramids if key[0] == path]:
+            del _pyramids[key]
+        if shm_name(filename) in _shm_blocks:
+            _close(shm_name(filename))
+
+
+def _close(name: str) -> None:
+    shm = _shm_blocks.pop(name)
+    try:
+        shm.close()
+    except BufferError:  # Still referenced by a living array, leave the mapping to the OS
+        pass
+    if name in _shm_owned:
+        _unlink(shm)
+        _shm_owned.discard(name)
+
+
+atexit.register(clear)
@@ -0,0 +1,251 @@
+import numpy as np
+import numpy.typing as npt
+import mitsuba as mi
+import drjit as dr
+
+from .angular_grid import HemisphereRings, RingGridLookup
+from .btf_interpolator import is_image_source, shared
+from .neighbor_table import NeighborTable
+
+
+class DrJitBtf:
+    """Dr.Jit implementation of the `BtfInterpolator` lookup.
+
+    The k-NN search over the (light, view) ring layout, the inverse distance weighting and the
+    texel gather are expressed with Dr.Jit operations (`dr.gather`, `dr.select`) only. In contrast
+    to `BtfInterpolator`, nothing is converted to NumPy, so `eval` can be traced symbolically and
+    recorded into the megakernel together with the rest of the integrator.
+
+    The neighbors and weights are the same as `BtfInterpolator` with mode="grid", so the angles must
+    have the UBO2003 / ATRIUM ring layout (see `RingGridLookup`). Alternatively, a precomputed
+    `NeighborTable` can be given, which works for any angle set and replaces the search by two reads.
+
+    Inputs
+    ------
+    images : ndarray (N, H, W, C)
+        BTF sample images. uint8 images with up to 4 channels are packed into one UInt32 per texel,
+        float16 images (linearized) are stored as Float16 and widened after the gather, other dtypes
+        are stored as Float.
+    angles : ndarray (N, 4)
+        (tl, pl, tv, pv) in degrees for each image.
+    k : int
+        Number of nearest angular samples used for interpolation.
+    p : float
+        Inverse distance weighting power.
+    table : NeighborTable, optional
+        Precomputed neighbors, must have been built for the same k.
+    lut : ndarray (256,), optional
+        Table applied to the uint8 texels before blending, see `BtfInterpolator`.
+    mip_levels : list of ndarray, optional
+        Spatial mip levels 1, 2, ... of the images, used by calls with a footprint (see `mip_pyramid`).
+    trilinear : bool
+        Blend the two nearest mip levels instead of picking the nearest one.
+    """
+
+    def __init__(self, images: npt.ArrayLike, angles: npt.ArrayLike, k: int = 4, p: float = 4.0, table: NeighborTable | None = None, lut: np.ndarray | None = None, mip_levels: list[np.ndarray] | None = None, trilinear: bool = False) -> None:
+        if is_image_source(images):
+            raise ValueError("DrJitBtf requires the images as an array, use the numpy backend for other image sources.")
+        images = np.asanyarray(images)  # keeps memory-mapped arrays, whose id keys the shared copies
+        if images.ndim != 4 or images.shape[-1] != 3:
+            raise ValueError("images must have shape (N,H,W,3).")
+        self._N, self._H, self._W, self._C = images.shape
+
+        self.k = max(1, int(k))
+        self.p = float(p)
+
+        if table is not None:
+            if table.k != self.k:
+                raise ValueError(f"The neighbor table was built for k={table.k}, not k={self.k}.")
+            self._table_resolution = table.resolution
+            self._table_index = mi.UInt32(table.index.reshape(-1).astype(np.uint32))
+            self._table_weights = mi.Float(table.weights(self.p).reshape(-1))
+        else:
+            grid = RingGridLookup.from_angles(angles)
+            if grid is None:
+                raise ValueError("DrJitBtf requires angles on hemispherical rings (UBO2003 / ATRIUM layout) or a neighbor table.")
+            if self.k > len(grid.light.dirs) * len(grid.view.dirs):
+                raise ValueError(f"k={self.k} exceeds the number of samples.")
+            self._table_resolution = None
+            self._light = _rings(grid.light)
+            self._view = _rings(grid.view)
+            self._num_view = grid.pair_index.shape[1]
+            self._pair_index = mi.UInt32(grid.pair_index.reshape(-1).astype(np.uint32))
+
+        # All levels are stored back to back, level l starts at texel offset[l]
+        levels = [images] + list(mip_levels or [])
+        sizes = [level.shape[1:3] for level in levels]
+        offsets = np.cumsum([0] + [self._N * h * w for h, w in sizes])
+        if offsets[-1] >= 2**32:
+            raise ValueError("Too many texels to be addressed with 32 bit indices.")
+        self._num_levels = len(levels)
+        self.trilinear = trilinear
+        self._level_offset = mi.UInt32(offsets[:-1].astype(np.uint32))
+        self._level_h = mi.UInt32(np.array([h for h, _ in sizes], dtype=np.uint32))
+        self._level_w = mi.UInt32(np.array([w for _, w in sizes], dtype=np.uint32))
+
+        self._packed = images.dtype == np.uint8
+        # One upload per image array and mip levels, shared by all instances (the entry keeps them alive)
+        key = ("drjit_texels", tuple(id(level) for level in levels))
+        _, self._texels = shared(key, lambda: (levels, _upload(levels, offsets)))
+
+        self._lut = None
+        if lut is not None:
+            if not self._packed:
+                raise ValueError("lut requires uint8 images.")
+            self._lut = mi.Float(np.asarray(lut, dtype=np.float32).reshape(256))
+
+    def eval(self, wi: mi.Vector3f, wr: mi.Vector3f, uv: mi.Point2f, active: mi.Mask = True, footprint: mi.Float | None = None) -> mi.Color3f:
+        """Interpolated texel value for light direction `wi`, view direction `wr` and texture coordinates `uv`.
+
+        The value is returned in the units (or the units of the lut) and channel order of the images (e.g. BGR in [0, 255]).
+        With mip levels, `footprint` (width of the pixel footprint in uv units) selects the level.
+        """
+        index, weights = self.neighbors(wi, wr, active)
+
+        # uv to xy, same convention as BtfInterpolator
+        xf = _wrap_float(uv.x * (self._W - 1), self._W)
+        yf = _wrap_float(uv.y * (self._H - 1), self._H)
+
+        if footprint is None or self._num_levels == 1:
+            return self._blend(index, weights, xf, yf, mi.UInt32(0), active)
+        lod = dr.clip(dr.log2(footprint * max(self._W, self._H)), 0.0, self._num_levels - 1)
+        if not self.trilinear:
+            return self._blend(index, weights, xf, yf, mi.UInt32(dr.round(lod)), active)
+        level = dr.floor(lod)
+        t = lod - level
+        fine = self._blend(index, weights, xf, yf, mi.UInt32(level), active)
+        coarse = self._blend(index, weights, xf, yf, dr.minimum(mi.UInt32(level) + 1, self._num_levels - 1), active & (t > 0))
+        return dr.lerp(fine, coarse, t)
+
+    def _blend(self, index: list[mi.UInt32], weights: list[mi.Float], xf: mi.Float, yf: mi.Float, level: mi.UInt32, active: mi.Mask) -> mi.Color3f:
+        if self._num_levels == 1:
+            offset, h, w = mi.UInt32(0), mi.UInt32(self._H), mi.UInt32(self._W)
+        else:
+            offset = dr.gather(mi.UInt32, self._level_offset, level, active)
+            h = dr.gather(mi.UInt32, self._level_h, level, active)
+            w = dr.gather(mi.UInt32, self._level_w, level, active)
+        x = dr.minimum(mi.UInt32(xf * (mi.Float(w) / self._W)), w - 1)
+        y = dr.minimum(mi.UInt32(yf * (mi.Float(h) / self._H)), h - 1)
+        texel = offset + y * w + x
+
+        value = mi.Color3f(0.0)
+        for i, weight in zip(index, weights):
+            value += self._gather(i * (h * w) + texel, active) * weight
+        return value
+
+    def neighbors(self, wi: mi.Vector3f, wr: mi.Vector3f, active: mi.Mask = True) -> tuple[list[mi.UInt32], list[mi.Float]]:
+        """Image indices and normalized weights of the k angular samples to blend."""
+        if self._table_resolution is not None:
+            r = self._table_resolution
+            lu, lv = _octahedral_cell(wi, r)
+            vu, vv = _octahedral_cell(wr, r)
+            cell = (((lu * r + lv) * r + vu) * r + vv) * self.k
+            index = [dr.gather(mi.UInt32, self._table_index, cell + t, active) for t in range(self.k)]
+            weights = [dr.gather(mi.Float, self._table_weights, cell + t, active) for t in range(self.k)]
+            return index, weights
+
+        distance, index = self.query(wi, wr, active)
+
+        # Inverse distance weights relative to the nearest sample, so that they never overflow (see idw_weights)
+        d0 = distance[0] + 1e-16
+        weights = [dr.power(d0 / (d + 1e-16), self.p) for d in distance]
+        weight_sum = sum(weights[1:], weights[0])
+        return index, [weight / weight_sum for weight in weights]
+
+    def query(self, wi: mi.Vector3f, wr: mi.Vector3f, active: mi.Mask = True) -> tuple[list[mi.Float], list[mi.UInt32]]:
+        """Distances and image indices of the k nearest angular samples, sorted by distance."""
+        dl, il = _nearest(self._light, wi, self.k)
+        dv, iv = _nearest(self._view, wr, self.k)
+
+        # See RingGridLookup._query: only pairs with (a+1)(b+1) <= k can be among the k nearest
+        best_d = [mi.Float(dr.inf) for _ in range(self.k)]
+        best_i = [mi.UInt32(0) for _ in range(self.k)]
+        for a in range(len(dl)):
+            for b in range(len(dv)):
+                if (a + 1) * (b + 1) <= self.k:
+                    _insert(best_d, best_i, dl[a] + dv[b], il[a] * self._num_view + iv[b])
+
+        index = [dr.gather(mi.UInt32, self._pair_index, i, active) for i in best_i]
+        distance = [dr.sqrt(dr.maximum(d, 0.0)) for d in best_d]
+        return distance, index
+
+    def _gather(self, index: mi.UInt32, active: mi.Mask) -> mi.Color3f:
+        if self._packed:
+            v = dr.gather(mi.UInt32, self._texels, index, active)
+            channels = [v & 0xFF, (v >> 8) & 0xFF, (v >> 16) & 0xFF]
+            if self._lut is not None:
+                return mi.Color3f(*[dr.gather(mi.Float, self._lut, c, active) for c in channels])
+            return mi.Color3f(*[mi.Float(c) for c in channels])
+        if isinstance(self._texels, mi.Float16):
+            return mi.Color3f(dr.gather(dr.float16_array_t(mi.Color3f), self._texels, index, active))
+        return dr.gather(mi.Color3f, self._texels, index, active)
+
+
+def _rings(rings: HemisphereRings) -> list[tuple[float, int, int, float]]:
+    # (polar angle [rad], start index, count, first azimuth [rad]) of each ring as Python scalars,
+    # which become literals in the generated kernel
+    return [
+        (float(np.radians(theta)), int(start), int(n), float(np.radians(phi0)))
+        for theta, start, n, phi0 in zip(rings._ring_theta, rings._ring_start, rings._ring_count, rings._ring_phi0)
+    ]
+
+
+def _octahedral_cell(w: mi.Vector3f, r: int) -> tuple[mi.UInt32, mi.UInt32]:
+    # Cell of the hemispherical octahedral map, see neighbor_table.dir_to_octahedral
+    norm = dr.abs(w.x) + dr.abs(w.y) + dr.abs(w.z)
+    px, py = w.x / norm, w.y / norm
+    u = dr.clip((px + py + 1.0) * (0.5 * r), 0.0, r - 1)
+    v = dr.clip((px - py + 1.0) * (0.5 * r), 0.0, r - 1)
+    return mi.UInt32(u), mi.UInt32(v)
+
+
+def _upload(levels: list[np.ndarray], offsets: np.ndarray) -> mi.UInt32 | mi.Float16 | mi.Float:
+    """Texels of all levels back to back, packed into one UInt32 per texel for uint8 images, in half precision for float16 images."""
+    if levels[0].dtype == np.uint8:
+        # (N, H, W, 3) uint8 -> (N * H * W) uint32, one gather per texel
+        rgba = np.zeros((offsets[-1], 4), dtype=np.uint8)
+        for level, start, end in zip(levels, offsets[:-1], offsets[1:]):
+            rgba[start:end, :3] = level.reshape(-1, 3)
+        return mi.UInt32(rgba.reshape(-1).view(np.uint32))
+    if levels[0].dtype == np.float16:  # the memory of the linearized images, instead of twice that as Float
+        return mi.Float16(levels[0].reshape(-1) if len(levels) == 1 else np.concatenate([level.reshape(-1) for level in levels]))
+    return mi.Float(np.concatenate([level.reshape(-1).astype(np.float32) for level in levels]))
+
+
+def _wrap(t: mi.Float, n: int) -> mi.UInt32:
+    return dr.minimum(mi.UInt32(_wrap_float(t, n)), n - 1)
+
+
+def _wrap_float(t: mi.Float, n: int) -> mi.Float:
+    return t - n * dr.floor(t / n)
+
+
+def _insert(best_d: list, best_i: list, d: mi.Float, i: mi.UInt32) -> None:
+    """Insert (d, i) into the lists sorted by increasing d, dropping the largest entry."""
+    for t in range(len(best_d)):
+        swap = d < best_d[t]
+        best_d[t], d = dr.select(swap, d, best_d[t]), dr.select(swap, best_d[t], d)
+        best_i[t], i = dr.select(swap, i, best_i[t]), dr.select(swap, best_i[t], i)
+
+
+def _nearest(rings: list[tuple[float, int, int, float]], w: mi.Vector3f, m: int) -> tuple[list[mi.Float], list[mi.UInt32]]:
+    """Squared distances and indices of the m nearest directions on a ring layout, see HemisphereRings.nearest."""
+    rho = dr.sqrt(dr.square(w.x) + dr.square(w.y))
+    phi = dr.atan2(w.y, w.x)
+
+    num = min(m, sum(n for _, _, n, _ in rings))
+    best_d = [mi.Float(dr.inf) for _ in range(num)]
+    best_i = [mi.UInt32(0) for _ in range(num)]
+    for theta, start, n, phi0 in rings:
+        st, ct = np.sin(theta), np.cos(theta)
+        d2_ring = dr.square(w.z - ct) + dr.square(rho - st)
+        x = (phi - phi0) * (n / (2.0 * np.pi))  # azimuth in units of ring steps
+        if n <= m:
+            js = [mi.Float(j) for j in range(n)]
+        else:
+            j0 = dr.round(x - (m - 1) / 2)
+            js = [j0 + t for t in range(m)]
+        for j in js:
+            d2 = d2_ring + 4.0 * rho * st * dr.square(dr.sin((x - j) * (np.pi / n)))
+            _insert(best_d, best_i, d2, start + _wrap(j, n))
+    return best_d, best_i
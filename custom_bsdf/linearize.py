@@ -0,0 +1,46 @@
+from typing import Optional
+import numpy as np
+import numpy.typing as npt
+
+
+def linear_lut(scale: float = 1.0, gamma: float = 2.2) -> np.ndarray:
+    """Table (256,) float32 mapping 8 bit texel values v to the linear reflectance (v * scale / 255)^gamma."""
+    return ((np.arange(256, dtype=np.float64) * (scale / 255.0)) ** gamma).astype(np.float32)
+
+
+def linearize(images: npt.ArrayLike, scale: float = 1.0, gamma: float = 2.2, dtype: npt.DTypeLike = np.float16, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Convert 8 bit images (N, H, W, C) to linear reflectance (v * scale / 255)^gamma with `dtype`.
+
+    The images are converted one at a time (memory-mapped inputs are not read in full at once).
+    If `out` is given (e.g. a memory-mapped file), the result is written into it.
+
+    Examples
+    --------
+    >>> images = np.full((1, 2, 2, 3), 255, dtype=np.uint8)
+    >>> linearize(images, scale=0.5)[0, 0, 0]
+    array([0.2177, 0.2177, 0.2177], dtype=float16)
+    """
+    if np.dtype(images.dtype) != np.uint8:
+        raise ValueError(f"linearize expects uint8 images, got {images.dtype}.")
+    lut = linear_lut(scale, gamma).astype(dtype)
+    if out is None:
+        out = np.empty(images.shape, dtype=dtype)
+    for i in range(len(images)):
+        out[i] = lut[images[i]]
+    return out
+
+
+def spatial_mean(images, lut: Optional[np.ndarray] = None) -> np.ndarray:
+    """Mean texel value (N, C) float64 of each image (N, H, W, C), after applying the table `lut` (256,) if given.
+
+    Image sources (see `BtfInterpolator`) are read through `gather`, one image at a time.
+    """
+    n, h, w, c = images.shape
+    yy, xx = np.meshgrid(np.arange(h), np.arange(w), indexing="ij")
+    means = np.empty((n, c), dtype=np.float64)
+    for i in range(n):
+        image = images[i] if isinstance(images, np.ndarray) else images.gather(i, yy, xx)
+        if lut is not None:
+            image = lut[image]
+        means[i] = np.mean(image.reshape(-1, c), axis=0, dtype=np.float64)
+    return means
@@ -1,11 +1,46 @@
+import threading
+import weakref
+from concurrent.futures import Future
+from typing import Optional
 import numpy as np
 import mitsuba as mi
 import drjit as dr
 
-from .microfacet_sampling import MicrofacetSampling
+from . import profiling
+from .microfacet_sampling import MicrofacetSampling, none_or, wavefront_size
 
+from .btf_fit import FittedBrdf
 from .btf_interpolator import BtfInterpolator
-from .ubo2003 import Ubo2003
+from .btf_store import load_btf, load_in_background, load_linearized, load_mip_pyramid
+from .drjit_btf import DrJitBtf
+from .linearize import linear_lut, spatial_mean
+from .path_differential import PathDifferential
+from .tabulated_sampling import TabulatedSampling
+from .ubo2003 import cache_base
+
+# Number of living numpy backend instances, and the recording flags to restore when the last one is destroyed
+_numpy_instances = 0
+_saved_flags: Optional[tuple[bool, bool]] = None
+_flags_lock = threading.Lock()
+
+
+def _disable_recording() -> None:
+    global _numpy_instances, _saved_flags
+    with _flags_lock:
+        if _numpy_instances == 0:
+            _saved_flags = (dr.flag(dr.JitFlag.LoopRecord), dr.flag(dr.JitFlag.VCallRecord))
+            dr.set_flag(dr.JitFlag.LoopRecord, False)
+            dr.set_flag(dr.JitFlag.VCallRecord, False)
+        _numpy_instances += 1
+
+
+def _restore_recording() -> None:
+    global _numpy_instances
+    with _flags_lock:
+        _numpy_instances -= 1
+        if _numpy_instances == 0 and _saved_flags is not None:
+            dr.set_flag(dr.JitFlag.LoopRecord, _saved_flags[0])
+            dr.set_flag(dr.JitFlag.VCallRecord, _saved_flags[1])
 
 
 class MeasuredBTF(MicrofacetSampling):
@@ -17,35 +52,285 @@ class MeasuredBTF(MicrofacetSampling):
         self.m_p: float = props.get("p", 4.0)  # Power parameter
         self.m_k: int = props.get("k", 4)  # Number of nearest neighbors
         self.m_gamma: float = props.get("gamma", 2.2)  # Gamma correction
+        self.m_cache_dir: str | None = props.get("cache_dir", None)  # Directory for the decoded BTF cache
+        self.m_shared_memory: bool = props.get("shared_memory", False)  # Share the BTF data between processes
+        self.m_backend: str = props.get("backend", "numpy")  # "numpy" or "drjit"
+        self.m_table_resolution: int = props.get("table_resolution", 0)  # Precomputed neighbor table (0: disabled)
+        self.m_tile: int = props.get("tile", 0)  # Tile size of the texel-major layout (0: disabled)
+        self.m_lazy_cache_mb: float = props.get("lazy_cache_mb", 0.0)  # Lazy loading with an LRU image cache (0: preload)
+        self.m_linearize: str = props.get("linearize", "none")  # "none", "lut" or "float16"
+        self.m_mip_filter: str = props.get("mip_filter", "none")  # "none", "nearest" or "trilinear"
+        self.m_interpolation: str = props.get("interpolation", "idw")  # "idw" or "barycentric"
+        self.m_sampling: str = props.get("sampling", "microfacet")  # "microfacet" or "tabulated"
+        self.m_sampling_resolution: int = props.get("sampling_resolution", 32)  # Light cells per axis of the tabulated sampling
+        self.m_coherence: str = props.get("coherence", "none")  # Texel lookup order: "none", "sort" or "dedup"
+        self.m_lod: str = props.get("lod", "none")  # Fitted diffuse + GGX fallback: "none", "depth" or "footprint"
+        self.m_lod_filename: str = props.get("lod_filename", "")  # Fitted parameters (see btf_fit.py)
+        self.m_lod_texels: float = props.get("lod_texels", 4.0)  # Footprint (in texels) above which lod="footprint" switches
+        self.m_async_load: bool = props.get("async_load", False)  # Load the BTF in a background thread, the first lookup waits for it
+        self.m_profile: bool = props.get("profile", False)  # Record call counts and stage times (see profiling.py)
 
         to_uv = props.get("to_uv", mi.ScalarTransform4f())
         self.m_transform = mi.Transform3f(to_uv.extract().matrix)
 
-        ubo = Ubo2003(self.m_filename)
-        images = ubo.images
-        angles = ubo.angles
-        self.btf_interp = BtfInterpolator(images, angles)
+        if self.m_linearize not in ("none", "lut", "float16"):
+            raise ValueError(f"Unknown linearize '{self.m_linearize}'. Use 'none', 'lut' or 'float16'.")
+        if self.m_mip_filter not in ("none", "nearest", "trilinear"):
+            raise ValueError(f"Unknown mip_filter '{self.m_mip_filter}'. Use 'none', 'nearest' or 'trilinear'.")
+        if self.m_interpolation == "barycentric" and self.m_backend != "numpy":
+            raise ValueError("interpolation='barycentric' is only supported by the numpy backend.")
+        if self.m_backend not in ("numpy", "drjit"):
+            raise ValueError(f"Unknown backend '{self.m_backend}'. Use 'numpy' or 'drjit'.")
+        if self.m_sampling not in ("microfacet", "tabulated"):
+            raise ValueError(f"Unknown sampling '{self.m_sampling}'. Use 'microfacet' or 'tabulated'.")
+        if self.m_lod not in ("none", "depth", "footprint"):
+            raise ValueError(f"Unknown lod '{self.m_lod}'. Use 'none', 'depth' or 'footprint'.")
+        if self.m_lod != "none" and not self.m_lod_filename:
+            raise ValueError("lod requires lod_filename, see custom_bsdf/btf_fit.py.")
+
+        if self.m_profile:
+            profiling.enable()
+
+        self._lod_checked = False  # see `_check_differentials`
+
+        # With async_load, the scene construction continues while the data loads, see `_wait`
+        self._loading: Optional[Future] = None
+        if self.m_async_load:
+            self._loading = load_in_background(self._load)
+        else:
+            self._load()
+
+        # Parameters exposed to `mi.traverse`, changing them rebuilds the interpolator but keeps the data
+        self.m_params = {
+            "p": mi.Float(self.m_p),
+            "k": mi.UInt32(self.m_k),
+            "scale": mi.Float(self.m_scale),
+            "gamma": mi.Float(self.m_gamma),
+        }
+
+        if self.m_backend == "numpy":
+            # Magic:
+            # Prevent RuntimeError: drjit.custom(<mitsuba.python.util._RenderOp>): error while performing a custom differentiable operation.
+            # https://github.com/mitsuba-renderer/mitsuba3/discussions/586#discussioncomment-5300468
+            # The NumPy lookup needs evaluated arrays, so loops and virtual calls must not be recorded.
+            # The integrator records them before the BSDF is called, so the flags cannot be scoped to
+            # `eval`: they stay off (for all instances in the process) while a numpy instance exists.
+            _disable_recording()
+            weakref.finalize(self, _restore_recording)
+
+    def _load(self) -> None:
+        """Load the data and build the interpolator and the sampling table."""
+        self._load_data()
+        self._build_interpolator()
+        self._fitted = None
+        if self.m_lod != "none":
+            self._fitted = FittedBrdf.load(self.m_lod_filename)
+            self._check_lod_gamma()
+        if self.m_sampling == "tabulated":
+            self.m_sampling_table = self._tabulate_sampling(self._data.images, self._data.angles)
+
+    def _wait(self) -> None:
+        """Wait for the background load started by the constructor (re-raising its error), if any."""
+        if self._loading is not None:
+            with profiling.stage("MeasuredBTF.wait"):
+                self._loading.result()
+            self._loading = None
+
+    def _check_lod_gamma(self) -> None:
+        # scale is applied to the fitted model as a factor scale^gamma, but the fit depends on gamma
+        if self._fitted is not None and abs(self._fitted.gamma - self.m_gamma) > 1e-6:
+            raise ValueError(f"{self.m_lod_filename} was fitted for gamma={self._fitted.gamma:g}, not gamma={self.m_gamma:g}.")
+
+    def _check_differentials(self, footprint: mi.Float) -> None:
+        """Raise on the first lod evaluation if the integrator cannot provide ray differentials.
 
+        Without them every hit counts as a secondary bounce, and the fitted model silently replaces the
+        measured BTF in the whole image. Recorded (symbolic) calls cannot be inspected, there only the
+        presence of a `path_differential` integrator is checked.
+        """
+        if self._lod_checked:
+            return
+        provided = PathDifferential.created > 0
+        if not provided and not dr.flag(dr.JitFlag.SymbolicScope):
+            provided = bool(dr.any(footprint > 0.0))
+        if not provided:
+            raise ValueError(
+                f"lod='{self.m_lod}' needs ray differentials, but the integrator does not provide them "
+                "(Mitsuba's integrators leave si.duv_dx and si.duv_dy at zero), so all hits would use the fitted model. "
+                "Render with the path_differential integrator (see custom_bsdf/path_differential.py) or set lod='none'."
+            )
+        self._lod_checked = True
+
+    @profiling.profiled("MeasuredBTF.load")
+    def _load_data(self) -> None:
+        """Load (or look up) the shared BTF data and mip levels, and the LUT for the current scale and gamma."""
+        # Instances with the same file share a single copy of the data
+        max_cache_bytes = int(self.m_lazy_cache_mb * 2**20) if self.m_lazy_cache_mb > 0 else None
+        # With linearize, scale and inverse gamma are applied to the texels before blending instead of per evaluation
+        self._lut = None
+        if self.m_linearize == "float16":
+            self._data = load_linearized(self.m_filename, self.m_scale, self.m_gamma, cache_dir=self.m_cache_dir, shared_memory=self.m_shared_memory)
+        else:
+            self._data = load_btf(self.m_filename, cache_dir=self.m_cache_dir, shared_memory=self.m_shared_memory, max_cache_bytes=max_cache_bytes)
+            self._lut = linear_lut(self.m_scale, self.m_gamma) if self.m_linearize == "lut" else None
+        # Spatial mip levels, selected by the ray differential footprint
+        self._mip_levels = None
+        if self.m_mip_filter != "none":
+            tag = f"linear-s{self.m_scale:g}-g{self.m_gamma:g}" if self.m_linearize == "float16" else ""
+            self._mip_levels = load_mip_pyramid(self.m_filename, self._data.images, cache_dir=self.m_cache_dir, tag=tag)
+
+    @profiling.profiled("MeasuredBTF.build")
+    def _build_interpolator(self) -> None:
+        """(Re)build the interpolator for the current settings, the search structures are shared with other instances."""
+        table_resolution = self.m_table_resolution if self.m_table_resolution > 0 else None
+        table_file = None
+        if table_resolution is not None and self.m_cache_dir is not None:
+            table_file = f"{cache_base(self.m_filename, self.m_cache_dir)}.table-r{table_resolution}-k{self.m_k}.npz"
+        trilinear = self.m_mip_filter == "trilinear"
+        # The table for the drjit backend is built by the NumPy interpolator
+        tile = self.m_tile if (self.m_tile > 0 and self.m_backend == "numpy") else None
+        self.btf_interp = BtfInterpolator(
+            self._data.images,
+            self._data.angles,
+            k=self.m_k,
+            p=self.m_p,
+            interpolation=self.m_interpolation,
+            table_resolution=table_resolution,
+            table_file=table_file,
+            tile=tile,
+            lut=self._lut,
+            mip_levels=self._mip_levels,
+            trilinear=trilinear,
+            coherence=self.m_coherence,
+        )
+        if self.m_backend == "drjit":
+            # Lookup expressed in Dr.Jit operations, can be recorded into the megakernel
+            self.btf_drjit = DrJitBtf(self._data.images, self._data.angles, k=self.m_k, p=self.m_p, table=self.btf_interp.table, lut=self._lut, mip_levels=self._mip_levels, trilinear=trilinear)
+
+    def traverse(self, callback: mi.TraversalCallback) -> None:
+        super().traverse(callback)
+        for name, value in self.m_params.items():
+            callback.put(name, value, mi.ParamFlags.NonDifferentiable)
+
+    def parameters_changed(self, keys: list[str]) -> None:
+        super().parameters_changed(keys)
+        self._wait()
+        p = float(self.m_params["p"][0])
+        k = int(self.m_params["k"][0])
+        scale = float(self.m_params["scale"][0])
+        gamma = float(self.m_params["gamma"][0])
+        if (p, k, scale, gamma) == (self.m_p, self.m_k, self.m_scale, self.m_gamma):
+            return
+        reload = (scale, gamma) != (self.m_scale, self.m_gamma) and self.m_linearize != "none"
+        self.m_p, self.m_k, self.m_scale, self.m_gamma = p, k, scale, gamma
+        self._check_lod_gamma()
+        if reload:
+            self._load_data()  # new LUT, or the float16 data for the new scale and gamma
+        self._build_interpolator()
+        if self.m_sampling == "tabulated":
+            # The table is built from the linear reflectance, which depends on all four parameters
+            self.m_sampling_table = self._tabulate_sampling(self._data.images, self._data.angles)
+
+    def _tabulate_sampling(self, images, angles) -> TabulatedSampling:
+        # Importance: luminance of the spatially averaged linear reflectance, interpolated like the texels
+        if self.m_linearize == "float16":
+            means = spatial_mean(images)
+        elif getattr(images, "dtype", None) == np.uint8:
+            means = spatial_mean(images, lut=linear_lut(self.m_scale, self.m_gamma))
+        else:
+            means = (spatial_mean(images) * (self.m_scale / 255.0)) ** self.m_gamma
+        interp = BtfInterpolator(means[:, np.newaxis, np.newaxis, :], angles, k=self.m_k, p=self.m_p)
+
+        def luminance(wo, wi):
+            b, g, r = interp(wo, wi, np.zeros((len(wo), 2), dtype=np.float32)).T
+            return np.maximum(0.2126 * r + 0.7152 * g + 0.0722 * b, 0.0)
+
+        return TabulatedSampling.from_function(luminance, resolution=self.m_sampling_resolution)
+
+    def sample(self, ctx: mi.BSDFContext, si: mi.SurfaceInteraction3f, sample1: mi.Float, sample2: mi.Point2f, active: mi.Mask) -> tuple[mi.BSDFSample3f, mi.Spectrum]:
+        self._wait()  # the sampling table may still be loading
+        return super().sample(ctx, si, sample1, sample2, active)
+
+    def pdf(self, ctx: mi.BSDFContext, si: mi.SurfaceInteraction3f, wo: mi.Vector3f, active: mi.Mask) -> mi.Float:
+        self._wait()
+        return super().pdf(ctx, si, wo, active)
+
+    @profiling.profiled("MeasuredBTF.eval", wavefront_size)
     def eval(self, ctx: mi.BSDFContext, si: mi.SurfaceInteraction3f, wo: mi.Vector3f, active: mi.Mask) -> mi.Spectrum:
+        self._wait()
         cos_theta_i = mi.Frame3f.cos_theta(si.wi)
         cos_theta_o = mi.Frame3f.cos_theta(wo)
         active &= (cos_theta_i > 0.0) & (cos_theta_o > 0.0)
 
-        if (dr.none(active)) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
+        if none_or(active) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
             return 0.0
 
         uv = self.m_transform.transform_affine(si.uv)
 
+        # Pixel footprint in uv units from the ray differentials (zero if the integrator does not provide them)
+        footprint = None
+        if self.m_mip_filter != "none" or self.m_lod != "none":
+            duv_dx = self.m_transform @ mi.Vector2f(si.duv_dx)
+            duv_dy = self.m_transform @ mi.Vector2f(si.duv_dy)
+            footprint = dr.maximum(dr.norm(duv_dx), dr.norm(duv_dy))
+
+        # Fitted model where the measured detail is not needed: secondary bounces (no footprint) and wide footprints
+        fitted = None
+        if self.m_lod != "none":
+            self._check_differentials(footprint)
+            fitted = footprint == 0.0
+            if self.m_lod == "footprint":
+                fitted |= footprint * max(self._data.images.shape[1:3]) > self.m_lod_texels
+            rgb = self._fitted.eval(wo, si.wi, uv, active & fitted) * self.m_scale**self.m_gamma
+            fitted_value = mi.Color3f(rgb) * dr.inv_pi
+            active_measured = active & ~fitted
+            if none_or(active_measured):
+                return mi.depolarizer(fitted_value) & active
+        if self.m_mip_filter == "none":
+            footprint = None
+
+        if self.m_backend == "drjit":
+            bgr = self.btf_drjit.eval(wo, si.wi, uv, active if fitted is None else active_measured, footprint=footprint)
+            if self.m_linearize == "none":
+                bgr = dr.power(bgr * (self.m_scale / 255.0), self.m_gamma)  # scale and inverse gamma correction
+            value = mi.Color3f(bgr.z, bgr.y, bgr.x) * dr.inv_pi  # BGR -> RGB
+            if fitted is not None:
+                value = dr.select(fitted, fitted_value, value)
+            return mi.depolarizer(value) & active
+
+        n = dr.width(wo)
+        if profiling.enabled():
+            # Evaluate the pending kernel of the inputs separately, otherwise it is timed as conversion
+            with profiling.stage("MeasuredBTF.eval.kernel", n):
+                dr.eval(wo, si.wi, uv, footprint, fitted)
+                dr.sync_thread()
+
         # Convert to numpy arrays for BTF lookup
-        wl = np.asarray(wo).T  # (N, 3)
-        wv = np.asarray(si.wi).T  # (N, 3)
-        uv = np.asarray(uv).T  # (N, 2)
-        bgr = self.btf_interp(wl, wv, uv)
+        with profiling.stage("MeasuredBTF.eval.to_numpy", n):
+            wl = np.asarray(wo).T  # (N, 3)
+            wv = np.asarray(si.wi).T  # (N, 3)
+            uv = np.asarray(uv).T  # (N, 2)
+            footprint = None if footprint is None else np.asarray(footprint)  # (N,)
+            # Only the lanes without the fitted model are looked up
+            measured = None if fitted is None else np.flatnonzero(~np.asarray(fitted))
+            if measured is not None:
+                wl, wv, uv = wl[measured], wv[measured], uv[measured]
+                footprint = None if footprint is None else footprint[measured]
+        bgr = self.btf_interp(wl, wv, uv, footprint=footprint)
 
-        bgr *= self.m_scale / 255.0  # scale
-        bgr **= self.m_gamma  # inverse gamma correction
+        if self.m_linearize == "none":
+            with profiling.stage("MeasuredBTF.eval.gamma", n):
+                bgr *= self.m_scale / 255.0  # scale
+                bgr **= self.m_gamma  # inverse gamma correction
         rgb = bgr[..., ::-1]  # BGR -> RGB
 
-        value = mi.Color3f(rgb.T) * dr.inv_pi
+        with profiling.stage("MeasuredBTF.eval.to_drjit", n):
+            if measured is not None:
+                rgb_all = np.zeros((n, 3), dtype=rgb.dtype)
+                rgb_all[measured] = rgb
+                rgb = rgb_all
+            value = mi.Color3f(rgb.T) * dr.inv_pi
+            if fitted is not None:
+                value = dr.select(fitted, fitted_value, value)
 
         return mi.depolarizer(value) & active
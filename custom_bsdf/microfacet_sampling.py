@@ -1,11 +1,24 @@
+from typing import Optional
 import mitsuba as mi
 import drjit as dr
 
-# Magic:
-# Prevent RuntimeError: drjit.custom(<mitsuba.python.util._RenderOp>): error while performing a custom differentiable operation.
-# https://github.com/mitsuba-renderer/mitsuba3/discussions/586#discussioncomment-5300468
-dr.set_flag(dr.JitFlag.LoopRecord, False)
-dr.set_flag(dr.JitFlag.VCallRecord, False)
+from . import profiling
+from .tabulated_sampling import TabulatedSampling
+
+
+def none_or(active: mi.Mask, default: bool = False) -> bool:
+    """`dr.none(active)`, or `default` if `active` is symbolic and cannot be evaluated (recorded loops / calls).
+
+    Counterpart of `dr::none_or<false>()` in C++, used for early exits that are only an optimization.
+    """
+    if dr.flag(dr.JitFlag.SymbolicScope):
+        return default
+    return dr.none(active)
+
+
+def wavefront_size(self, ctx: mi.BSDFContext, si: mi.SurfaceInteraction3f, *args) -> int:
+    """Width of the arrays of a BSDF call, recorded by the profiling of the BSDF methods."""
+    return dr.width(si.wi)
 
 
 class MicrofacetSampling(mi.BSDF):
@@ -15,6 +28,9 @@ class MicrofacetSampling(mi.BSDF):
     By default, `eval()` is implemented as a diffuse reflection, but can be changed as needed.
 
     This class is implemented based on measured_polarized plugin in Mitsuba3.
+
+    If a subclass sets `self.m_sampling_table` (see `TabulatedSampling`), the GGX lobe is replaced
+    by the tabulated distribution, still mixed with cosine hemisphere sampling.
     """
 
     def __init__(self, props: mi.Properties) -> None:
@@ -29,23 +45,29 @@ class MicrofacetSampling(mi.BSDF):
         # Set to 1.0 in order to fully fall back to cosine sampling.
         self.COSINE_HEMISPHERE_PDF_WEIGHT = 0.1
 
+        # Data-driven distribution replacing the GGX lobe, set by subclasses
+        self.m_sampling_table: Optional[TabulatedSampling] = None
+
+    @profiling.profiled("MicrofacetSampling.sample", wavefront_size)
     def sample(self, ctx: mi.BSDFContext, si: mi.SurfaceInteraction3f, sample1: mi.Float, sample2: mi.Point2f, active: mi.Mask) -> tuple[mi.BSDFSample3f, mi.Spectrum]:
         cos_theta_i = mi.Frame3f.cos_theta(si.wi)
         active &= cos_theta_i > 0.0
 
         bs = dr.zeros(mi.BSDFSample3f)
-        if dr.none(active) | (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
+        if none_or(active) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
             return bs, 0.0
 
-        distr = mi.MicrofacetDistribution(mi.MicrofacetType.GGX, self.m_alpha_sample, self.m_alpha_sample, True)
-
         lobe_pdf_diffuse = self.COSINE_HEMISPHERE_PDF_WEIGHT
         sample_diffuse = active & (sample1 < lobe_pdf_diffuse)
         sample_microfacet = active & (~sample_diffuse)
 
         wo_diffuse = mi.warp.square_to_cosine_hemisphere(sample2)
-        m, unused = distr.sample(si.wi, sample2)
-        wo_microfacet = mi.reflect(si.wi, m)
+        if self.m_sampling_table is not None:
+            wo_microfacet = self.m_sampling_table.sample(si.wi, sample2, sample_microfacet)
+        else:
+            distr = mi.MicrofacetDistribution(mi.MicrofacetType.GGX, self.m_alpha_sample, self.m_alpha_sample, True)
+            m, unused = distr.sample(si.wi, sample2)
+            wo_microfacet = mi.reflect(si.wi, m)
 
         bs.wo[sample_diffuse] = wo_diffuse
         bs.wo[sample_microfacet] = wo_microfacet
@@ -64,25 +86,28 @@ class MicrofacetSampling(mi.BSDF):
         cos_theta_o = mi.Frame3f.cos_theta(wo)
         active &= (cos_theta_i > 0.0) & (cos_theta_o > 0.0)
 
-        if (dr.none(active)) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
+        if none_or(active) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
             return 0.0
 
         value = mi.Color3f(0.2, 0.25, 0.7) * dr.inv_pi * cos_theta_o
 
         return mi.depolarizer(value) & active
 
+    @profiling.profiled("MicrofacetSampling.pdf", wavefront_size)
     def pdf(self, ctx: mi.BSDFContext, si: mi.SurfaceInteraction3f, wo: mi.Vector3f, active: mi.Mask) -> mi.Float:
-        if dr.none(active) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
+        if none_or(active) or (not ctx.is_enabled(mi.BSDFFlags.GlossyReflection)):
             return 0.0
 
         cos_theta_i = mi.Frame3f.cos_theta(si.wi)
         cos_theta_o = mi.Frame3f.cos_theta(wo)
 
-        distr = mi.MicrofacetDistribution(mi.MicrofacetType.GGX, self.m_alpha_sample, self.m_alpha_sample, True)
-        H = dr.normalize(wo + si.wi)
-
         pdf_diffuse = mi.warp.square_to_cosine_hemisphere_pdf(wo)
-        pdf_microfacet = distr.pdf(si.wi, H) / (4.0 * dr.dot(wo, H))
+        if self.m_sampling_table is not None:
+            pdf_microfacet = self.m_sampling_table.pdf(si.wi, wo, active)
+        else:
+            distr = mi.MicrofacetDistribution(mi.MicrofacetType.GGX, self.m_alpha_sample, self.m_alpha_sample, True)
+            H = dr.normalize(wo + si.wi)
+            pdf_microfacet = distr.pdf(si.wi, H) / (4.0 * dr.dot(wo, H))
 
         pdf = 0
         pdf += pdf_diffuse * self.COSINE_HEMISPHERE_PDF_WEIGHT
@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import Callable
+import numpy as np
+
+
+def idw_weights(distance: np.ndarray, p: float) -> np.ndarray:
+    """Normalized inverse distance weights 1 / d^p along the last axis.
+
+    The weights are computed relative to the nearest sample, which avoids overflow for small distances.
+    """
+    distance = np.asarray(distance, dtype=np.float32) + 1e-16
+    weights = (np.min(distance, axis=-1, keepdims=True) / distance) ** p
+    return weights / np.sum(weights, axis=-1, keepdims=True)
+
+
+def dir_to_octahedral(w: np.ndarray) -> np.ndarray:
+    """Map directions (..., 3) on the upper hemisphere to the square [-1, 1]^2 (..., 2).
+
+    Hemispherical octahedral map: the hemisphere is projected onto the diamond |x| + |y| <= 1,
+    which is rotated by 45 degrees to fill the square. Directions below the horizon are mirrored.
+    """
+    w = np.asarray(w, dtype=np.float32)
+    norm = np.abs(w[..., 0]) + np.abs(w[..., 1]) + np.abs(w[..., 2])
+    px = w[..., 0] / norm
+    py = w[..., 1] / norm
+    return np.stack([px + py, px - py], axis=-1)
+
+
+def octahedral_to_dir(uv: np.ndarray) -> np.ndarray:
+    """Inverse of `dir_to_octahedral`."""
+    uv = np.asarray(uv, dtype=np.float32)
+    px = (uv[..., 0] + uv[..., 1]) * 0.5
+    py = (uv[..., 0] - uv[..., 1]) * 0.5
+    w = np.stack([px, py, 1.0 - np.abs(px) - np.abs(py)], axis=-1)
+    return w / np.linalg.norm(w, axis=-1, keepdims=True)
+
+
+class NeighborTable:
+    """Precomputed k-NN table over quantized (wi, wr) directions.
+
+    Each hemisphere is discretized into `resolution` x `resolution` cells of the hemispherical
+    octahedral map, and the k nearest angular samples of every (light cell, view cell) pair are
+    stored, so a query reduces to computing two cell indices and reading the table.
+
+    Inputs
+    ------
+    index : ndarray (R, R, R, R, k)
+        Indices of the k nearest angular samples for each (light u, light v, view u, view v) cell.
+    distance : ndarray (R, R, R, R, k)
+        Distances of the k nearest angular samples, sorted in increasing order.
+
+    Use `NeighborTable.build` to compute the table from a k-NN query function.
+    """
+
+    def __init__(self, index: np.ndarray, distance: np.ndarray) -> None:
+        if index.ndim != 5 or index.shape != distance.shape or len(set(index.shape[:4])) != 1:
+            raise ValueError("index and distance must have shape (R,R,R,R,k).")
+        self.index = np.ascontiguousarray(index, dtype=np.int32)
+        self.distance = np.ascontiguousarray(distance, dtype=np.float32)
+        self.resolution = index.shape[0]
+        self.k = index.shape[-1]
+        self._weights: dict[float, np.ndarray] = {}  # by p, most recently used last
+
+    @classmethod
+    def build(cls, query: Callable[[np.ndarray, np.ndarray], tuple[np.ndarray, np.ndarray]], resolution: int, chunk_size: int = 1 << 18) -> "NeighborTable":
+        """Run `query(wi, wr) -> (distance, index)` at the center directions of all cell pairs."""
+        r = resolution
+        centers = (np.arange(r, dtype=np.float32) + 0.5) / r * 2.0 - 1.0
+        uu, vv = np.meshgrid(centers, centers, indexing="ij")
+        dirs = octahedral_to_dir(np.stack([uu, vv], axis=-1)).reshape(-1, 3)  # (R * R, 3)
+
+        light, view = np.meshgrid(np.arange(r * r), np.arange(r * r), indexing="ij")
+        light, view = light.reshape(-1), view.reshape(-1)
+        distances, indices = [], []
+        for start in range(0, len(light), chunk_size):
+            d, i = query(dirs[light[start : start + chunk_size]], dirs[view[start : start + chunk_size]])
+            distances.append(d)
+            indices.append(i)
+        distance = np.concatenate(distances).reshape(r, r, r, r, -1)
+        index = np.concatenate(indices).reshape(r, r, r, r, -1)
+        return cls(index, distance)
+
+    def cells(self, w: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Cell coordinates (u, v) of directions (..., 3)."""
+        uv = dir_to_octahedral(w)
+        cell = np.clip(((uv + 1.0) * 0.5 * self.resolution).astype(np.int32), 0, self.resolution - 1)
+        return cell[..., 0], cell[..., 1]
+
+    def flat_cells(self, wi: np.ndarray, wr: np.ndarray) -> np.ndarray:
+        """Flat index of the (light cell, view cell) pairs containing (wi, wr) into the (R^4, k) table."""
+        r = self.resolution
+        lu, lv = self.cells(wi)
+        vu, vv = self.cells(wr)
+        return ((lu * r + lv) * r + vu) * r + vv
+
+    def lookup(self, wi: np.ndarray, wr: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the distances and indices (..., k) of the k nearest samples of the cells containing (wi, wr)."""
+        cell = self.flat_cells(wi, wr)
+        return self.distance.reshape(-1, self.k)[cell], self.index.reshape(-1, self.k)[cell]
+
+    def weights(self, p: float) -> np.ndarray:
+        """Normalized inverse distance weights (R, R, R, R, k) for the power `p`.
+
+        The weights of the last few powers are kept, so that interpolators with different p can share the table.
+        """
+        weights = self._weights.pop(p, None)
+        if weights is None:
+            weights = idw_weights(self.distance, p)
+            if len(self._weights) >= 4:
+                self._weights.pop(next(iter(self._weights)))
+        self._weights[p] = weights
+        return weights
+
+    def save(self, file: str | Path) -> None:
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, "wb") as f:
+            np.savez(f, index=self.index, distance=self.distance)
+
+    @classmethod
+    def load(cls, file: str | Path) -> "NeighborTable":
+        with np.load(file) as data:
+            return cls(data["index"], data["distance"])
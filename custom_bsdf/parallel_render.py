@@ -0,0 +1,161 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Callable, Optional
+import numpy as np
+import mitsuba as mi
+from tqdm import tqdm
+
+# The other modules of the package need the variant at import time, they are imported in the
+# functions as the workers import this module before `_init_worker` sets the variant.
+
+# Scene of the worker process, loaded once by `_init_worker`
+_scene = None
+_load_seconds = 0.0
+
+
+def share_btfs(scene_dict: dict) -> dict:
+    """Enable `shared_memory` for all `measuredbtf` plugins in the scene dictionary (in place, except lazily loaded ones)."""
+    for value in scene_dict.values():
+        if isinstance(value, dict):
+            if value.get("type") == "measuredbtf" and not value.get("lazy_cache_mb", 0):
+                value["shared_memory"] = True
+            share_btfs(value)
+    return scene_dict
+
+
+def _init_worker(scene_factory: Callable[[], dict], variant: str, threads: int) -> None:
+    global _scene, _load_seconds
+    start = time.perf_counter()
+    mi.set_variant(variant)
+    import drjit as dr
+
+    dr.set_thread_count(threads)
+    from .measuredbtf import MeasuredBTF
+    from .path_differential import PathDifferential
+
+    mi.register_bsdf("measuredbtf", lambda props: MeasuredBTF(props))
+    mi.register_integrator("path_differential", lambda props: PathDifferential(props))
+    _scene = mi.load_dict(share_btfs(scene_factory()))
+    _load_seconds = time.perf_counter() - start
+
+
+def _render_job(window: Optional[tuple[int, int, int, int]], spp: int, sample_per_pass: int, seed: int) -> tuple[np.ndarray, float, float]:
+    from .render_passes import RunningStats, render_crop
+
+    start = time.perf_counter()
+    stats = None
+    for i, done in enumerate(range(0, spp, sample_per_pass)):
+        n = min(sample_per_pass, spp - done)
+        if window is None:
+            image = np.asarray(mi.render(_scene, seed=seed + i, spp=n))
+        else:
+            image = render_crop(_scene, window, n, seed=seed + i)
+        if stats is None:
+            stats = RunningStats(image.shape)
+        stats.add(image, n)
+    return stats.mean.astype(np.float32), time.perf_counter() - start, _load_seconds
+
+
+def render_parallel(
+    scene_factory: Callable[[], dict],
+    spp: int,
+    workers: Optional[int] = None,
+    split: str = "tiles",
+    tile_size: int = 64,
+    sample_per_pass: Optional[int] = None,
+    progress: bool = True,
+) -> tuple[np.ndarray, dict]:
+    """Render a scene with a pool of worker processes, and stitch or average their results.
+
+    Every worker loads the scene once. The `measuredbtf` datasets are loaded into shared memory by the
+    calling process first (see `share_btfs`), so the workers map a single copy of them instead of
+    decoding their own. The workers are spawned, so the calling script needs an
+    `if __name__ == "__main__":` guard, and `scene_factory` must be importable by the workers
+    (a function defined at the top level of a module).
+
+    Parameters
+    ----------
+    scene_factory : callable
+        Function returning the scene dictionary. It is called once in this process and once in each worker.
+    spp : int
+        Samples per pixel.
+    workers : int, optional
+        Number of worker processes. Default: number of CPU cores. The cores are divided between the
+        Dr.Jit thread pools of the workers.
+    split : str
+        "tiles": each job renders one tile of `tile_size` pixels with all samples, through the crop
+        window of the film (see `render_crop`). "seeds": each job renders the full frame with a part
+        of the samples and its own seed, and the frames are averaged. Tiles need less memory per
+        worker, seeds do not compile a kernel per crop window.
+    tile_size : int
+        Size of the tiles in pixels.
+    sample_per_pass : int, optional
+        Samples per pixel rendered at once by a worker (memory), all of the job by default.
+    progress : bool
+        Show a progress bar.
+
+    Returns
+    -------
+    image : ndarray (H, W, C)
+        Rendered image.
+    report : dict
+        Wall time, load time of the workers, summed render time of the jobs, and the parallel
+        efficiency (summed render time / (wall time x workers)), the fraction of the wall time the
+        workers spent rendering. Loading, scheduling and idle workers at the end lower it. Contention
+        between the workers (memory bandwidth, oversubscribed cores) slows down the jobs themselves
+        and is not captured, compare the wall time to a single process render for that.
+    """
+    from .render_passes import RunningStats, split_tiles
+
+    if split not in ("tiles", "seeds"):
+        raise ValueError(f"Unknown split '{split}'. Use 'tiles' or 'seeds'.")
+    workers = workers or os.cpu_count()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    start = time.perf_counter()
+
+    # Loads the datasets into shared memory, which stays alive as long as this process holds the scene
+    scene = mi.load_dict(share_btfs(scene_factory()))
+    width, height = (int(size) for size in scene.sensors()[0].film().crop_size())
+
+    if split == "tiles":
+        jobs = [(window, spp, i * spp) for i, window in enumerate(split_tiles(height, width, tile_size))]
+    else:
+        chunk = -(-spp // workers) if sample_per_pass is None else sample_per_pass
+        jobs = [(None, min(chunk, spp - done), done) for done in range(0, spp, chunk)]
+    sample_per_pass = sample_per_pass or spp
+
+    image = None
+    stats = None
+    busy, load = 0.0, 0.0
+    context = get_context("spawn")  # Dr.Jit and the LLVM backend are not fork-safe
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(scene_factory, mi.variant(), threads)) as pool:
+        futures = {pool.submit(_render_job, window, n, sample_per_pass, seed): (window, n) for window, n, seed in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), unit="job", disable=not progress):
+            (window, n), (result, seconds, load_seconds) = futures[future], future.result()
+            busy += seconds
+            load = max(load, load_seconds)
+            if window is None:
+                if stats is None:
+                    stats = RunningStats(result.shape)
+                stats.add(result, n)
+            else:
+                if image is None:
+                    image = np.zeros((height, width) + result.shape[2:], dtype=np.float32)
+                y, x, h, w = window
+                image[y : y + h, x : x + w] = result
+    if stats is not None:
+        image = stats.mean.astype(np.float32)
+
+    wall = time.perf_counter() - start
+    report = {
+        "workers": workers,
+        "split": split,
+        "jobs": len(jobs),
+        "wall_seconds": wall,
+        "load_seconds": load,
+        "render_seconds": busy,
+        "parallel_efficiency": busy / (wall * workers),
+    }
+    return image, report
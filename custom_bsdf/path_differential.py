@@ -0,0 +1,100 @@
+import mitsuba as mi
+import drjit as dr
+
+from .microfacet_sampling import none_or
+
+
+class PathDifferential(mi.SamplingIntegrator):
+    """Path tracer that provides ray differentials to the BSDFs at the first intersection.
+
+    Mitsuba's `path` integrator does not compute the uv partials of the surface interaction, so
+    `si.duv_dx` and `si.duv_dy` are zero in `BSDF.eval`. This integrator traces the same paths
+    (emitter sampling and BSDF sampling combined by multiple importance sampling, Russian roulette),
+    but calls `compute_uv_partials` with the camera ray differential at the first intersection.
+    Secondary intersections keep zero partials.
+
+    Register it with
+
+    >>> mi.register_integrator("path_differential", lambda props: PathDifferential(props))
+
+    Parameters (same as `path`): max_depth (default: -1, unlimited up to 64), rr_depth (default: 5).
+    """
+
+    # Number of instances created in the process, `MeasuredBTF` with `lod` checks that one exists
+    created: int = 0
+
+    def __init__(self, props: mi.Properties) -> None:
+        super().__init__(props)
+        PathDifferential.created += 1
+        max_depth = props.get("max_depth", -1)
+        self.max_depth = 64 if max_depth < 0 else max_depth
+        self.rr_depth = props.get("rr_depth", 5)
+
+    def sample(self, scene: mi.Scene, sampler: mi.Sampler, ray: mi.RayDifferential3f, medium: mi.Medium = None, active: mi.Bool = True):
+        bsdf_ctx = mi.BSDFContext()
+        ray_diff = ray  # note: copying a RayDifferential3f drops its differentials
+        ray = mi.Ray3f(ray)
+        active = mi.Bool(active)
+        L = mi.Spectrum(0.0)
+        beta = mi.Spectrum(1.0)
+        prev_si = dr.zeros(mi.SurfaceInteraction3f)
+        prev_bsdf_pdf = mi.Float(1.0)
+        prev_bsdf_delta = mi.Bool(True)
+        valid = mi.Bool(False)
+
+        # The depth loop is unrolled in Python, so that BSDFs that evaluate NumPy code can be used
+        for depth in range(self.max_depth + 1):
+            si = scene.ray_intersect(ray, ray_flags=mi.RayFlags.All, coherent=depth == 0, active=active)
+            if depth == 0:
+                si.compute_uv_partials(ray_diff)
+                valid = si.is_valid()
+
+            # Emitter hit by the previous BSDF sample
+            ds = mi.DirectionSample3f(scene, si=si, ref=prev_si)
+            em_pdf = dr.select(prev_bsdf_delta, 0.0, scene.pdf_emitter_direction(prev_si, ds, ~prev_bsdf_delta))
+            L += beta * _mis_weight(prev_bsdf_pdf, em_pdf) * ds.emitter.eval(si, active)
+
+            active_next = active & si.is_valid() & (depth < self.max_depth)
+            if none_or(active_next):
+                break
+            bsdf = si.bsdf(ray)
+
+            # Emitter sampling
+            active_em = active_next & mi.has_flag(bsdf.flags(), mi.BSDFFlags.Smooth)
+            ds, em_weight = scene.sample_emitter_direction(si, sampler.next_2d(), True, active_em)
+            active_em &= ds.pdf != 0.0
+            wo = si.to_local(ds.d)
+            bsdf_value_em, bsdf_pdf_em = bsdf.eval_pdf(bsdf_ctx, si, wo, active_em)
+            mis_em = dr.select(ds.delta, 1.0, _mis_weight(ds.pdf, bsdf_pdf_em))
+            L += dr.select(active_em, beta * mis_em * bsdf_value_em * em_weight, 0.0)
+
+            # BSDF sampling
+            bsdf_sample, bsdf_weight = bsdf.sample(bsdf_ctx, si, sampler.next_1d(), sampler.next_2d(), active_next)
+            ray = si.spawn_ray(si.to_world(bsdf_sample.wo))
+            beta *= bsdf_weight
+            prev_si = si
+            prev_bsdf_pdf = bsdf_sample.pdf
+            prev_bsdf_delta = mi.has_flag(bsdf_sample.sampled_type, mi.BSDFFlags.Delta)
+
+            # Russian roulette
+            beta_max = dr.max(beta)
+            active = active_next & (beta_max != 0.0)
+            if depth + 1 >= self.rr_depth:
+                rr_prob = dr.minimum(beta_max, 0.95)
+                rr_continue = sampler.next_1d() < rr_prob
+                beta = dr.select(rr_continue, beta / rr_prob, 0.0)
+                active &= rr_continue
+
+        return L, valid, []
+
+    def aov_names(self):
+        return []
+
+    def to_string(self):
+        return f"PathDifferential[max_depth={self.max_depth}, rr_depth={self.rr_depth}]"
+
+
+def _mis_weight(pdf_a, pdf_b):
+    """Power heuristic."""
+    a2 = dr.square(pdf_a)
+    return dr.detach(dr.select(pdf_a > 0.0, a2 / (a2 + dr.square(pdf_b)), 0.0))
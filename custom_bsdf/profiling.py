@@ -0,0 +1,126 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Optional
+
+# Profiling is enabled by this environment variable (any value but "", "0", "false" or "off"),
+# by `enable()`, or by the `profile` property of the `measuredbtf` plugin.
+ENV_VAR = "BTF_PROFILE"
+
+_enabled = os.environ.get(ENV_VAR, "").lower() not in ("", "0", "false", "off")
+_stats: dict[str, list] = {}  # stage -> [calls, items, seconds, max items]
+_lock = threading.Lock()
+_null = nullcontext()
+
+
+def enable(on: bool = True) -> None:
+    """Enable (or disable) the recording of the stages in this process."""
+    global _enabled
+    _enabled = on
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class _Stage:
+    __slots__ = ("name", "items", "start")
+
+    def __init__(self, name: str, items: int) -> None:
+        self.name = name
+        self.items = items
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        record(self.name, time.perf_counter() - self.start, self.items)
+
+
+def record(name: str, seconds: float, items: int = 0) -> None:
+    """Add one call of `seconds` processing `items` elements (e.g. the wavefront size) to the stage `name`."""
+    items = int(items)
+    with _lock:
+        entry = _stats.get(name)
+        if entry is None:
+            _stats[name] = [1, items, seconds, items]
+        else:
+            entry[0] += 1
+            entry[1] += items
+            entry[2] += seconds
+            entry[3] = max(entry[3], items)
+
+
+def stage(name: str, items: int = 0):
+    """Context manager timing a stage, a shared no-op if profiling is disabled.
+
+    Stages are named "<Class>.<method>[.<step>]". The time of a stage includes the stages nested in it,
+    e.g. "MeasuredBTF.eval" includes "BtfInterpolator.__call__".
+
+    Examples
+    --------
+    >>> with profiling.stage("BtfInterpolator.search", len(wi)):
+    ...     index, weights = self.neighbors(wi, wr)
+    """
+    return _Stage(name, items) if _enabled else _null
+
+
+def profiled(name: str, items: Optional[Callable[..., int]] = None):
+    """Decorator timing every call of a function as the stage `name`.
+
+    `items` is called with the arguments of the function and returns the number of processed elements.
+    """
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Stage(name, items(*args, **kwargs) if items is not None else 0):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def summary() -> dict[str, dict[str, float]]:
+    """Recorded stages: calls, items (total, mean and max per call), seconds and microseconds per item."""
+    with _lock:
+        stats = {name: list(entry) for name, entry in _stats.items()}
+    return {
+        name: {
+            "calls": calls,
+            "items": items,
+            "mean_items": items / calls,
+            "max_items": max_items,
+            "seconds": seconds,
+            "us_per_item": seconds / items * 1e6 if items else None,
+        }
+        for name, (calls, items, seconds, max_items) in sorted(stats.items())
+    }
+
+
+def report(total_seconds: Optional[float] = None) -> str:
+    """Table of the recorded stages, with their share of `total_seconds` if given."""
+    lines = [f"{'stage':40s} {'calls':>8s} {'mean items':>11s} {'seconds':>9s} {'us/item':>8s}" + ("   share" if total_seconds else "")]
+    for name, entry in summary().items():
+        per_item = f"{entry['us_per_item']:8.3f}" if entry["us_per_item"] is not None else f"{'':8s}"
+        share = f" {entry['seconds'] / total_seconds:7.1%}" if total_seconds else ""
+        lines.append(f"{name:40s} {entry['calls']:8d} {entry['mean_items']:11.0f} {entry['seconds']:9.3f} {per_item}{share}")
+    return "\n".join(lines)
+
+
+def dump(file: str | Path, **meta) -> None:
+    """Write the summary and `meta` (e.g. the total render time) as JSON."""
+    with open(file, "w") as f:
+        json.dump({"meta": meta, "stages": summary()}, f, indent=2)
+
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
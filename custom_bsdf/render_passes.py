@@ -0,0 +1,383 @@
+import os
+import re
+import resource
+import time
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import mitsuba as mi
+from tqdm import tqdm
+
+
+class RunningStats:
+    """Per-pixel running mean and variance of images rendered in passes.
+
+    Each pass is the mean of `weight` samples per pixel, over the full image or a crop window of it.
+    The passes are combined with the weighted incremental algorithm (West, 1979), so that only the
+    accumulators are kept in memory and passes of different sizes can be mixed.
+
+    Inputs
+    ------
+    shape : tuple
+        Shape of the images (H, W, C).
+    """
+
+    def __init__(self, shape: tuple[int, ...]) -> None:
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)  # sum of weight * (pass mean - mean)^2
+        self.weight = np.zeros(shape[:2] + (1,), dtype=np.int64)  # samples accumulated per pixel
+        self._count = np.zeros(shape[:2] + (1,), dtype=np.int64)  # passes accumulated per pixel
+        self.passes = 0  # passes accumulated in total
+
+    def add(self, image: np.ndarray, weight: int, offset: tuple[int, int] = (0, 0)) -> None:
+        """Accumulate the image of a pass that averages `weight` samples per pixel.
+
+        The image may cover a crop window starting at pixel `offset` (y, x).
+        """
+        image = np.asarray(image, dtype=np.float64)
+        y, x = offset
+        h, w = image.shape[:2]
+        if y < 0 or x < 0 or y + h > self.mean.shape[0] or x + w > self.mean.shape[1] or image.shape[2:] != self.mean.shape[2:]:
+            raise ValueError(f"image of shape {image.shape} at {offset} does not fit into {self.mean.shape}.")
+        window = np.s_[y : y + h, x : x + w]
+        mean, m2, total = self.mean[window], self._m2[window], self.weight[window]  # views
+        total += weight
+        self._count[window] += 1
+        self.passes += 1
+        delta = image - mean
+        mean += delta * (weight / total)
+        delta *= image - mean
+        delta *= weight
+        m2 += delta
+
+    @property
+    def variance(self) -> np.ndarray:
+        """Per-pixel variance of a single sample, estimated from the spread of the passes (0 before the second pass).
+
+        A pass averaging n samples has the variance sigma^2 / n, so sum(n_i * (m_i - mean)^2) / (passes - 1) estimates sigma^2.
+        """
+        return self._m2 / np.maximum(self._count - 1, 1)
+
+    @property
+    def std_error(self) -> np.ndarray:
+        """Per-pixel standard error of the mean."""
+        return np.sqrt(self.variance / np.maximum(self.weight, 1))
+
+    def relative_error(self, epsilon: float = 0.01) -> np.ndarray:
+        """Per-pixel relative standard error (H, W), averaged over the channels, inf before the second pass.
+
+        `epsilon` is added to the mean, so that dark pixels do not dominate.
+        """
+        error = np.sqrt(np.mean(self.std_error**2, axis=-1)) / (np.mean(self.mean, axis=-1) + epsilon)
+        return np.where(self._count[..., 0] < 2, np.inf, error)
+
+    def save(self, file: str | Path, **meta) -> None:
+        """Write the accumulators (and `meta` values) to an `.npz` file, replacing it atomically."""
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, mean=self.mean, m2=self._m2, weight=self.weight, count=self._count, passes=self.passes, **meta)
+        os.replace(tmp, file)
+
+    @classmethod
+    def load(cls, file: str | Path) -> tuple["RunningStats", dict]:
+        """Read the accumulators written by `save`, and the `meta` values."""
+        fields = ("mean", "m2", "weight", "count", "passes")
+        with np.load(file) as data:
+            stats = cls(data["mean"].shape)
+            stats.mean[...] = data["mean"]
+            stats._m2[...] = data["m2"]
+            stats.weight[...] = data["weight"]
+            stats._count[...] = data["count"]
+            stats.passes = int(data["passes"])
+            meta = {key: data[key] for key in data.files if key not in fields}
+        return stats, meta
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes (since the last `reset_peak_rss`, on Linux)."""
+    try:
+        with open("/proc/self/status") as f:
+            return int(re.search(r"VmHWM:\s+(\d+)", f.read()).group(1)) * 1024
+    except (OSError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB on Linux
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes (0 if unknown)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size to the current one (Linux >= 4.0). Returns False if not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def render_passes(
+    scene: mi.Scene,
+    spp: int,
+    sample_per_pass: Optional[int] = None,
+    memory_budget: Optional[int] = None,
+    checkpoint: str | Path | None = None,
+    tag: str = "",
+    sensor: int | mi.Sensor = 0,
+    progress: bool = True,
+) -> tuple[RunningStats, list[dict]]:
+    """Render `spp` samples per pixel in passes, accumulating the running mean and variance in place.
+
+    Pass i is rendered with seed i, so the result does not depend on whether the render was resumed.
+
+    Parameters
+    ----------
+    scene : mi.Scene
+        Scene to render.
+    spp : int
+        Total number of samples per pixel.
+    sample_per_pass : int, optional
+        Samples per pixel of each pass (the last pass renders the remainder). If None, it is chosen
+        from `memory_budget`, or all samples are rendered in one pass.
+    memory_budget : int, optional
+        Peak resident memory of the process in bytes. The first pass renders 1 spp to measure the
+        memory per sample, and the following passes are as large as fit into the budget.
+    checkpoint : str or Path, optional
+        `.npz` file to which the accumulators are saved after each pass. If it exists, the render
+        resumes from it. It is kept after the render, delete it to start over. A checkpoint of
+        another film size, spp, mode (`render_adaptive`) or `tag` is rejected with a ValueError.
+    tag : str
+        Identifies the scene in the checkpoint, e.g. its file name or a hash of its description.
+    sensor : int or mi.Sensor
+        Sensor to render.
+    progress : bool
+        Show a progress bar and log each pass.
+
+    Returns
+    -------
+    stats : RunningStats
+        Accumulated mean and variance.
+    log : list of dict
+        Per pass: pass index, seed, spp, seconds and peak RSS in MB.
+    """
+    if isinstance(sensor, int):
+        sensor = scene.sensors()[sensor]
+    width, height = (int(size) for size in sensor.film().crop_size())
+    meta = {"mode": "passes", "tag": tag, "spp": spp}
+
+    stats = None
+    if checkpoint is not None and Path(checkpoint).exists():
+        stats = load_checkpoint(checkpoint, (height, width), **meta)
+    if sample_per_pass is None and memory_budget is None:
+        sample_per_pass = spp
+
+    log = []
+    done = 0 if stats is None else int(stats.weight.min())
+    bar = tqdm(total=spp, initial=done, unit="spp", disable=not progress)
+    while done < spp:
+        calibrate = sample_per_pass is None
+        n = 1 if calibrate else min(sample_per_pass, spp - done)
+        seed = 0 if stats is None else stats.passes
+        baseline = current_rss()
+        reset_peak_rss()  # otherwise the peak since the start, which overestimates the pass
+        start = time.perf_counter()
+        image = np.asarray(mi.render(scene, sensor=sensor, seed=seed, spp=n))
+        seconds = time.perf_counter() - start
+        peak = peak_rss()
+
+        if stats is None:
+            stats = RunningStats(image.shape)
+        stats.add(image, n)
+        done += n
+        if checkpoint is not None:
+            stats.save(checkpoint, **meta)
+
+        if calibrate:
+            # Memory grows with the number of lanes (pixels x spp), the 1 spp pass includes the fixed overhead
+            per_sample = max(peak - baseline, 1)
+            sample_per_pass = max(1, int((memory_budget - baseline) // per_sample))
+            if progress:
+                tqdm.write(f"Memory per sample ~{per_sample / 2**20:.0f} MB, rendering {sample_per_pass} spp per pass")
+
+        record = {"pass": stats.passes - 1, "seed": seed, "spp": n, "seconds": seconds, "peak_rss_mb": peak / 2**20}
+        log.append(record)
+        bar.update(n)
+        if progress:
+            tqdm.write(f"Pass {record['pass']}: {n} spp in {seconds:.2f} s, peak RSS {record['peak_rss_mb']:.0f} MB")
+    bar.close()
+    return stats, log
+
+
+def render_adaptive(
+    scene: mi.Scene,
+    target_error: float = 0.02,
+    time_budget: Optional[float] = None,
+    max_spp: int = 4096,
+    sample_per_pass: int = 4,
+    tile_size: Optional[int] = None,
+    checkpoint: str | Path | None = None,
+    tag: str = "",
+    sensor: int | mi.Sensor = 0,
+    progress: bool = True,
+) -> tuple[RunningStats, list[dict]]:
+    """Render passes until the relative error reaches `target_error`, the time budget is spent or `max_spp` is reached.
+
+    The error of a region is the mean relative standard error of its pixels (see `RunningStats.relative_error`).
+    Without `tile_size`, full frames are rendered until the error of the image is below the target.
+    With `tile_size`, the image is divided into tiles after the first two passes, and the following
+    passes only render the tiles above the target, highest error first, through the crop window of the
+    film. Since the error falls with 1 / sqrt(spp), a tile pass renders the samples predicted to reach
+    the target, but at most as many as the tile already has, and at most as many lanes as a full frame
+    pass. Each crop is extended by the radius of the reconstruction filter, so that the tile borders
+    receive the same samples as in a full frame.
+
+    Dr.Jit compiles a kernel for every crop window (the window is a constant of the kernel), so the
+    first passes over the tiles are slower. The kernels are cached on disk and reused by later renders
+    of the same scene, and larger tiles need fewer of them.
+
+    Parameters
+    ----------
+    scene : mi.Scene
+        Scene to render.
+    target_error : float
+        Relative standard error at which a region is converged.
+    time_budget : float, optional
+        Stop after this many seconds (checked between crop renders). The first round is always rendered.
+    max_spp : int
+        Maximum number of samples per pixel.
+    sample_per_pass : int
+        Samples per pixel of the full frame passes, and the minimum of the tile passes.
+    tile_size : int, optional
+        Size of the tiles in pixels. If None, only full frames are rendered.
+    checkpoint : str or Path, optional
+        `.npz` file to which the accumulators are saved after each round, see `render_passes`.
+    tag : str
+        Identifies the scene in the checkpoint, see `render_passes`.
+    sensor : int or mi.Sensor
+        Sensor to render. Its crop window is restored afterwards.
+    progress : bool
+        Log each round.
+
+    Returns
+    -------
+    stats : RunningStats
+        Accumulated mean and variance, `stats.weight` holds the samples per pixel.
+    log : list of dict
+        Per round: round index, number of rendered regions, mean relative error, mean spp and elapsed seconds.
+    """
+    if isinstance(sensor, int):
+        sensor = scene.sensors()[sensor]
+    width, height = (int(size) for size in sensor.film().crop_size())
+    frame = (0, 0, height, width)
+    tiles = [frame] if tile_size is None else split_tiles(height, width, tile_size)
+
+    meta = {"mode": "adaptive", "tag": tag}
+
+    stats = None
+    if checkpoint is not None and Path(checkpoint).exists():
+        stats = load_checkpoint(checkpoint, (height, width), **meta)
+    log = []
+    start = time.perf_counter()
+    while True:
+        # At least one round (unless resumed), so that there is an image to return
+        if stats is not None and time_budget is not None and time.perf_counter() - start >= time_budget:
+            break
+        if stats is None or stats.passes < 2:
+            regions = [(sample_per_pass, frame)]  # variance estimate
+        else:
+            error = stats.relative_error()
+            regions = []
+            for y, x, h, w in tiles:
+                tile_error = float(np.mean(error[y : y + h, x : x + w]))
+                done = int(stats.weight[y : y + h, x : x + w].max())
+                if tile_error <= target_error or done >= max_spp:
+                    continue
+                # Predicted remainder, at most doubling the samples as the estimate is noisy
+                n = int(np.ceil(done * ((tile_error / target_error) ** 2 - 1)))
+                n = min(max(n, sample_per_pass), max(done, sample_per_pass), max_spp - done, sample_per_pass * (height * width) // (h * w))
+                regions.append((tile_error, n, (y, x, h, w)))
+            if len(regions) == len(tiles) and len(tiles) > 1:
+                regions = [(np.inf, min(n for _, n, _ in regions), frame)]  # one render instead of one per tile
+            # Highest error first, so that the time budget is spent where it matters
+            regions = [(n, region) for _, n, region in sorted(regions, reverse=True)]
+        if not regions:
+            break
+
+        for n, (y, x, h, w) in regions:
+            if log and time_budget is not None and time.perf_counter() - start >= time_budget:
+                break
+            image = render_crop(scene, (y, x, h, w), n, seed=0 if stats is None else stats.passes, sensor=sensor)
+            if stats is None:
+                stats = RunningStats(image.shape)
+            stats.add(image, n, offset=(y, x))
+        if checkpoint is not None:
+            stats.save(checkpoint, **meta)
+
+        error = stats.relative_error()
+        record = {
+            "round": len(log),
+            "regions": len(regions),
+            "error": float(np.mean(error)),
+            "spp": float(np.mean(stats.weight)),
+            "seconds": time.perf_counter() - start,
+        }
+        log.append(record)
+        if progress:
+            tqdm.write(f"Round {record['round']}: {record['regions']} regions, error {record['error']:.4f}, {record['spp']:.1f} spp on average, {record['seconds']:.1f} s")
+    return stats, log
+
+
+def load_checkpoint(file: str | Path, shape: tuple[int, int], **expected) -> RunningStats:
+    """Read a checkpoint of `render_passes` or `render_adaptive`, raising a ValueError if it belongs to another render.
+
+    `shape` is the (H, W) of the film, `expected` the meta values it was saved with. Values missing
+    from the file (checkpoints of earlier versions) are not checked.
+    """
+    stats, meta = RunningStats.load(file)
+    if stats.mean.shape[:2] != tuple(shape):
+        height, width = stats.mean.shape[:2]
+        raise ValueError(f"The checkpoint {file} was rendered for a {width}x{height} film, not {shape[1]}x{shape[0]}.")
+    for key, value in expected.items():
+        if key in meta and meta[key].item() != value:
+            raise ValueError(f"The checkpoint {file} was rendered for {key}={meta[key].item()!r}, not {value!r}. Delete it to start over.")
+    return stats
+
+
+def split_tiles(height: int, width: int, tile_size: int) -> list[tuple[int, int, int, int]]:
+    """Windows (y, x, h, w) of the tiles covering an image, row by row."""
+    return [(y, x, min(tile_size, height - y), min(tile_size, width - x)) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+
+def render_crop(scene: mi.Scene, window: tuple[int, int, int, int], spp: int, seed: int = 0, sensor: int | mi.Sensor = 0) -> np.ndarray:
+    """Render the window (y, x, h, w) of the image through the crop window of the film.
+
+    The window is relative to the current crop window of the film, which is restored afterwards.
+    The rendered crop is extended by the radius of the reconstruction filter and cut back, so that
+    the window receives the same samples as in a full frame.
+    """
+    if isinstance(sensor, int):
+        sensor = scene.sensors()[sensor]
+    film = sensor.film()
+    params = mi.traverse(sensor)
+    crop_offset, crop_size = mi.ScalarPoint2u(film.crop_offset()), mi.ScalarVector2u(film.crop_size())
+    border = int(np.ceil(film.rfilter().radius()))
+    y, x, h, w = window
+    y0, x0 = max(y - border, 0), max(x - border, 0)
+    y1, x1 = min(y + h + border, int(crop_size[1])), min(x + w + border, int(crop_size[0]))
+    params["film.crop_offset"] = mi.ScalarPoint2u(crop_offset[0] + x0, crop_offset[1] + y0)
+    params["film.crop_size"] = mi.ScalarVector2u(x1 - x0, y1 - y0)
+    params.update()
+    try:
+        image = np.asarray(mi.render(scene, sensor=sensor, seed=seed, spp=spp))
+    finally:
+        params["film.crop_offset"] = crop_offset
+        params["film.crop_size"] = crop_size
+        params.update()
+    return image[y - y0 : y - y0 + h, x - x0 : x - x0 + w]
@@ -0,0 +1,90 @@
+from typing import Callable
+import numpy as np
+import mitsuba as mi
+import drjit as dr
+
+
+class TabulatedSampling:
+    """Importance sampling of outgoing directions from a tabulated, view-dependent distribution.
+
+    Both hemispheres are divided into cells of the equal-area square parameterization of
+    `mi.warp.square_to_uniform_hemisphere`. For every view cell, a discrete distribution over the
+    `resolution` x `resolution` light cells is stored. A direction is sampled by picking a light cell
+    from the distribution of the view cell containing `wi`, followed by a uniform position within
+    the cell, so the pdf is piecewise constant per (view cell, light cell) pair.
+
+    Inputs
+    ------
+    values : ndarray (Rv, Rv, R, R)
+        Non-negative importance of each (view cell, light cell) pair, e.g. the reflectance at the cell
+        centers. View cells whose values sum to zero fall back to a uniform distribution.
+
+    Use `TabulatedSampling.from_function` to tabulate a reflectance function.
+    """
+
+    def __init__(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 4 or values.shape[0] != values.shape[1] or values.shape[2] != values.shape[3]:
+            raise ValueError("values must have shape (Rv,Rv,R,R).")
+        if np.any(values < 0) or not np.all(np.isfinite(values)):
+            raise ValueError("values must be finite and non-negative.")
+        self.view_resolution = values.shape[0]
+        self.resolution = values.shape[2]
+
+        pmf = values.reshape(self.view_resolution**2, self.resolution**2)
+        total = pmf.sum(axis=-1, keepdims=True)
+        pmf = np.where(total > 0, pmf / np.where(total > 0, total, 1.0), 1.0 / pmf.shape[-1])
+        cdf = np.cumsum(pmf, axis=-1)
+        cdf[:, -1] = 1.0
+        self.pmf = pmf.astype(np.float32)  # (Rv * Rv, R * R)
+        self._pmf = mi.Float(self.pmf.reshape(-1))
+        self._cdf = mi.Float(cdf.astype(np.float32).reshape(-1))
+
+    @classmethod
+    def from_function(cls, f: Callable[[np.ndarray, np.ndarray], np.ndarray], resolution: int = 32, view_resolution: int = 16) -> "TabulatedSampling":
+        """Tabulate `f(wo, wi) -> (M,)` at the centers of all (view cell, light cell) pairs.
+
+        `wo` and `wi` are (M, 3) light and view directions in the local frame.
+        """
+        view = cell_centers(view_resolution)  # (Rv * Rv, 3)
+        light = cell_centers(resolution)  # (R * R, 3)
+        values = np.empty((len(view), len(light)), dtype=np.float64)
+        for i, wi in enumerate(view):
+            values[i] = f(light, np.broadcast_to(wi, light.shape))
+        return cls(values.reshape(view_resolution, view_resolution, resolution, resolution))
+
+    def _view_offset(self, wi: mi.Vector3f) -> mi.UInt32:
+        r = self.view_resolution
+        p = mi.warp.uniform_hemisphere_to_square(wi)
+        cell = dr.minimum(mi.UInt32(p.x * r), r - 1) * r + dr.minimum(mi.UInt32(p.y * r), r - 1)
+        return cell * (self.resolution**2)
+
+    def sample(self, wi: mi.Vector3f, sample: mi.Point2f, active: mi.Mask = True) -> mi.Vector3f:
+        """Sample an outgoing direction for the incident direction `wi` (both in the local frame)."""
+        r = self.resolution
+        offset = self._view_offset(wi)
+        cell = dr.binary_search(0, r * r - 1, lambda i: dr.gather(mi.Float, self._cdf, offset + i, active) < sample.x)
+        cdf_hi = dr.gather(mi.Float, self._cdf, offset + cell, active)
+        pmf = dr.gather(mi.Float, self._pmf, offset + cell, active)
+
+        # Reuse the position of sample.x within the cell's cdf interval for the x offset in the cell
+        x = dr.clip((sample.x - (cdf_hi - pmf)) / dr.maximum(pmf, 1e-20), 0.0, 1.0)
+        p = mi.Point2f((mi.Float(cell // r) + x) / r, (mi.Float(cell % r) + sample.y) / r)
+        return mi.warp.square_to_uniform_hemisphere(p)
+
+    def pdf(self, wi: mi.Vector3f, wo: mi.Vector3f, active: mi.Mask = True) -> mi.Float:
+        """Solid angle density of sampling `wo` for the incident direction `wi`."""
+        r = self.resolution
+        p = mi.warp.uniform_hemisphere_to_square(wo)
+        cell = dr.minimum(mi.UInt32(p.x * r), r - 1) * r + dr.minimum(mi.UInt32(p.y * r), r - 1)
+        pmf = dr.gather(mi.Float, self._pmf, self._view_offset(wi) + cell, active)
+        # Each cell covers 2 pi / R^2 sr
+        return dr.select(active & (mi.Frame3f.cos_theta(wo) > 0.0), pmf * (r * r * dr.inv_two_pi), 0.0)
+
+
+def cell_centers(resolution: int) -> np.ndarray:
+    """Directions (R * R, 3) at the cell centers of the equal-area hemisphere parameterization, in cell order."""
+    s = (np.arange(resolution, dtype=np.float32) + 0.5) / resolution
+    u, v = np.meshgrid(s, s, indexing="ij")
+    w = mi.warp.square_to_uniform_hemisphere(mi.Point2f(u.reshape(-1), v.reshape(-1)))
+    return np.asarray(w).T.copy()
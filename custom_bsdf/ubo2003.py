@@ -3,15 +3,24 @@ import os
 os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 
 from pathlib import Path
+import hashlib
+import json
+import multiprocessing
 import re
+import struct
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
 from typing import Optional
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo
 from tqdm import tqdm
 import numpy as np
 import cv2
 
+from . import profiling
+
 
 def parse_keyed_number(text: str, key: str) -> float:
     """Extract a float value following a given key from a text string.
@@ -59,6 +68,97 @@ def parse_keyed_number(text: str, key: str) -> float:
     return float(matches[0])
 
 
+def cache_key(file: str | Path) -> str:
+    """Return a short hash (16 hex digits) identifying a file by its absolute path, modification time and size.
+
+    The value differs between machines and changes when the file is modified.
+
+    Examples
+    --------
+    >>> len(cache_key("UBO2003/UBO_IMPALLA256.zip"))
+    16
+    """
+    path = Path(file).resolve()
+    stat = path.stat()
+    text = f"{path}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def cache_base(file: str | Path, cache_dir: str | Path) -> Path:
+    """Common path prefix (without suffix) of the cache files of `file` in `cache_dir`."""
+    return Path(cache_dir) / f"{Path(file).stem}-{cache_key(file)}"
+
+
+class ZipMemberReader:
+    """Thread-safe reader of zip file members without a global lock.
+
+    The data offsets of the members are resolved from their local headers once, and the raw bytes
+    are read with `os.pread` on a shared file descriptor, so any number of threads can read (and
+    inflate) members concurrently. Encrypted members, compression methods other than stored /
+    deflated, and platforms without `os.pread` fall back to one `ZipFile` handle per thread.
+
+    Parameters
+    ----------
+    file : str or Path
+        Path to the zip file.
+    infolist : list of ZipInfo, optional
+        Members of the zip file, if already known from an open `ZipFile`.
+    """
+
+    def __init__(self, file: str | Path, infolist: Optional[list[ZipInfo]] = None) -> None:
+        self.file = str(file)
+        if infolist is None:
+            with ZipFile(self.file) as zfile:
+                infolist = zfile.infolist()
+        self._infos = {info.filename: info for info in infolist}
+        self._offsets: dict[str, int] = {}
+        self._local = threading.local()
+        self._fd: Optional[int] = os.open(self.file, os.O_RDONLY | getattr(os, "O_BINARY", 0)) if hasattr(os, "pread") else None
+
+    def read(self, name: str) -> bytes:
+        info = self._infos[name]
+        if self._fd is None or info.compress_type not in (ZIP_STORED, ZIP_DEFLATED) or info.flag_bits & 0x1:
+            return self._zipfile().read(name)
+
+        offset = self._offsets.get(name)
+        if offset is None:
+            header = os.pread(self._fd, 30, info.header_offset)
+            if header[:4] != b"PK\x03\x04":
+                raise BadZipFile(f"Bad local file header of {name}")
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            offset = self._offsets[name] = info.header_offset + 30 + name_len + extra_len
+
+        data = os.pread(self._fd, info.compress_size, offset)
+        if info.compress_type == ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        if zlib.crc32(data) != info.CRC:
+            raise BadZipFile(f"Bad CRC-32 of {name}")
+        return data
+
+    def _zipfile(self) -> ZipFile:
+        zfile = getattr(self._local, "zfile", None)
+        if zfile is None:
+            zfile = self._local.zfile = ZipFile(self.file)
+        return zfile
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self) -> None:
+        self.close()
+
+
+def decode_image(data: bytes, name: str = "") -> np.ndarray:
+    """Decode an encoded image file (bytes) into a BGR(A) array."""
+    arr = np.frombuffer(data, dtype=np.uint8)
+    img_bgr = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED | cv2.IMREAD_COLOR_BGR)
+    if img_bgr is None:
+        raise ValueError(f"Failed to decode image: {name}")
+    return img_bgr
+
+
 class Ubo2003:
     """Load BTF images and angles from a UBO2003 zip file.
 
@@ -96,36 +196,104 @@ class Ubo2003:
     >>> btf_data.preload()  # or accessing btf_data.images implicitly triggers preload
     >>> for angle, img in zip(btf_data.angles, btf_data.images):
     ...     # process img ang angle...
+
+    Cache the decoded images on disk. The first preload writes a raw `.npy` file
+    into `cache_dir`, and later instances open it via `np.memmap` instead of decoding the zip.
+
+    >>> btf_data = Ubo2003("UBO2003/UBO_IMPALLA256.zip", cache_dir="cache")
+    >>> btf_data.images  # decoded once, memory-mapped afterwards
+
+    Decode images lazily and keep the most recently used ones in memory. The object itself can be
+    passed to `BtfInterpolator` in place of `images`, which then only decodes the angular samples
+    that are actually looked up.
+
+    >>> btf_data = Ubo2003("UBO2003/UBO_IMPALLA256.zip", max_cache_bytes=512 * 2**20)
+    >>> interp = BtfInterpolator(btf_data, btf_data.angles)
+    >>> btf_data.cache_info()
+    {'hits': 0, 'misses': 0, 'evictions': 0, 'images': 0, 'bytes': 0, 'max_bytes': 536870912}
     """
 
-    def __init__(self, file_zip: str | Path, preload: bool = False) -> None:
+    def __init__(self, file_zip: str | Path, preload: bool = False, cache_dir: str | Path | None = None, max_cache_bytes: Optional[int] = None) -> None:
         self.zfile = ZipFile(file_zip)
-        self._zip_lock = threading.Lock()  # Lock ensures ZipFile.read is thread-safe during parallel preload
+        self._reader = ZipMemberReader(file_zip, self.zfile.infolist())  # lock-free parallel reads
+
+        # Cache files are keyed by the zip path, mtime and size, so a modified zip is never served stale data
+        self._cache_base: Optional[Path] = None
+        if cache_dir is not None:
+            self._cache_base = cache_base(file_zip, cache_dir)
 
         self.angle_file_dict: dict[tuple[float, float, float, float], str] = {}
-        for name in self.zfile.namelist():
-            basename = os.path.basename(name)
-            ext = os.path.splitext(basename)[1].lower()
-            if ext not in [".jpg", ".jpeg", ".png", ".exr", ".hdr"]:
-                continue
-            tl = parse_keyed_number(basename, "tl")
-            pl = parse_keyed_number(basename, "pl")
-            tv = parse_keyed_number(basename, "tv")
-            pv = parse_keyed_number(basename, "pv")
-            angle = (tl, pl, tv, pv)
-            self.angle_file_dict[angle] = name
+        with profiling.stage("Ubo2003.index"):
+            if not self._load_cached_index():
+                for name in self.zfile.namelist():
+                    basename = os.path.basename(name)
+                    ext = os.path.splitext(basename)[1].lower()
+                    if ext not in [".jpg", ".jpeg", ".png", ".exr", ".hdr"]:
+                        continue
+                    tl = parse_keyed_number(basename, "tl")
+                    pl = parse_keyed_number(basename, "pl")
+                    tv = parse_keyed_number(basename, "tv")
+                    pv = parse_keyed_number(basename, "pv")
+                    angle = (tl, pl, tv, pv)
+                    self.angle_file_dict[angle] = name
+                self._save_cached_index()
+
+        # Index structures, so that lookups by angle or file never scan the lists
+        self._angles = list(self.angle_file_dict.keys())
+        self._files = list(self.angle_file_dict.values())
+        self._angle_index = {angle: i for i, angle in enumerate(self._angles)}
+        self._file_index = {name: i for i, name in enumerate(self._files)}
+        self.angle_array = np.array(self._angles, dtype=np.float64).reshape(-1, 4)  # (N, 4) tl, pl, tv, pv
+        self.angle_array.flags.writeable = False
 
         self._images: Optional[np.ndarray] = None
+        self._sample: Optional[np.ndarray] = None  # First image, read to determine the shape
+
+        # LRU cache of decoded images (image index -> image) used while the images are not preloaded
+        self.max_cache_bytes = max_cache_bytes
+        self._lru: OrderedDict[int, np.ndarray] = OrderedDict()
+        self._lru_bytes = 0
+        self._lru_lock = threading.Lock()
+        self._hits = self._misses = self._evictions = 0
         if preload:
             self.preload()
 
+    @property
+    def cache_files(self) -> Optional[tuple[Path, Path]]:
+        """Paths of the (index json, images npy) cache files, or None if caching is disabled."""
+        if self._cache_base is None:
+            return None
+        return Path(f"{self._cache_base}.json"), Path(f"{self._cache_base}.npy")
+
+    def _load_cached_index(self) -> bool:
+        if self.cache_files is None or not self.cache_files[0].exists():
+            return False
+        with open(self.cache_files[0]) as f:
+            index = json.load(f)
+        for angle, name in zip(index["angles"], index["files"]):
+            self.angle_file_dict[tuple(angle)] = name
+        return True
+
+    def _save_cached_index(self) -> None:
+        if self.cache_files is None:
+            return
+        index = {"angles": list(self.angle_file_dict.keys()), "files": list(self.angle_file_dict.values())}
+        file_json = self.cache_files[0]
+        file_json.parent.mkdir(parents=True, exist_ok=True)
+        file_tmp = file_json.with_suffix(f".json.{os.getpid()}.tmp")
+        with open(file_tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(file_tmp, file_json)  # atomic, concurrent jobs never see a partial file
+
     @property
     def angles(self) -> list[tuple[float, float, float, float]]:
-        return list(self.angle_file_dict.keys())
+        """Angles (tl, pl, tv, pv) of the images. The list is shared, do not modify it."""
+        return self._angles
 
     @property
     def files(self) -> list[str]:
-        return list(self.angle_file_dict.values())
+        """Member names of the images in the zip file. The list is shared, do not modify it."""
+        return self._files
 
     @property
     def images(self) -> np.ndarray:
@@ -136,21 +304,110 @@ class Ubo2003:
             return self._images
 
     def _read_image(self, filepath: str) -> np.ndarray:
-        with self._zip_lock:
-            data = self.zfile.read(filepath)  # bytes
-        arr = np.frombuffer(data, dtype=np.uint8)
-        img_bgr = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED | cv2.IMREAD_COLOR_BGR)
-        if img_bgr is None:
-            raise ValueError(f"Failed to decode image: {filepath}")
-        return img_bgr
+        return decode_image(self._reader.read(filepath), filepath)
 
     def get_image(self, filepath: str) -> np.ndarray:
         if self._images is not None:
-            index = self.files.index(filepath)
-            return self._images[index]
+            return self._images[self._file_index[filepath]]
+        elif self.max_cache_bytes is not None:
+            return self.image(self._file_index[filepath])
         else:
             return self._read_image(filepath)
 
+    def image(self, index: int) -> np.ndarray:
+        """Return the image with index `index` (in the order of `angles`).
+
+        Without preloading, the image is decoded on demand and kept in the LRU cache if `max_cache_bytes` is set.
+        """
+        if self._images is not None:
+            return self._images[index]
+        index = int(index)
+        with self._lru_lock:
+            img = self._lru.get(index)
+            if img is not None:
+                self._lru.move_to_end(index)
+                self._hits += 1
+                return img
+            self._misses += 1
+        img = self._read_image(self.files[index])
+        self._cache_put(index, img)
+        return img
+
+    def _cache_put(self, index: int, img: np.ndarray) -> None:
+        if self.max_cache_bytes is None or img.nbytes > self.max_cache_bytes:
+            return
+        with self._lru_lock:
+            if index in self._lru:  # decoded concurrently by another thread
+                return
+            while self._lru and self._lru_bytes + img.nbytes > self.max_cache_bytes:
+                _, old = self._lru.popitem(last=False)
+                self._lru_bytes -= old.nbytes
+                self._evictions += 1
+            self._lru[index] = img
+            self._lru_bytes += img.nbytes
+
+    @profiling.profiled("Ubo2003.gather", lambda self, index, *args, **kwargs: np.size(index))
+    def gather(self, index, y, x, max_workers: int | None = None) -> np.ndarray:
+        """Return the texels `images[index, y, x]` (broadcast shape + (C,)) without preloading all images.
+
+        Only the images referenced by `index` are read: cached images are served from the LRU cache,
+        the missing ones are decoded in parallel (`max_workers` threads) and added to it.
+        """
+        index, y, x = np.broadcast_arrays(np.asarray(index, dtype=np.int64), np.asarray(y), np.asarray(x))
+        shape = index.shape
+        index, y, x = index.reshape(-1), y.reshape(-1), x.reshape(-1)
+        if self._images is not None:
+            return self._images[index, y, x].reshape(shape + (-1,))
+
+        # Group the lookups by image
+        order = np.argsort(index, kind="stable")
+        used, start, count = np.unique(index[order], return_index=True, return_counts=True)
+        groups = {int(i): order[s : s + n] for i, s, n in zip(used, start, count)}
+
+        sample = self._sample_image()
+        out = np.empty((len(index), sample.shape[-1]), dtype=sample.dtype)
+
+        missing = []
+        with self._lru_lock:
+            for i, sel in groups.items():
+                img = self._lru.get(i)
+                if img is None:
+                    missing.append(i)
+                    continue
+                self._lru.move_to_end(i)
+                out[sel] = img[y[sel], x[sel]]
+            self._hits += len(groups) - len(missing)
+            self._misses += len(missing)
+
+        if missing:
+            files = self.files
+            with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                # The texels are copied as soon as an image is decoded, so the cache may be smaller than the lookup
+                for i, img in zip(missing, ex.map(lambda i: self._read_image(files[i]), missing)):
+                    sel = groups[i]
+                    out[sel] = img[y[sel], x[sel]]
+                    self._cache_put(i, img)
+        return out.reshape(shape + (-1,))
+
+    def cache_info(self) -> dict[str, int | None]:
+        """Hit, miss and eviction counters and the current size of the LRU image cache."""
+        with self._lru_lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "images": len(self._lru),
+                "bytes": self._lru_bytes,
+                "max_bytes": self.max_cache_bytes,
+            }
+
+    def clear_cache(self) -> None:
+        """Drop all images from the LRU cache and reset the counters."""
+        with self._lru_lock:
+            self._lru.clear()
+            self._lru_bytes = 0
+            self._hits = self._misses = self._evictions = 0
+
     def angle_to_image(self, tl: float, pl: float, tv: float, pv: float) -> np.ndarray:
         key = (tl, pl, tv, pv)
         file = self.angle_file_dict[key]
@@ -160,18 +417,166 @@ class Ubo2003:
         """Alias for angle_to_image"""
         return self.angle_to_image(tl, pl, tv, pv)
 
-    def preload(self, max_workers: int | None = None, show_progress: bool = False):
-        files = list(self.angle_file_dict.values())
+    def angle_to_index(self, tl: float, pl: float, tv: float, pv: float) -> int:
+        """Index of the image with the given angles, in the order of `angles`."""
+        return self._angle_index[(tl, pl, tv, pv)]
 
-        sample_img = self._read_image(files[0])
-        h, w, c = sample_img.shape
-        self._images = np.empty((len(files), h, w, c), dtype=sample_img.dtype)
+    def angles_to_indices(self, angles: np.ndarray) -> np.ndarray:
+        """Indices (B,) of the images with the angles (B, 4).
+
+        Raises KeyError if an angle is not in the dataset.
+        """
+        angles = np.asarray(angles, dtype=np.float64).reshape(-1, 4)
+        return np.fromiter((self._angle_index[tuple(a)] for a in angles.tolist()), dtype=np.int64, count=len(angles))
+
+    def angles_to_images(self, angles: np.ndarray) -> np.ndarray:
+        """Stacked images (B, H, W, C) of the angles (B, 4).
+
+        The images are taken from `images` if preloaded, otherwise they are decoded (in parallel).
+        """
+        return self.indices_to_images(self.angles_to_indices(angles))
+
+    def indices_to_images(self, index: np.ndarray, max_workers: int | None = None) -> np.ndarray:
+        """Stacked images (B, H, W, C) by an index array (B,)."""
+        index = np.asarray(index, dtype=np.int64).reshape(-1)
+        if self._images is not None:
+            return self._images[index]
+        sample = self._sample_image()
+        out = np.empty((len(index),) + sample.shape, dtype=sample.dtype)
+
+        def decode(b):
+            out[b] = self.image(index[b])
 
-        pbar = tqdm(total=len(files), disable=not show_progress, desc="Ubo2003.preload")
         with ThreadPoolExecutor(max_workers=max_workers) as ex:
-            futures = {ex.submit(self._read_image, f): i for i, f in enumerate(files)}
-            for fut in as_completed(futures):
-                i = futures[fut]
-                self._images[i] = fut.result()
-                pbar.update(1)
+            list(ex.map(decode, range(len(index))))
+        return out
+
+    def _sample_image(self) -> np.ndarray:
+        if self._images is not None:
+            return self._images[0]
+        if self._sample is None:
+            self._sample = self._read_image(self.files[0])
+        return self._sample
+
+    @property
+    def shape(self) -> tuple[int, int, int, int]:
+        """Shape (N, H, W, C) of the image stack, without preloading it."""
+        h, w, c = self._sample_image().shape
+        return (len(self._files), h, w, c)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._sample_image().dtype
+
+    @profiling.profiled("Ubo2003.preload", lambda self, *args, **kwargs: len(self.files))
+    def preload(self, max_workers: int | None = None, show_progress: bool = False, out: Optional[np.ndarray] = None, backend: str = "thread"):
+        """Decode all images into memory.
+
+        If `out` is given (e.g. an array backed by shared memory), the images are written into it
+        instead of a newly allocated array, and it becomes `self.images`.
+
+        The images are read and decoded in parallel by `max_workers` workers:
+          "thread"  : threads of this process. Reading and decoding release the GIL.
+          "process" : a pool of spawned processes, which write the images straight into the cache
+                      file, or into a temporary shared memory block that is then copied to the output.
+                      As with any spawned pool, the main module must be guarded by `if __name__ == "__main__":`.
+        """
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown backend '{backend}'. Use 'thread' or 'process'.")
+        files = self.files
+
+        if self.cache_files is not None and self.cache_files[1].exists():
+            images = np.load(self.cache_files[1], mmap_mode="r")
+            if images.shape == self.shape:
+                if out is not None:
+                    out[...] = images
+                    images = out
+                self._images = images
+                return
+
+        shape = self.shape
+        write_cache = self.cache_files is not None
+        if out is not None:
+            self._images = out
+        elif write_cache:
+            # Decode straight into the cache file, then publish it under its final name
+            file_tmp = self.cache_files[1].with_suffix(f".npy.{os.getpid()}.tmp")
+            self._images = np.lib.format.open_memmap(file_tmp, mode="w+", dtype=self.dtype, shape=shape)
+        else:
+            self._images = np.empty(shape, dtype=self.dtype)
+
+        pbar = tqdm(total=len(files), disable=not show_progress, desc="Ubo2003.preload")
+        if backend == "thread":
+            images = self._images
+
+            def decode(i):
+                images[i] = self._read_image(files[i])
+
+            with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                for fut in as_completed([ex.submit(decode, i) for i in range(len(files))]):
+                    fut.result()
+                    pbar.update(1)
+        else:
+            self._preload_processes(files, max_workers, pbar, file_tmp if write_cache and out is None else None)
         pbar.close()
+
+        if write_cache:
+            file_npy = self.cache_files[1]
+            if out is not None:
+                file_tmp = file_npy.with_suffix(f".npy.{os.getpid()}.tmp")
+                with open(file_tmp, "wb") as f:
+                    np.save(f, out)
+            else:
+                self._images.flush()
+                del self._images
+            os.replace(file_tmp, file_npy)
+            if out is None:
+                self._images = np.load(file_npy, mmap_mode="r")
+
+    def _preload_processes(self, files: list[str], max_workers: int | None, pbar: tqdm, file_npy: Optional[Path], chunk_size: int = 64) -> None:
+        # Workers write into the (memory-mapped) cache file if there is one, otherwise into shared memory
+        shm = None
+        if file_npy is not None:
+            self._images.flush()
+            target = ("npy", str(file_npy))
+        else:
+            shm = SharedMemory(create=True, size=max(1, self._images.nbytes))
+            target = ("shm", shm.name, self._images.shape, self._images.dtype.str)
+        try:
+            chunks = [list(range(start, min(start + chunk_size, len(files)))) for start in range(0, len(files), chunk_size)]
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as ex:
+                futures = [ex.submit(_decode_into, self._reader.file, [(i, files[i]) for i in chunk], target) for chunk in chunks]
+                for fut in as_completed(futures):
+                    pbar.update(fut.result())
+            if shm is not None:
+                self._images[...] = np.ndarray(self._images.shape, dtype=self._images.dtype, buffer=shm.buf)
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+# ZipMemberReader of each zip file opened by a preload worker process
+_worker_readers: dict[str, ZipMemberReader] = {}
+
+
+def _decode_into(file_zip: str, items: list[tuple[int, str]], target: tuple) -> int:
+    """Process pool task of `Ubo2003.preload`: decode the (index, member name) items into the target array."""
+    reader = _worker_readers.get(file_zip)
+    if reader is None:
+        reader = _worker_readers[file_zip] = ZipMemberReader(file_zip)
+    if target[0] == "npy":
+        images = np.load(target[1], mmap_mode="r+")
+        for i, name in items:
+            images[i] = decode_image(reader.read(name), name)
+        images.flush()
+    else:
+        _, name_shm, shape, dtype = target
+        shm = SharedMemory(name_shm)
+        images = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        for i, name in items:
+            images[i] = decode_image(reader.read(name), name)
+        del images
+        shm.close()
+    return len(items)
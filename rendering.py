@@ -1,13 +1,19 @@
+import hashlib
 import time
-from tqdm import tqdm
+from pathlib import Path
 import numpy as np
 import mitsuba as mi
 
 mi.set_variant("llvm_ad_rgb")
 
+from custom_bsdf import profiling
 from custom_bsdf.measuredbtf import MeasuredBTF
+from custom_bsdf.path_differential import PathDifferential
+from custom_bsdf.parallel_render import render_parallel
+from custom_bsdf.render_passes import peak_rss, render_adaptive, render_passes
 
 mi.register_bsdf("measuredbtf", lambda props: MeasuredBTF(props))
+mi.register_integrator("path_differential", lambda props: PathDifferential(props))
 
 
 # Scene to render
@@ -22,31 +28,65 @@ from scenes.simple_sphere.scene import scene_dict
 # scene_dict["bsdf-matpreview"]["scale"] = 0.6
 
 
+def make_scene_dict():
+    # Called by the worker processes of the parallel rendering, which import this script again
+    return scene_dict
+
+
 def main():
     spp = 16
+    # Rendering with the measured BTF tends to use a lot of memory,
+    # so the rendering is split into several passes that are averaged in place.
+    # Set sample_per_pass, or None to choose it from the memory budget (peak RSS of the process).
     sample_per_pass = 16
-    if spp % sample_per_pass != 0:
-        raise ValueError("spp must be a multiple of sample_per_pass")
+    memory_budget_gb = 16.0
+    # The accumulated passes are saved here, so that an interrupted rendering resumes from the last pass
+    checkpoint = "output.checkpoint.npz"
+    # A checkpoint of another scene (or an edited scene_dict) is rejected instead of being mixed in
+    scene_tag = hashlib.sha1(repr(scene_dict).encode()).hexdigest()[:16]
+    # Progressive mode: if target_error is set, render until the relative error of every tile is below it
+    # (or the time budget in seconds is spent) instead of a fixed spp, which is then the maximum.
+    target_error = None  # e.g. 0.02
+    time_budget = None
+    tile_size = 64
+    # Parallel mode: if workers > 1, render the tiles (or split="seeds": parts of the samples) in worker processes
+    workers = 1
+    split = "tiles"
+
+    if workers > 1:
+        print(f"Rendering with {spp} spp in {workers} processes...")
+        img, report = render_parallel(make_scene_dict, spp, workers=workers, split=split, tile_size=tile_size, sample_per_pass=sample_per_pass)
+        print(f"Rendering finished in {report['wall_seconds'] / 60:.2f} min, parallel efficiency {report['parallel_efficiency']:.0%}.")
+        mi.util.write_bitmap("output.jpg", mi.Bitmap(img))
+        return
 
     print("Loading scene...")
     scene = mi.load_dict(scene_dict)
 
     print(f"Starting rendering with {spp} spp...")
     start_time = time.time()
-    if sample_per_pass > spp:
-        img = mi.render(scene, spp=spp)
+    if target_error is None:
+        stats, log = render_passes(scene, spp, sample_per_pass=sample_per_pass, memory_budget=int(memory_budget_gb * 2**30), checkpoint=checkpoint, tag=scene_tag)
+        peak_rss_mb = max((record["peak_rss_mb"] for record in log), default=peak_rss() / 2**20)
     else:
-        # Rendering with the measured BTF tends to use a lot of memory,
-        # so splitting the rendering into several passes and averaging the results.
-        images = []
-        for i in tqdm(range(spp // sample_per_pass)):
-            img = mi.render(scene, seed=i, spp=sample_per_pass)
-            images.append(img)
-        img = mi.Bitmap(np.mean(images, axis=0))
+        stats, log = render_adaptive(scene, target_error=target_error, time_budget=time_budget, max_spp=spp, sample_per_pass=sample_per_pass or 4, tile_size=tile_size, checkpoint=checkpoint, tag=scene_tag)
+        peak_rss_mb = peak_rss() / 2**20
+        print(f"{np.mean(stats.weight):.1f} spp on average, {np.min(stats.weight)} to {np.max(stats.weight)} per pixel")
+    img = mi.Bitmap(stats.mean.astype(np.float32))
+    render_seconds = time.time() - start_time
+
+    print(f"Rendering finished in {render_seconds / 60:.2f} min.")
+    print(f"Peak RSS {peak_rss_mb:.0f} MB")
+    if stats.passes >= 2:
+        print(f"Mean relative error {np.mean(stats.relative_error()):.4f}")
 
-    print(f"Rendering finished in {(time.time() - start_time) / 60:.2f} min.")
+    # With BTF_PROFILE=1 (or the profile property of a measuredbtf plugin), show where the time went
+    if profiling.enabled():
+        print(profiling.report(render_seconds))
+        profiling.dump("output.profile.json", render_seconds=render_seconds, spp=spp)
 
     mi.util.write_bitmap("output.jpg", img)
+    Path(checkpoint).unlink(missing_ok=True)
 
 
 if __name__ == "__main__":